@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+#direct BAM/CRAM input for the pileup scripts, skipping the samtools mpileup text stage.
+#pysam's pileup engine walks the alignments and every covered site becomes the same read base and quality vectors the text parser decodes from mpileup output
+#of the same alignments with BAQ off (samtools mpileup -B) and the same reference: bases matching the reference as . or , by strand, other bases upper case on the forward strand
+#and lower case on the reverse, deletions and reference skips as placeholders, and qualities as the values of the mpileup quality characters relative to '0'.
+#the scripts then get the same folded ACGTN. reads and strands as from pileup_parser.tokenize and apply the same filters as always, without the pileup text ever being written out and read back.
+#pysam gives the indel markup of each read (but not the read start and end marks), which pileup_parser.tokenize drops as it does in text.
+#pysam is only needed for this input mode; pileup_parser.read_batches imports this module when it is given a .bam or .cram path.
+
+#import
+import numpy as np
+import pysam
+import pileup_parser
+
+#define functions/classes
+
+BATCHSITES = 1 << 16 #sites per batch.
+REFWINDOW = 1 << 20 #reference bases fetched at a time.
+FLAG_FILTER = 0x4 | 0x100 | 0x200 | 0x400 #unmapped, secondary, qc fail and duplicate reads, as samtools mpileup skips by default.
+PHRED = 33
+
+class BamBatch(pileup_parser.SiteBatch):
+    '''
+    A SiteBatch of sites of one contig built from pysam pileup columns instead of a text block.
+    The read base and quality columns it reports are the kept ACGTN. reads, folded to the forward strand, and their digits, and the depth column is the number of reads at the site, as in mpileup's depth column.
+    '''
+    def __init__(self, contig, pos, refs, depths, bases, quals, offsets, reverse = None):
+        self.contig = contig
+        self.pos = pos
+        self.refs = refs
+        self.depths = depths
+        self.bases = bases
+        self.quals = quals
+        self.reverse = reverse
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.pos)
+
+    def column(self, i, col):
+        if col == 0:
+            return self.contig
+        if col == 1:
+            return str(self.pos[i])
+        if col == 2:
+            return chr(self.refs[i])
+        if col == 3:
+            return str(self.depths[i])
+        if col == 4:
+            return self.bases[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+        return (self.quals[self.offsets[i]:self.offsets[i+1]] + pileup_parser.QZERO).tobytes().decode()
+
+    def fields(self, i):
+        return [self.column(i, c) for c in range(6)]
+
+    def positions(self):
+        return self.pos
+
+class Reference:
+    '''
+    Reference bases of a fasta file with a .fai index, fetched a window at a time since pileup sites come in position order.
+    '''
+    def __init__(self, path):
+        self.fasta = pysam.FastaFile(path)
+        self.contig = None
+        self.start = 0
+        self.bases = b''
+
+    def base(self, contig, pos):
+        #the reference byte at a 0 based position, N past the end of the sequence.
+        if contig != self.contig or not self.start <= pos < self.start + len(self.bases):
+            self.contig = contig
+            self.start = pos
+            self.bases = self.fasta.fetch(contig, pos, pos + REFWINDOW).encode()
+        offset = pos - self.start
+        return self.bases[offset] if offset < len(self.bases) else ord('N')
+
+def make_batch(contig, pos, refs, depths, seqs, quals):
+    #turn the per-site read base strings and quality lists of one contig into a BamBatch, tokenizing and keeping the ACGTN. reads as the text parser does.
+    raw = np.frombuffer(''.join(seqs).encode(), dtype = np.uint8)
+    raw_offsets = np.zeros(len(seqs) + 1, dtype = np.int64)
+    np.cumsum([len(s) for s in seqs], out = raw_offsets[1:])
+    codes, reverse, read_offsets = pileup_parser.tokenize(raw, raw_offsets)
+    rawquals = np.concatenate(quals).astype(np.int64) if quals else np.zeros(0, dtype = np.int64)
+    assert len(codes) == len(rawquals), 'pysam returned different numbers of reads and qualities in ' + contig
+    #the text parser subtracts '0' from the quality characters in uint8, so characters below '0' wrap around the same way here.
+    rawquals = ((rawquals + PHRED - pileup_parser.QZERO) % 256).astype(np.uint8)
+    keep = pileup_parser.any_of(codes, pileup_parser.KEEP)
+    offsets = np.zeros(len(seqs) + 1, dtype = np.int64)
+    np.cumsum(pileup_parser.segment_sums(keep, read_offsets), out = offsets[1:])
+    return BamBatch(contig, np.array(pos, dtype = np.int64), np.array(refs, dtype = np.uint8), np.array(depths, dtype = np.int64), codes[keep], rawquals[keep], offsets, reverse[keep])
+
+def iter_bam_batches(path, reference, regions = None, require = None, batchsites = BATCHSITES, min_baseq = 13, min_mapq = 0, max_depth = 8000):
+    #yield a BamBatch for every batchsites covered sites of an indexed BAM or CRAM file, optionally restricted to regions (1 based inclusive, as from pileup_parser.get_regions).
+    #min_baseq, min_mapq and max_depth are samtools mpileup's -Q, -q and -d with their defaults. require works as in pileup_parser.parse_block.
+    assert reference != None, 'BAM and CRAM input needs the reference fasta the pileups were made with'
+    bam = pysam.AlignmentFile(path, reference_filename = reference)
+    ref = Reference(reference)
+    fasta = pysam.FastaFile(reference)
+    wanted = None if require == None else require.decode()
+    if regions == None:
+        spans = [(contig, None, None) for contig in bam.references]
+    else:
+        spans = [(contig, start - 1, None if end == float('inf') else int(end)) for contig, start, end in regions]
+    for contig, start, end in spans:
+        pos, refs, depths, seqs, quals = [], [], [], [], []
+        columns = bam.pileup(contig, start, end, truncate = start != None, fastafile = fasta, stepper = 'samtools', compute_baq = False,
+            min_base_quality = min_baseq, min_mapping_quality = min_mapq, max_depth = max_depth, flag_filter = FLAG_FILTER, multiple_iterators = False)
+        for column in columns:
+            #one entry per read, with its indel markup as in mpileup text; without the markup pysam gives deleted bases as empty strings instead of *.
+            reads = column.get_query_sequences(mark_matches = True, add_indels = True)
+            bases = ''.join(reads)
+            #reverse strand reads come back in lower case (, for reference matches), so require is answered on the folded bases.
+            folded = bases.upper()
+            if wanted != None and not any([c in folded for c in wanted]):
+                continue
+            pos.append(column.reference_pos + 1)
+            refs.append(ref.base(contig, column.reference_pos))
+            depths.append(len(reads))
+            seqs.append(bases)
+            quals.append(np.asarray(column.get_query_qualities(), dtype = np.int64))
+            if len(pos) >= batchsites:
+                yield make_batch(contig, pos, refs, depths, seqs, quals)
+                pos, refs, depths, seqs, quals = [], [], [], [], []
+        if pos:
+            yield make_batch(contig, pos, refs, depths, seqs, quals)
+    bam.close()
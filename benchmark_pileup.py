@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+#this script benchmarks the pileup scripts on synthetic pileups from simulate_pileup.py.
+#for each pileup size and script it reports sites per second, peak resident memory and the PCR duplicate threshold cache hit rate,
+#and saves the results as json so runs before and after a change can be compared with --compare.
+#every script runs in its own process so its memory use is measured alone; the child side of this script runs the script's main and records its threshold caches.
+
+#import
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import simulate_pileup
+
+#define functions/classes
+
+SCRIPTS = ['pileup_to_vcf', 'pileup_to_vcf_snpg', 'pileup_to_fshift_vcf', 'pileup_to_plaintxt', 'collapse_pileup_to_mut', 'remove_bad_entries', 'get_best_mutations']
+
+def script_args(script, pileup, header, output):
+    #command line arguments for a script reading pileup and writing output; get_best_mutations reads standard in instead.
+    if script in ('pileup_to_vcf', 'pileup_to_vcf_snpg', 'pileup_to_fshift_vcf'):
+        return ['-a', header, '-p', pileup, '-o', output]
+    if script == 'pileup_to_plaintxt':
+        return ['-p', pileup, '-o', output]
+    if script == 'collapse_pileup_to_mut':
+        return ['-e', pileup]
+    if script == 'remove_bad_entries':
+        return ['-i', pileup, '-o', output]
+    return []
+
+def run_child(script, statsfile, argv):
+    #child side: run one script's main with the given arguments and write the hit and miss counts of every threshold cache it made.
+    import pcr_thresholds
+    caches = []
+    init = pcr_thresholds.ThresholdCache.__init__
+    def tracking_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        caches.append(self)
+    pcr_thresholds.ThresholdCache.__init__ = tracking_init
+    module = importlib.import_module(script)
+    sys.argv = [script + '.py'] + argv
+    module.main()
+    sys.stdout.flush()
+    lookups = sum([c.lookups for c in caches])
+    computed = sum([c.computed for c in caches])
+    with open(statsfile, 'w+') as outf:
+        json.dump({'cache_lookups': lookups, 'cache_misses': computed}, outf)
+
+def run_script(script, pileup, header, workdir):
+    #run one script in a child process; returns its timing, memory and cache statistics.
+    output = os.path.join(workdir, script + '.out')
+    statsfile = os.path.join(workdir, script + '.stats.json')
+    command = [sys.executable, os.path.abspath(__file__), '--child', script, statsfile, '--'] + script_args(script, pileup, header, output)
+    stdin = open(pileup, 'rb') if script == 'get_best_mutations' else subprocess.DEVNULL
+    stdout = open(output, 'wb') if script in ('collapse_pileup_to_mut', 'get_best_mutations') else subprocess.DEVNULL
+    start = time.time()
+    process = subprocess.Popen(command, stdin = stdin, stdout = stdout, cwd = os.path.dirname(os.path.abspath(__file__)))
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    for handle in (stdin, stdout):
+        if handle != subprocess.DEVNULL:
+            handle.close()
+    assert status == 0, script + ' failed'
+    with open(statsfile) as inf:
+        stats = json.load(inf)
+    with open(output, 'rb') as inf:
+        stats['output_lines'] = sum([chunk.count(b'\n') for chunk in iter(lambda: inf.read(1 << 20), b'')])
+    stats['seconds'] = seconds
+    stats['peak_rss_mb'] = usage.ru_maxrss / 1024 #linux reports kilobytes.
+    stats['cache_hit_rate'] = None if stats['cache_lookups'] == 0 else 1 - stats['cache_misses'] / stats['cache_lookups']
+    return stats
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, previous):
+    #print the sites per second of this run relative to an earlier results file, per script and size.
+    before = {(r['script'], r['sites']): r for r in previous['results']}
+    print('script\tsites\tsites_per_sec\tbefore\tratio')
+    for r in results['results']:
+        old = before.get((r['script'], r['sites']))
+        if old != None:
+            print('{}\t{}\t{:.0f}\t{:.0f}\t{:.2f}'.format(r['script'], r['sites'], r['sites_per_sec'], old['sites_per_sec'], r['sites_per_sec'] / old['sites_per_sec']))
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
+    parser.add_argument('-n', '--sites', type = int, nargs = '+', help = 'Pileup sizes to benchmark. Default 1000000 10000000', default = [1000000, 10000000])
+    parser.add_argument('-s', '--scripts', nargs = '+', choices = SCRIPTS, help = 'Scripts to benchmark. Default all', default = SCRIPTS)
+    parser.add_argument('-w', '--workdir', help = 'Directory for the synthetic pileups and script outputs. Pileups already there are reused. Default bench', default = 'bench')
+    parser.add_argument('-o', '--output', help = 'Path of the json results file. Default bench/results.json', default = None)
+    parser.add_argument('--compare', help = 'Earlier json results file to compare sites per second against.', default = None)
+    parser.add_argument('-d', '--depth', help = 'Depth distribution, uniform:lo,hi poisson:mean or negbin:mean,dispersion. Default uniform:20,150', default = 'uniform:20,150')
+    parser.add_argument('-a', '--alt_rate', type = float, help = 'Chance of each read base being an alternative allele. Default .002', default = .002)
+    parser.add_argument('-N', '--n_rate', type = float, help = 'Chance of each read base being an N. Default .005', default = .005)
+    parser.add_argument('-p', '--pcr_rate', type = float, help = 'Chance of a site carrying a PCR duplicate cluster. Default .01', default = .01)
+    parser.add_argument('--pcr_size', help = 'Smallest and largest PCR cluster size. Default 3,8', default = '3,8')
+    parser.add_argument('-i', '--indel_rate', type = float, help = 'Chance of a site carrying an indel token. Default 0', default = 0)
+    parser.add_argument('-e', '--edge_rate', type = float, help = 'Chance of each read base carrying a read start or end mark. Default 0', default = 0)
+    parser.add_argument('--seed', type = int, help = 'Random seed for the synthetic pileups. Default 0', default = 0)
+    args = parser.parse_args()
+    return args
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3], sys.argv[5:])
+        return
+    args = argparser()
+    os.makedirs(args.workdir, exist_ok = True)
+    output = os.path.join(args.workdir, 'results.json') if args.output == None else args.output
+    settings = simulate_pileup.settings_from_args(args)
+    header = os.path.join(args.workdir, 'header.vcf')
+    with open(header, 'w+') as outf:
+        print('##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO', file = outf)
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+        'host': platform.node(), 'settings': dict(settings, seed = args.seed), 'results': []}
+    for nsites in args.sites:
+        #the file name records the settings, so a pileup is only reused for the same synthetic data.
+        tag = '_'.join([str(nsites), args.depth.replace(':', '-').replace(',', '-'), str(args.alt_rate), str(args.n_rate), str(args.pcr_rate), args.pcr_size.replace(',', '-'), str(args.indel_rate), str(args.edge_rate), str(args.seed)])
+        pileup = os.path.join(args.workdir, 'sim_' + tag + '.pileup')
+        if not os.path.exists(pileup):
+            if args.verbose:
+                print("Writing", nsites, "synthetic sites to", pileup, file = sys.stderr)
+            with open(pileup + '.tmp', 'w+') as outf:
+                simulate_pileup.simulate(outf, nsites, seed = args.seed, **settings)
+            os.replace(pileup + '.tmp', pileup)
+        for script in args.scripts:
+            stats = run_script(script, os.path.abspath(pileup), os.path.abspath(header), os.path.abspath(args.workdir))
+            stats.update({'script': script, 'sites': nsites, 'sites_per_sec': nsites / stats['seconds']})
+            results['results'].append(stats)
+            if args.verbose:
+                rate = 'na' if stats['cache_hit_rate'] == None else '{:.3f}'.format(stats['cache_hit_rate'])
+                print('{}\t{}\t{:.1f}s\t{:.0f} sites/s\t{:.0f} MB\tcache hit rate {}'.format(script, nsites, stats['seconds'], stats['sites_per_sec'], stats['peak_rss_mb'], rate), file = sys.stderr)
+    with open(output, 'w+') as outf:
+        json.dump(results, outf, indent = 1)
+    if args.compare != None:
+        with open(args.compare) as inf:
+            compare(results, json.load(inf))
+
+if __name__ == "__main__":
+    main()
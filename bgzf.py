@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+#BGZF (blocked gzip, as written by bgzip) reading and writing plus a position index for sorted pileups, using only zlib.
+#a BGZF file is a series of small gzip members, so any byte of the uncompressed text can be reached through a virtual offset:
+#the compressed offset of its block shifted left 16 bits, plus the offset inside that block. The .pidx index records the virtual offset
+#of the first line of every block (and of every contig start) with its contig and position, so a region can be read by seeking straight to it.
+#VCFs written as BGZF get a tabix (.tbi) index instead, which bcftools, tabix, SnpEff and pysam can use to seek.
+#run this script directly to compress and index a pileup, or to index a pileup that was compressed with bgzip.
+
+#import
+import argparse
+import bisect
+import collections
+import gzip
+import io
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+#define functions/classes
+
+MAGIC = b'\x1f\x8b\x08\x04'
+MAX_BLOCK = 0xff00 #uncompressed bytes per block, the same as bgzip uses so blocks stay under 64kb compressed.
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+INDEX_VERSION = 1
+
+READ_THREADS = min(4, os.cpu_count() or 1) #decompression threads used by default when reading BGZF input.
+
+def is_bgzf(path):
+    #True if the file starts with a BGZF block header.
+    with open(path, 'rb') as inf:
+        header = inf.read(16)
+    return len(header) == 16 and header[:4] == MAGIC and header[12:14] == b'BC'
+
+def is_gzip(path):
+    #True for any gzip file, BGZF included.
+    with open(path, 'rb') as inf:
+        return inf.read(2) == b'\x1f\x8b'
+
+def read_raw_block(handle):
+    #read the compressed BGZF block at the handle position; returns its bytes, or None at the end of the file.
+    header = handle.read(18)
+    if len(header) < 18:
+        return None
+    assert header[:4] == MAGIC, 'not a BGZF block'
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:] + handle.read(xlen - 6)
+    bsize = None
+    i = 0
+    while i < len(extra):
+        slen = struct.unpack('<H', extra[i+2:i+4])[0]
+        if extra[i:i+2] == b'BC':
+            bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+        i += 4 + slen
+    assert bsize != None, 'BGZF block without a BC field'
+    return header[:12] + extra + handle.read(bsize - xlen - 11)
+
+def inflate_block(raw):
+    #decompressed bytes of a block from read_raw_block.
+    xlen = struct.unpack('<H', raw[10:12])[0]
+    data = zlib.decompress(raw[12+xlen:-8], -15)
+    assert len(data) == struct.unpack('<I', raw[-4:])[0], 'BGZF block size check failed'
+    return data
+
+def read_block(handle):
+    #read the BGZF block at the handle position; returns its decompressed bytes, or None at the end of the file.
+    raw = read_raw_block(handle)
+    return None if raw == None else inflate_block(raw)
+
+def iter_raw_blocks(path):
+    #yield (compressed offset, decompressed bytes) for every block of a BGZF file.
+    with open(path, 'rb') as inf:
+        while True:
+            coffset = inf.tell()
+            data = read_block(inf)
+            if data == None:
+                break
+            if data:
+                yield coffset, data
+
+class BgzfReader(io.RawIOBase):
+    '''
+    Read only binary handle on the uncompressed text of a BGZF file (a path, or an open binary handle such as standard in), with seek() and tell() in virtual offsets.
+    It has the read() method the pileup_parser block reader needs. With threads > 1 the blocks ahead of the read position are decompressed on a thread pool
+    (zlib releases the GIL), so decompression runs alongside the parsing.
+    '''
+    def __init__(self, path, threads = 1):
+        super().__init__()
+        self.owned = isinstance(path, str)
+        self.handle = open(path, 'rb') if self.owned else path
+        self.coffset = 0
+        self.roffset = 0 #compressed offset of the next block to read from the handle, counted so a pipe works too.
+        self.data = b''
+        self.pos = 0
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending = collections.deque() #(compressed offset, decompression future) of the blocks read ahead.
+
+    def _read_ahead(self):
+        while len(self.pending) < self.threads * 4:
+            raw = read_raw_block(self.handle)
+            if raw == None:
+                break
+            self.pending.append((self.roffset, self.pool.submit(inflate_block, raw)))
+            self.roffset += len(raw)
+
+    def _next_block(self):
+        if self.pool == None:
+            self.coffset = self.roffset
+            raw = read_raw_block(self.handle)
+            data = None if raw == None else inflate_block(raw)
+            self.roffset += 0 if raw == None else len(raw)
+        else:
+            self._read_ahead()
+            if self.pending:
+                self.coffset, future = self.pending.popleft()
+                data = future.result()
+            else:
+                self.coffset = self.roffset
+                data = None
+        self.data = b'' if data == None else data
+        self.pos = 0
+        return data != None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.handle.seekable()
+
+    def seek(self, voffset, whence = 0):
+        self.pending.clear()
+        self.handle.seek(voffset >> 16)
+        self.roffset = voffset >> 16
+        self._next_block()
+        self.pos = voffset & 0xffff
+        return voffset
+
+    def tell(self):
+        return (self.coffset << 16) | self.pos
+
+    def read(self, size = -1):
+        chunks = []
+        while size == None or size < 0 or size > 0:
+            if self.pos >= len(self.data) and not self._next_block():
+                break
+            take = len(self.data) - self.pos if size == None or size < 0 else min(size, len(self.data) - self.pos)
+            chunks.append(self.data[self.pos:self.pos+take])
+            self.pos += take
+            if size != None and size > 0:
+                size -= take
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self.pool != None:
+                self.pool.shutdown(cancel_futures = True)
+            if self.owned:
+                self.handle.close()
+        super().close()
+
+def open_input(path = None, text = True, threads = READ_THREADS):
+    #handle on a plain, gzip or BGZF compressed file, or on standard in when path is None, decompressing as it reads.
+    #text handles are for line iteration like open(path); binary ones (text = False) are for the pileup_parser block reader.
+    if path == None:
+        handle = sys.stdin.buffer
+        head = handle.peek(18)[:18]
+    else:
+        with open(path, 'rb') as inf:
+            head = inf.read(18)
+    if len(head) >= 16 and head[:4] == MAGIC and head[12:14] == b'BC':
+        binary = io.BufferedReader(BgzfReader(path if path != None else handle, threads), 1 << 20)
+    elif head[:2] == b'\x1f\x8b':
+        binary = gzip.open(path, 'rb') if path != None else gzip.GzipFile(fileobj = handle)
+    elif path == None:
+        return sys.stdin if text else handle
+    else:
+        return open(path) if text else open(path, 'rb')
+    return io.TextIOWrapper(binary) if text else binary
+
+def compress_block(data, level = 6):
+    #one complete BGZF block holding data, at most MAX_BLOCK bytes.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = MAGIC + b'\x00\x00\x00\x00\x00\xff' + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfWriter:
+    '''
+    Binary write handle that compresses its input into BGZF blocks, readable by bgzip, samtools and BgzfReader.
+    With threads > 1 blocks are compressed by a thread pool (zlib releases the GIL) and written in order as they finish.
+    '''
+    def __init__(self, path, level = 6, threads = 1):
+        self.handle = open(path, 'wb')
+        self.level = level
+        self.buffer = b''
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending = []
+
+    def _write_block(self, data):
+        if self.pool == None:
+            self.handle.write(compress_block(data, self.level))
+            return
+        self.pending.append(self.pool.submit(compress_block, data, self.level))
+        #keep a few blocks per thread in flight, so memory stays bounded.
+        while len(self.pending) > self.threads * 4:
+            self.handle.write(self.pending.pop(0).result())
+
+    def _drain(self):
+        for future in self.pending:
+            self.handle.write(future.result())
+        self.pending = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= MAX_BLOCK:
+            full = len(self.buffer) - len(self.buffer) % MAX_BLOCK
+            for start in range(0, full, MAX_BLOCK):
+                self._write_block(self.buffer[start:start+MAX_BLOCK])
+            self.buffer = self.buffer[full:]
+
+    def tell(self):
+        self._drain()
+        return (self.handle.tell() << 16) | len(self.buffer)
+
+    def close(self):
+        if self.buffer:
+            self._write_block(self.buffer)
+            self.buffer = b''
+        self._drain()
+        if self.pool != None:
+            self.pool.shutdown()
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+def index_path(path):
+    return path + '.pidx'
+
+def site_key(line):
+    #contig and position of a pileup line.
+    spent = line.split(b'\t', 2)
+    return spent[0].decode(), int(spent[1])
+
+def build_index(path):
+    #scan a BGZF pileup and return the index entries [(contig, position, virtual offset)].
+    #the first line of every block is recorded, plus the first line of every contig that starts inside a block.
+    entries = []
+    carry = b''
+    carry_voffset = None
+    for coffset, data in iter_raw_blocks(path):
+        text = carry + data
+        lines = text.split(b'\n')
+        last = lines.pop()
+        if lines:
+            first = carry_voffset if carry else coffset << 16
+            contig, pos = site_key(lines[0])
+            if not entries or entries[-1][0] != contig or entries[-1][2] != first:
+                entries.append((contig, pos, first))
+            if site_key(lines[-1])[0] != contig:
+                #a contig starts in this block; walk its lines to find where.
+                offset = len(lines[0]) + 1
+                for line in lines[1:]:
+                    key = site_key(line)
+                    if key[0] != entries[-1][0]:
+                        entries.append((key[0], key[1], (coffset << 16) | (offset - len(carry))))
+                    offset += len(line) + 1
+            carry_voffset = (coffset << 16) | (len(text) - len(last) - len(carry))
+        elif not carry:
+            carry_voffset = coffset << 16
+        carry = last
+    return entries
+
+def write_index(path, entries):
+    with open(index_path(path) + '.tmp', 'w+') as outf:
+        print('#pileup_index\tversion=' + str(INDEX_VERSION), file = outf)
+        for contig, pos, voffset in entries:
+            print(contig + '\t' + str(pos) + '\t' + str(voffset), file = outf)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+
+def load_index(path):
+    #dictionary of contig: (positions, virtual offsets) from the .pidx file next to a BGZF pileup.
+    index = {}
+    with open(index_path(path)) as inf:
+        header = inf.readline().strip().split('\t')
+        if header != ['#pileup_index', 'version=' + str(INDEX_VERSION)]:
+            raise ValueError(index_path(path) + " is not a version " + str(INDEX_VERSION) + " pileup index")
+        for entry in inf:
+            contig, pos, voffset = entry.strip().split('\t')
+            if contig not in index:
+                index[contig] = ([], [])
+            index[contig][0].append(int(pos))
+            index[contig][1].append(int(voffset))
+    return index
+
+def trim_block(block, contig, start, end):
+    #keep the lines of a block that fall within the region; also reports whether reading can stop.
+    #most blocks of a region lie entirely inside it, so only the first and last line are checked before splitting.
+    lines = block.split(b'\n')[:-1]
+    first = site_key(lines[0])
+    last = site_key(lines[-1])
+    if first[0] == contig and last[0] == contig and first[1] >= start and last[1] <= end:
+        return block, False
+    kept = []
+    for line in lines:
+        key = site_key(line)
+        if key[0] != contig or key[1] > end:
+            return b''.join(kept), True
+        if key[1] >= start:
+            kept.append(line + b'\n')
+    return b''.join(kept), False
+
+def iter_region_blocks(path, regions, blocksize = 1 << 20, index = None):
+    #yield blocks of whole lines of a sorted BGZF pileup that fall within regions, a list of (contig, start, end) with 1 based inclusive positions.
+    #each region seeks to the last indexed line at or before its start.
+    if index == None:
+        index = load_index(path)
+    reader = BgzfReader(path, READ_THREADS)
+    for contig, start, end in regions:
+        if contig not in index:
+            continue
+        positions, voffsets = index[contig]
+        reader.seek(voffsets[max(0, bisect.bisect_right(positions, start) - 1)])
+        carry = b''
+        done = False
+        while not done:
+            data = reader.read(blocksize)
+            if not data:
+                if carry:
+                    block, done = trim_block(carry + b'\n', contig, start, end)
+                    if block:
+                        yield block
+                break
+            data = carry + data
+            cut = data.rfind(b'\n') + 1
+            carry = data[cut:]
+            if cut == 0:
+                continue
+            block, done = trim_block(data[:cut], contig, start, end)
+            if block:
+                yield block
+    reader.close()
+
+def reg2bin(beg, end):
+    #smallest tabix/BAI bin holding the 0 based half open interval [beg, end).
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def iter_lines(path):
+    #yield (line, virtual offset of its start, virtual offset just past its newline) for every line of a BGZF file.
+    carry = b''
+    carry_voffset = None
+    for coffset, data in iter_raw_blocks(path):
+        text = carry + data
+        start = 0
+        while True:
+            cut = text.find(b'\n', start)
+            if cut < 0:
+                break
+            #offsets before len(carry) fall in an earlier block.
+            first = carry_voffset + start if start < len(carry) else (coffset << 16) | (start - len(carry))
+            yield text[start:cut], first, (coffset << 16) | (cut + 1 - len(carry))
+            start = cut + 1
+        if start < len(carry):
+            carry_voffset += start
+        else:
+            carry_voffset = (coffset << 16) | (start - len(carry))
+        carry = text[start:]
+
+def build_tabix(path):
+    #tabix (.tbi) index of a sorted BGZF VCF. Returns the index as a bytes object, before its own BGZF compression.
+    names = []
+    refs = {}
+    for line, vstart, vend in iter_lines(path):
+        if line.startswith(b'#'):
+            continue
+        spent = line.split(b'\t', 4)
+        contig = spent[0].decode()
+        beg = int(spent[1]) - 1
+        end = beg + max(len(spent[3]), 1)
+        if contig not in refs:
+            names.append(contig)
+            refs[contig] = ({}, [])
+        bins, linear = refs[contig]
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        for window in range(beg >> 14, ((end - 1) >> 14) + 1):
+            while len(linear) <= window:
+                linear.append(None)
+            if linear[window] == None:
+                linear[window] = vstart
+    nmtext = b''.join([name.encode() + b'\x00' for name in names])
+    #format 2 is VCF: sequence, begin and end columns 1, 2 and 0, '#' for header lines, no lines skipped.
+    out = [b'TBI\x01', struct.pack('<8i', len(names), 2, 1, 2, 0, ord('#'), 0, len(nmtext)), nmtext]
+    for name in names:
+        bins, linear = refs[name]
+        out.append(struct.pack('<i', len(bins)))
+        for b in sorted(bins):
+            out.append(struct.pack('<Ii', b, len(bins[b])))
+            for vstart, vend in bins[b]:
+                out.append(struct.pack('<QQ', vstart, vend))
+        #windows no record starts in take the offset of the window before them.
+        previous = 0
+        for i, voffset in enumerate(linear):
+            if voffset == None:
+                linear[i] = previous
+            previous = linear[i]
+        out.append(struct.pack('<i', len(linear)))
+        out.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+    return b''.join(out)
+
+def write_tabix(path):
+    #write the .tbi index next to a BGZF VCF.
+    writer = BgzfWriter(path + '.tbi.tmp')
+    writer.write(build_tabix(path))
+    writer.close()
+    os.replace(path + '.tbi.tmp', path + '.tbi')
+
+def compress_pileup(inpath, outpath, level = 6, threads = 1):
+    #bgzip a pileup (or standard in when inpath is None) into outpath.
+    inf = sys.stdin.buffer if inpath == None else open(inpath, 'rb')
+    writer = BgzfWriter(outpath, level, threads)
+    while True:
+        data = inf.read(1 << 20)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+    if inpath != None:
+        inf.close()
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help = 'Pileup to compress. Default is standard in', default = None)
+    parser.add_argument('-o', '--output', help = 'Path of the BGZF pileup to write and index. If no input is given with an existing output, only the index is (re)built')
+    parser.add_argument('-l', '--level', type = int, help = 'zlib compression level. Default 6', default = 6)
+    parser.add_argument('-t', '--threads', type = int, help = 'Number of compression threads. Default 1', default = 1)
+    parser.add_argument('--vcf', action = 'store_true', help = 'The input is a sorted VCF; write a tabix .tbi index instead of the pileup .pidx index.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = argparser()
+    if args.input != None or not os.path.exists(args.output):
+        compress_pileup(args.input, args.output, args.level, args.threads)
+    if args.vcf:
+        write_tabix(args.output)
+    else:
+        write_index(args.output, build_index(args.output))
+
+if __name__ == "__main__":
+    main()
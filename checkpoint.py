@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+#checkpoints for long pileup conversions (pileup_to_vcf and remove_bad_entries), so an interrupted run can continue with --resume instead of starting over.
+#every interval seconds, once a batch has been written, the outputs are flushed to disk and a json file next to the first output records the pileup byte offset reached,
+#the byte size of every output at that point, the settings of the run and the PCR duplicate thresholds computed so far.
+#--resume cuts the outputs back to those sizes and continues reading the pileup from the offset, so at most one interval of work is lost.
+#both ends are addressed by byte offsets, so this needs an uncompressed pileup file (no regions) and uncompressed output files. The checkpoint is removed when the run finishes.
+#checkpoints are off unless the scripts are given --checkpoint-interval; a resumed run keeps saving them every INTERVAL seconds unless given its own interval.
+
+#import
+import json
+import os
+import time
+import bgzf
+import pileup_parser
+import output_writer
+
+#define functions/classes
+
+CHECKPOINT_VERSION = 1
+INTERVAL = 600 #seconds between the checkpoints of a resumed run without --checkpoint-interval.
+IGNORED = ('resume', 'checkpoint_interval', 'verbose', 'profile', 'threads', 'compress_threads') #options that can change between a run and its resumption.
+
+def checkpoint_path(path):
+    return path + '.ckpt'
+
+def interval(args):
+    #seconds between checkpoints for a script's parsed arguments, 0 when the run is not checkpointed.
+    if args.checkpoint_interval != None:
+        return args.checkpoint_interval
+    return INTERVAL if args.resume else 0
+
+def supported(pileup, outputs, regions = None, bgzip = False):
+    #whether a run can be checkpointed: an uncompressed pileup file without regions, written to uncompressed output files.
+    return (pileup != None and regions == None and os.path.isfile(pileup) and not bgzf.is_gzip(pileup) and not pileup_parser.is_alignment(pileup) and len(outputs) > 0
+        and all([path != None and not output_writer.wants_bgzip(path, bgzip) for path in outputs]))
+
+class Checkpoint:
+    '''
+    The checkpoint file of one run. settings are the run's parsed arguments, which a resumed run must repeat (apart from IGNORED);
+    caches are the pcr_thresholds.ThresholdCache objects whose thresholds are saved and restored.
+    '''
+    def __init__(self, path, args, caches, interval = 600):
+        self.path = path
+        self.settings = {k: v for k, v in vars(args).items() if k not in IGNORED}
+        self.caches = caches
+        self.interval = interval
+        self.last = time.time()
+
+    def due(self):
+        return self.interval > 0 and time.time() - self.last >= self.interval
+
+    def save(self, offset, writers, extra = None):
+        #record that the pileup was processed up to byte offset, with everything written to the given output_writer.OutputWriter objects.
+        #extra is any other json value the script needs to reopen its outputs.
+        state = {'version': CHECKPOINT_VERSION, 'input_offset': offset, 'output_offsets': [w.sync() for w in writers], 'extra': extra,
+            'settings': self.settings, 'thresholds': [[[k[0], k[1], float(v)] for k, v in cache.items()] for cache in self.caches]}
+        with open(self.path + '.tmp', 'w+') as outf:
+            json.dump(state, outf)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.last = time.time()
+
+    def load(self):
+        #the saved state, with its thresholds merged back into the caches, or None when there is no checkpoint to resume from.
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as inf:
+            state = json.load(inf)
+        assert state['version'] == CHECKPOINT_VERSION, self.path + ' is not a version ' + str(CHECKPOINT_VERSION) + ' checkpoint'
+        changed = sorted([k for k in set(state['settings']) | set(self.settings) if state['settings'].get(k) != self.settings.get(k)])
+        assert len(changed) == 0, self.path + ' was made with different settings: ' + ', '.join(changed)
+        for cache, entries in zip(self.caches, state['thresholds']):
+            cache.merge([((length, basecount), thresh) for length, basecount, thresh in entries])
+        return state
+
+    def finish(self):
+        #the run completed, so there is nothing left to resume. A save cut short by the interruption can leave its temporary file behind too.
+        for path in (self.path, self.path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+#this script runs pileup_to_plaintxt over a cohort of samples and writes one combined table, e.g. as DnDscv input.
+#it takes a manifest of sample ID and pileup path pairs and calls the samples on a pool of worker processes.
+#the PCR duplicate thresholds are kept in a table in shared memory (pcr_thresholds.SharedThresholds), so a threshold computed for one sample is reused by every worker.
+#each sample is written to its own part file in the work directory first, which is only put in place once the sample finished.
+#a rerun after a failure or interruption reuses the finished parts and only calls the remaining samples; the combined table is written once every sample is done.
+
+#import
+import argparse
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+import pileup_parser
+import pcr_thresholds
+import pileup_to_plaintxt
+
+#define functions/classes
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
+    parser.add_argument('-m', '--manifest', help = 'Tab separated file of sample ID and pileup path (or site store directory), one sample per line.')
+    parser.add_argument('-o', '--output', help = 'Name of the combined text output file.')
+    parser.add_argument('-w', '--workdir', help = 'Directory for the per sample part files. Default is the output name plus .parts', default = None)
+    parser.add_argument('-t', '--threads', type = int, help = 'Number of worker processes. Default is the number of cpus', default = os.cpu_count())
+    parser.add_argument('-g', '--germline', type = bool, help = 'Set to True to retain germline mutations. Default is False and ignores high frequency mutations', default = False)
+    parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification. Default 50', default = 50)
+    pcr_thresholds.add_arguments(parser, loaded = 'It seeds the shared table')
+    parser.add_argument('--table-depth', dest = 'table_depth', type = int, help = 'Largest number of quality alternatives covered by the shared threshold table; longer keys are kept per worker. Default 1000', default = 1000)
+    parser.add_argument('--redo', action = 'store_true', help = 'Call every sample again instead of reusing finished part files.')
+    args = parser.parse_args()
+    return args
+
+def read_manifest(path):
+    #(sample ID, pileup path) pairs in manifest order. Blank lines and lines starting with # are skipped.
+    samples = []
+    with open(path) as inf:
+        for entry in inf:
+            if entry.startswith('#') or not entry.strip():
+                continue
+            spent = entry.strip().split('\t')
+            assert len(spent) == 2, 'manifest lines need a sample ID and a pileup path: ' + entry.strip()
+            samples.append((spent[0], spent[1]))
+    ids = [s[0] for s in samples]
+    assert len(set(ids)) == len(ids), 'sample IDs in the manifest are not unique'
+    return samples
+
+def part_path(workdir, sample_id):
+    return os.path.join(workdir, sample_id + '.txt')
+
+#each worker process reads and extends the shared threshold table.
+worker_track = None
+
+def init_worker(buffer, maxlen, seed, backend, depth_cap = None):
+    global worker_track
+    worker_track = pcr_thresholds.SharedThresholds(buffer, maxlen, seed = seed, backend = backend, depth_cap = depth_cap)
+
+def pool_call_sample(args):
+    #call one sample into its part file. Returns the sample ID, the number of rows (None on failure), the error text, the seconds taken
+    #and the thresholds this worker computed for the sample, for the cache file.
+    sample_id, path, part, mind, germline = args
+    known = len(worker_track)
+    start = time.time()
+    rows = 0
+    try:
+        with open(part + '.tmp', 'w+') as outf:
+            for batch in pileup_parser.read_batches(path, require = b'ACGT'):
+                lines = pileup_to_plaintxt.call_batch(pileup_parser.single_sample(batch, 'cohort_plaintxt'), mind, germline, worker_track, sample_id)
+                outf.write(''.join([line + '\n' for line in lines]))
+                rows += len(lines)
+        os.replace(part + '.tmp', part)
+    except Exception:
+        if os.path.exists(part + '.tmp'):
+            os.remove(part + '.tmp')
+        return sample_id, None, traceback.format_exc(), time.time() - start, list(worker_track.items())[known:]
+    return sample_id, rows, None, time.time() - start, list(worker_track.items())[known:]
+
+def combine_parts(samples, workdir, output):
+    #concatenate the part files in manifest order into the combined table.
+    with open(output + '.tmp', 'wb') as outf:
+        for sample_id, path in samples:
+            with open(part_path(workdir, sample_id), 'rb') as inf:
+                while True:
+                    chunk = inf.read(1 << 24)
+                    if not chunk:
+                        break
+                    outf.write(chunk)
+    os.replace(output + '.tmp', output)
+
+def main():
+    args = argparser()
+    samples = read_manifest(args.manifest)
+    workdir = args.output + '.parts' if args.workdir == None else args.workdir
+    os.makedirs(workdir, exist_ok = True)
+    todo = [(sample_id, path) for sample_id, path in samples if args.redo or not os.path.exists(part_path(workdir, sample_id))]
+    if args.verbose and len(todo) < len(samples):
+        print("Reusing", len(samples) - len(todo), "finished samples from", workdir, file = sys.stderr)
+    pdt = pcr_thresholds.from_args(args)
+    buffer = pcr_thresholds.shared_table(args.table_depth, pdt.items())
+    tasks = [(sample_id, path, part_path(workdir, sample_id), args.mind, args.germline) for sample_id, path in todo]
+    failed = []
+    done = len(samples) - len(todo)
+    with Pool(max(1, min(args.threads, len(tasks))), initializer = init_worker, initargs = (buffer, args.table_depth, args.seed, args.backend, args.depth_cap)) as p:
+        for sample_id, rows, error, seconds, found in p.imap_unordered(pool_call_sample, tasks):
+            pdt.merge(found)
+            if rows == None:
+                failed.append(sample_id)
+                print("Sample", sample_id, "failed:\n" + error, file = sys.stderr)
+                continue
+            done += 1
+            if args.verbose:
+                print("[{}/{}] {}: {} rows in {:.1f}s".format(done, len(samples), sample_id, rows, seconds), file = sys.stderr)
+        p.close()
+        p.join()
+    pdt.save()
+    if failed:
+        print(len(failed), "samples failed (" + ', '.join(failed) + "); rerun the same command to retry them, finished samples are kept", file = sys.stderr)
+        sys.exit(1)
+    combine_parts(samples, workdir, args.output)
+    if args.verbose:
+        print("Wrote", len(samples), "samples to", args.output, file = sys.stderr)
+
+if __name__ == "__main__":
+    main()
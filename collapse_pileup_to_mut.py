@@ -5,7 +5,10 @@
 import argparse
 import sys
 import numpy as np
-import statistics as st
+import pileup_parser
+import pcr_thresholds
+import profiler
+import density_tracks
 
 #adapted cousin of count_errors.py
 #creates a simplified pileup format for input to DnDscv
@@ -15,8 +18,15 @@ def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     parser.add_argument('-t', '--threshold', type = int, help = 'Set a minimum number of times a base must be seen. default 2', default = 2)
-    parser.add_argument('-e', '--errors', help = 'path to input pileup file.')
+    parser.add_argument('-e', '--errors', help = 'path to input pileup file or site store directory (see site_store.py). Default is standard in', default = None)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('--cap-report', dest = 'cap_report', action = 'store_true', help = 'Also collapse every site with exact thresholds and report to stderr how many mutation records, and so --tracks mutation counts, the --depth-cap loses, gains or changes, and how many thresholds each mode computed')
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only process this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only process the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--tracks', help = 'Also write windowed mutation, callable site and callable depth bedgraph tracks with this path prefix, counted in the same pass (see density_tracks.py). Default is no tracks', default = None)
+    parser.add_argument('-w', '--windows', type = int, nargs = '+', help = 'Window sizes of the --tracks, in bases. Default 1000 10000 100000', default = [1000, 10000, 100000])
     # parser.add_argument('-o', '--output', help = 'set a name for the simplified output file. default simple.txt', default = 'simple.txt')
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
     args = parser.parse_args()
     return args
 
@@ -30,113 +40,108 @@ def count_bases(path):
                         counts[base] += 1
     return counts
 
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
+def collapse_site(chrom, loc, ref, nalts, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), dindeces = None):
+    #collapse the quality filtered bases of one site (Ns removed, reference dots kept for spacing) into mutation records of chrom, loc, ref and base.
+    #pcr clusters and scattered alternatives are each recorded once because of the weaknesses of DnDscv.
+    prof = profiler.active
+    start = prof.start()
+    found = []
+    skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+    dindeces = pcr_thresholds.get_dindex(nalts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+    for base in 'ACGT':
+        basecount = nalts.count(base)
+        if 2 <= basecount <= len(nalts)/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+            key = (len(nalts), basecount)
+            thresh = pcr_duplicate_track[key]
+            if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                #print("QC: Base is skipped for clustering")
+                skip += base
+                prof.count('pcr_clusters')
+                found.append([chrom, loc, ref, base])
+        else:
+            #print("QC: Base is singleton or too high frequency in pileup")
+            skip += base
+    start = prof.lap('pcr_test', start)
+    #now actually go through and count the scattered mutations.
+    for base in nalts:
+        if base != '.' and base not in skip:
+            #print it out, but only record it once because of the weaknesses of DnDscv
+            skip += base
+            found.append([chrom, loc, ref, base])
+    prof.lap('format', start)
+    return found, pcr_duplicate_track
 
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
+def call_batch(batch, threshold = 2, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), tracks = None):
+    #the collapsed mutation lines of call_records.
+    return ['\t'.join(record) for record in call_records(batch, threshold, pcr_duplicate_track, tracks)]
 
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
+def call_records(batch, threshold = 2, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), tracks = None):
+    #strip out Ns and low quality alleles for a whole pileup_parser batch at once and return the collapsed mutation records.
+    #with tracks (a density_tracks.WindowTracks), the sites passing the depth filter and the records are also counted into its windows.
+    #apply filters for calling mutations here.
+    #first, the depth must be at least five in order to differentiate between germline and somatic mutations.
+    #depth being the non-N content of the alternative allele string.
+    #only sites with at least one alternative left can produce any output.
+    prof = profiler.active
+    start = prof.start()
+    quality = (batch.quals >= threshold) & (batch.bases != ord('N'))
+    depth = batch.count(quality)
+    nonref = batch.count(quality & (batch.bases != ord('.')))
+    deep = (depth > 5) & (batch.ref_codes(upper = True) != ord('N'))
+    sites = np.flatnonzero(deep & (nonref > 0))
+    alts = batch.strings(quality, sites)
+    #the pcr cluster gaps of all the sites in one go.
+    dindeces = pcr_thresholds.site_dindeces(*batch.masked(quality), sites)
+    if prof.enabled:
+        prof.count('sites', len(batch))
+        prof.reject('depth', len(batch) - deep.sum())
+        prof.reject('quality', deep.sum() - len(sites))
+    prof.lap('filter', start)
+    records = []
+    mutated = [] #the site of each record, for the tracks.
+    for i, nalts, dindex in zip(sites, alts, dindeces):
+        found, pcr_duplicate_track = collapse_site(batch.chrom(i), batch.loc(i), batch.ref(i).upper(), nalts, pcr_duplicate_track, dindex)
+        records.extend(found)
+        mutated.extend([i] * len(found))
+    if tracks != None:
+        start = prof.start()
+        tracks.add_batch(batch, called = deep, depths = depth, mutated = mutated)
+        prof.lap('tracks', start)
+    return records
+
+def collapse_pileup_to_mut(chunks, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), threshold = 2):
+    #pipeline stage (see pileup_pipeline.py): the mutation records of call_records for each chunk of sites.
+    for chunk in chunks:
+        yield call_records(pileup_parser.as_batch(chunk, 'collapse_pileup_to_mut'), threshold, pcr_duplicate_track)
 
 def main():
     args = argparser()
     #insert code
 
-    pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
-    with open(args.errors) as ef:
-        for entry in ef:
-            spent = entry.strip().split()
-            chrom = spent[0]
-            loc = spent[1]
-            ref = spent[2].upper()
-            if len(spent) > 4 and ref != "N": #ignore empty lines from end of files etc
-                spent = entry.strip().split()
-                alts = [b for b in spent[4] if b in 'ACGTN.']
-                quals = spent[5]
-                assert len(alts) == len(quals)
-                nalts = ''
-                nquals = ''
-                for i, base in enumerate(alts):
-                    if int(quals[i]) >= args.threshold and base != 'N': #strip out Ns and low quality alleles
-                        nalts += base
-                        nquals += quals[i]
-                #apply filters for calling mutations here.
-                #first, the depth must be at least five in order to differentiate between germline and somatic mutations.
-                #depth being the non-N content of the alternative allele string.
-                #second, any mutations which exist at higher than a 25% frequency in the string are probably germline and should be ignored for somatic mutation analysis.
-                if len(nalts) > 5:
-                    # [nalts.count(base) < len(nalts)/4 for base in 'ACGT']):
-                    #now, apply the pcr duplicate permutation filter structure using functions above.
-                    skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-                    dindeces = get_dindex(nalts)
-                    for base in 'ACGT':
-                        basecount = nalts.count(base)
-                        if 2 <= basecount <= len(nalts)/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                            key = (len(nalts), basecount)
-                            if key not in pcr_duplicate_track:
-                                pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                            thresh = pcr_duplicate_track[key]
-                            if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                                #print("QC: Base is skipped for clustering")
-                                skip += base
-                                print('\t'.join([chrom, loc, ref, base]))
-                        else:
-                            #print("QC: Base is singleton or too high frequency in pileup")
-                            skip += base
-                    #now actually go through and count the scattered mutations.
-                    for base in nalts:
-                        if base != '.' and base not in skip:
-                            #print it out, but only record it once because of the weaknesses of DnDscv
-                            skip += base
-                            print('\t'.join([chrom, loc, ref, base]))
-                
-                # else:
-                    # print("QC: Read is skipped for having no alts")
-                    # continue
-                # ref = spent[2].upper() #don't particularly care whether its forward or reverse
-                # cir = ''.join(c for c in spent[4].upper() if c in 'ACGTN.') #remove characters indicating read start or end or mapping scores or whatever.
-                # # assert len(cir) == int(spent[3])
-                # alts = [c for c in cir if c != "N"] #alts is not for iteration later
-                # realdepth = len(alts)
-                # if ref != 'N':
-                #     if realdepth > 5 and all([cir.count(base) < len(cir)/4 for base in 'ACGT']):
-                        
-                #     #counts[ref] += depth
-                #     if int(spent[3]) == len(spent[5]):
-                #         counts[ref] += len([v for v in cir if v != 'N']) #don't want to count bases the read has no information about as either reference or nonreference
-                #     #if depth == len(spent[5]): #ignore entries with indels or other complications for this iteration of the pipeline
-                #         for i, base in enumerate(cir): #may be length 1.
-                #             if base in "ACGT" and base != ref and spent[5][i] in '0123456789':
-                #                 if int(spent[5][i]) >= args.threshold:
-                #                     sumerrors[(ref,base)] += 1 
+    pcr_duplicate_track = pcr_thresholds.from_args(args) #using dynamic programming to save compute cycles for this qc measure
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pcr_duplicate_track)
+    report = pcr_thresholds.CapReport(args, key_fields = 4) if args.cap_report else None
+    tracks = density_tracks.WindowTracks(args.tracks, args.windows) if args.tracks != None else None
+    #the callable depth needs the reference only sites too, which are skipped otherwise.
+    require = b'ACGT' if tracks == None else None
+    for batch in prof.timed(pileup_parser.read_batches(args.errors, pileup_parser.get_regions(args.region, args.regions_bed), require = require), 'parse'):
+        batch = pileup_parser.single_sample(batch, 'collapse_pileup_to_mut')
+        records = call_records(batch, args.threshold, pcr_duplicate_track, tracks)
+        if report != None:
+            #the records are matched per base, and the exact ones are not counted into the tracks.
+            report.compare(call_records(batch, args.threshold, report.exact_track), records)
+        start = prof.start()
+        for record in records:
+            print('\t'.join(record))
+        prof.lap('write', start)
+    if tracks != None:
+        tracks.close()
+    pcr_duplicate_track.save()
+    if report != None:
+        report.report(pcr_duplicate_track)
+    if args.profile != None:
+        prof.report(args.profile, 'collapse_pileup_to_mut')
 
 if __name__ == "__main__":
     main()
@@ -1,71 +1,182 @@
 #!/usr/bin/env python3
 
+#this script compares the depth of two pileups of the same reference, position by position.
+#both pileups are read at once in a single streaming merge-join, so they must be sorted by position with their contigs in the same order, as samtools writes them.
+#they can be plain, gzip or BGZF compressed. Memory use does not grow with the size of the pileups.
+#by default the contigs are renamed and selected as this script always has (DEFAULT_CONTIGS): the Drosophila chromosome arms and Wolbachia are reported as 2L, 2R, 3L, 3R, X and W,
+#and unplaced scaffolds and other contigs are skipped. The depth sums cover the same contigs. Rows come in the order the pileups list the contigs,
+#so the whole-file version's W, 2L, 2R, 3L, 3R, X for pileups sorted that way.
+#a contig map (-m) replaces the default. It has one contig per line in the order the pileups list them,
+#as the pileup name, optionally followed by a tab and the name to report it under; contigs missing from the map are skipped. For example
+#CP001391.1	W
+#NT_479533.1	2L
+#with --all-contigs every contig is compared under its own name.
+#without a map the contig order is taken from a first pass over the contig column of both pileups, so a contig found in only one of them still gets the same rank in both,
+#or from the reference index (-r) if given.
+
 #import
 import argparse
-import numpy as np
+import sys
+import bgzf
 
 #define functions/classes
 
+#pileup contig: reported name, the contigs compared without -m or --all-contigs.
+DEFAULT_CONTIGS = {'CP001391.1': 'W', #wolbachia.
+    'NT_479533.1': '2L',
+    'NT_479534.1': '2R',
+    'NT_479535.1': '3L',
+    'NT_479536.1': '3R',
+    'NC_029795.1': 'X'}
+
 def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
-    parser.add_argument('-a', '--first')
-    parser.add_argument('-b', '--second')
-    parser.add_argument('-o', '--output')
+    parser.add_argument('-a', '--first', help = 'First pileup. Can be gzip or BGZF compressed')
+    parser.add_argument('-b', '--second', help = 'Second pileup. Can be gzip or BGZF compressed')
+    parser.add_argument('-o', '--output', help = 'Name of the output file of contig, position, first depth, second depth and their difference. Default is stdout', default = None)
+    parser.add_argument('-m', '--contig-map', dest = 'contig_map', help = 'File of the contigs to compare in pileup order, each optionally followed by a tab and a new name. Default is the Drosophila arms and Wolbachia of DEFAULT_CONTIGS, as 2L, 2R, 3L, 3R, X and W', default = None)
+    parser.add_argument('--all-contigs', dest = 'all_contigs', action = 'store_true', help = 'Compare every contig under its own name instead of the default contigs')
+    parser.add_argument('-r', '--reference-index', dest = 'reference_index', help = 'Reference .fai (or any file whose first column lists the contigs in reference order) giving the contig order of the pileups. Default is the order of a first pass over both pileups, or of the contig map (-m)', default = None)
     args = parser.parse_args()
     return args
 
-def read_pileup(path):
-    chroms = {k:[] for k in ['W','2L','2R','3L','3R','X']}
+def read_contig_map(path):
+    #dictionary of pileup contig name to reported name, and the list of reported names in pileup order.
+    names = {}
+    order = []
     with open(path) as inf:
         for entry in inf:
-            spent = entry.strip().split()
-            if spent[0] == 'CP001391.1':
-                chro = "W" #wolbachia.
-            elif spent[0] == 'NT_479533.1':
-                chro = '2L'
-            elif spent[0] == 'NT_479535.1':
-                chro = '3L'
-            elif spent[0] == 'NT_479534.1':
-                chro = '2R'
-            elif spent[0] == 'NT_479536.1':
-                chro = '3R'
-            elif spent[0] == 'NC_029795.1':
-                chro = 'X'
-            else:
-                continue #skip node and small scaffold 
-            chroms[chro].append((int(spent[1]),int(spent[3])))
-    return chroms
-
-def combine_pileup(b1, b2):
-    bdeps = {}
-    for chro, locs in b1.items():
-        if chro not in bdeps:
-            bdeps[chro] = {}
-
-        for loc, dep in locs:
-            bdeps[chro][loc] = [dep, 0]
-
-    for chro, locs in b2.items():
-        for loc, dep in locs:
-            if loc in bdeps[chro]:
-                bdeps[chro][loc][1] = dep
-            else:
-                bdeps[chro][loc] = [0, dep]
-    return bdeps
+            spent = entry.strip().split('\t')
+            if spent[0] == '':
+                continue
+            names[spent[0]] = spent[-1]
+            if spent[-1] not in order:
+                order.append(spent[-1])
+    return names, order
+
+def read_pileup(path, names = None):
+    #yield (contig, position, depth) for each line of a pileup, renaming contigs by names and skipping the ones it lacks.
+    with bgzf.open_input(path) as inf:
+        for entry in inf:
+            spent = entry.split('\t', 4)
+            chro = spent[0]
+            if names != None:
+                if chro not in names:
+                    continue #skip node and small scaffold
+                chro = names[chro]
+            yield chro, int(spent[1]), int(spent[3])
+
+def read_reference_index(path):
+    #the contig names of a .fai or similar file, in reference order.
+    with open(path) as inf:
+        return [entry.split('\t')[0].strip() for entry in inf if entry.strip() != '']
+
+def pileup_contigs(path):
+    #the contigs of a pileup in the order it lists them.
+    order = []
+    with bgzf.open_input(path) as inf:
+        for entry in inf:
+            chro = entry[:entry.index('\t')]
+            if len(order) == 0 or order[-1] != chro:
+                order.append(chro)
+    return order
+
+def merge_contig_orders(first, second):
+    #one contig order that keeps the order of both lists, with the contigs found in only one of them placed where that list has them.
+    in1, in2 = set(first), set(second)
+    order = []
+    i = j = 0
+    while i < len(first) or j < len(second):
+        if i < len(first) and j < len(second) and first[i] == second[j]:
+            order.append(first[i])
+            i += 1
+            j += 1
+        elif i < len(first) and first[i] not in in2:
+            order.append(first[i])
+            i += 1
+        elif j < len(second) and second[j] not in in1:
+            order.append(second[j])
+            j += 1
+        else:
+            raise ValueError('pileups list their contigs in different orders at ' + first[i] + ' and ' + second[j] + ', but they need the same order to be merged')
+    return order
+
+class ContigOrder(dict):
+    '''
+    Rank of each contig in the order the pileups share, fixed before the merge so both pileups are ranked alike
+    whichever of them a contig is found in. A contig outside the order stops the run.
+    '''
+    def __init__(self, order):
+        super().__init__()
+        for chro in order:
+            self.setdefault(chro, len(self))
+
+    def __missing__(self, chro):
+        raise ValueError('contig ' + chro + ' is not in the contig order; list it with --contig-map or --reference-index')
+
+def contig_order(args, names):
+    #the reported contig names in the order of the pileups, or of the reference index.
+    if args.reference_index != None:
+        contigs = read_reference_index(args.reference_index)
+    else:
+        #only the contigs that are compared, so skipped scaffolds listed in different orders do not matter.
+        contigs = [[chro for chro in pileup_contigs(path) if names == None or chro in names] for path in (args.first, args.second)]
+        contigs = merge_contig_orders(*contigs)
+    if names == None:
+        return contigs
+    return [names[chro] for chro in contigs if chro in names]
+
+def combine_pileup(b1, b2, order):
+    #merge-join two (contig, position, depth) streams sorted in the same contig order; yields (contig, position, first depth, second depth),
+    #with a depth of 0 where a position is only in one of the pileups.
+    end = (float('inf'), 0)
+    n1 = next(b1, None)
+    n2 = next(b2, None)
+    last = (-1, 0)
+    while n1 != None or n2 != None:
+        k1 = end if n1 == None else (order[n1[0]], n1[1])
+        k2 = end if n2 == None else (order[n2[0]], n2[1])
+        key = min(k1, k2)
+        assert key > last, 'pileups are not sorted in the same contig order at ' + (n1 if k1 == key else n2)[0] + ' ' + str(key[1]) + '; give the contig order with --reference-index or --contig-map'
+        last = key
+        if k1 == k2:
+            yield n1[0], n1[1], n1[2], n2[2]
+            n1 = next(b1, None)
+            n2 = next(b2, None)
+        elif k1 < k2:
+            yield n1[0], n1[1], n1[2], 0
+            n1 = next(b1, None)
+        else:
+            yield n2[0], n2[1], 0, n2[2]
+            n2 = next(b2, None)
 
 def main():
     args = argparser()
     #insert code
-    b1 = read_pileup(args.first)
-    b2 = read_pileup(args.second)
-    print("Sum of depth in pileup b1:", sum([sum([v[1] for v in k]) for k in b1.values()]))
-    print("Sum of depth in pileup b2:", sum([sum([v[1] for v in k]) for k in b2.values()]))
-    bdeps = combine_pileup(b1,b2)
-    with open(args.output, 'w+') as outf:
-        for chro, locd in bdeps.items():
-            for l, pd in sorted(list(locd.items())):
-                print('\t'.join([str(v) for v in [chro, l, pd[0], pd[1], pd[1]-pd[0]]]), file = outf)
+    assert args.contig_map == None or not args.all_contigs, 'give either a contig map (-m) or --all-contigs'
+    if args.contig_map != None:
+        names, order = read_contig_map(args.contig_map)
+    else:
+        names, order = (None if args.all_contigs else DEFAULT_CONTIGS), None
+    if args.reference_index != None or order == None:
+        order = contig_order(args, names)
+    sum1 = 0
+    sum2 = 0
+    outf = sys.stdout if args.output == None else open(args.output, 'w+')
+    lines = []
+    for chro, l, d1, d2 in combine_pileup(read_pileup(args.first, names), read_pileup(args.second, names), ContigOrder(order)):
+        sum1 += d1
+        sum2 += d2
+        lines.append(chro + '\t' + str(l) + '\t' + str(d1) + '\t' + str(d2) + '\t' + str(d2 - d1) + '\n')
+        if len(lines) >= 100000:
+            outf.write(''.join(lines))
+            lines = []
+    outf.write(''.join(lines))
+    if args.output != None:
+        outf.close()
+    print("Sum of depth in pileup b1:", sum1, file = sys.stderr if args.output == None else sys.stdout)
+    print("Sum of depth in pileup b2:", sum2, file = sys.stderr if args.output == None else sys.stdout)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import pileup_parser
 
 #set id conversion dictionary.
 # convert = {
@@ -40,8 +41,24 @@ convert = {
     'NC_0000024.10':'chrY',
 } #human chromosomes.
 
-for entry in sys.stdin:
-    spent = entry.strip().split()
+def convert_record(spent, convert = convert):
+    #the split line with its contig renamed, or None for contigs missing from the conversion dictionary.
     nname = convert.get(spent[0], None)
     if nname != None:
-        print('\t'.join([nname] + spent[1:]))
\ No newline at end of file
+        return [nname] + spent[1:]
+    return None
+
+def convert_ids(chunks, convert = convert):
+    #pipeline stage (see pileup_pipeline.py): the records of convert_record for each chunk of records.
+    for chunk in chunks:
+        records = [convert_record(spent, convert) for spent in pileup_parser.as_records(chunk)]
+        yield [r for r in records if r != None]
+
+def main():
+    for entry in sys.stdin:
+        nent = convert_record(entry.strip().split())
+        if nent != None:
+            print('\t'.join(nent))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+#windowed mutation density tracks built while a script streams the pileup (collapse_pileup_to_mut.py --tracks), in place of writing the mutation file and binning it again with bin_mutations.py.
+#for every window size three bedgraph tracks are written: prefix.<size>.mutations.bedgraph, the number of mutation records in each window,
+#prefix.<size>.callable.bedgraph, the number of callable sites (those that passed the script's depth filter), and prefix.<size>.depth.bedgraph, the summed quality depth of those sites.
+#windows are 0 based and half open, [k*size, (k+1)*size), as bedgraph expects. The three tracks list the same windows, every window with a callable site or a mutation,
+#so a mutation count of zero means none were found in callable sequence rather than that nothing was covered.
+#the pileup has to list each contig's sites together, sorted by position, as samtools writes it. A contig's windows are written out when the next contig starts,
+#so memory holds the windows of one contig per size however long the pileup is.
+
+#import
+import numpy as np
+import output_writer
+
+#define functions/classes
+
+TRACKS = ('mutations', 'callable', 'depth')
+
+def track_path(prefix, size, track):
+    return prefix + '.' + str(size) + '.' + track + '.bedgraph'
+
+class WindowTracks:
+    '''
+    Per window counts of mutations, callable sites and callable depth at several window sizes, accumulated a batch of sites at a time.
+    close() writes out the last contig and closes the tracks.
+    '''
+    def __init__(self, prefix, sizes):
+        assert len(sizes) > 0 and min(sizes) > 0, 'window sizes must be positive'
+        self.sizes = sorted(set(sizes))
+        self.writers = {(size, track): output_writer.OutputWriter(track_path(prefix, size, track)) for size in self.sizes for track in TRACKS}
+        self.contig = None
+        self.finished = set() #contigs already written out, to catch a pileup that is not grouped by contig.
+        self.counts = {}
+
+    def add(self, contig, positions, depths, mutations):
+        #count the callable sites of one contig at 1 based positions with their depths, and the 1 based positions of its mutation records.
+        if contig != self.contig:
+            self.flush()
+            assert contig not in self.finished, 'the sites of ' + contig + ' are not together in the pileup; the tracks need a pileup sorted by contig'
+            self.contig = contig
+            self.counts = {size: np.zeros((len(TRACKS), 0), dtype = np.int64) for size in self.sizes}
+        if len(positions) == 0 and len(mutations) == 0:
+            return
+        for size in self.sizes:
+            windows = [(np.asarray(values, dtype = np.int64) - 1) // size for values in (mutations, positions, positions)]
+            first = min([w.min() for w in windows if len(w) > 0])
+            last = max([w.max() for w in windows if len(w) > 0])
+            counts = self.counts[size]
+            if last >= counts.shape[1]:
+                #grow by doubling, so a contig costs a handful of copies rather than one per batch.
+                grown = np.zeros((len(TRACKS), max(last + 1, 2 * counts.shape[1])), dtype = np.int64)
+                grown[:,:counts.shape[1]] = counts
+                self.counts[size] = counts = grown
+            #only the span of windows this batch touches is binned.
+            for row, (w, weights) in enumerate(zip(windows, (None, None, depths))):
+                binned = np.bincount(w - first, weights = weights, minlength = last - first + 1)
+                counts[row, first:last+1] += binned.astype(np.int64)
+
+    def add_batch(self, batch, called, depths, mutated):
+        #count a pileup_parser batch: called is the site mask of callable sites, depths the depth of every site and mutated the site index of every mutation record.
+        positions = batch.positions()
+        mutated = np.asarray(mutated, dtype = np.int64)
+        for contig, start, end in batch.contig_runs():
+            sites = start + np.flatnonzero(called[start:end])
+            self.add(contig, positions[sites], depths[sites], positions[mutated[(mutated >= start) & (mutated < end)]])
+
+    def flush(self):
+        #write out the windows of the current contig.
+        if self.contig == None:
+            return
+        for size in self.sizes:
+            counts = self.counts[size]
+            windows = np.flatnonzero((counts[0] > 0) | (counts[1] > 0))
+            starts = (windows * size).tolist()
+            for row, track in enumerate(TRACKS):
+                values = counts[row, windows].tolist()
+                self.writers[(size, track)].write_lines([self.contig + '\t' + str(s) + '\t' + str(s + size) + '\t' + str(v) for s, v in zip(starts, values)])
+        self.finished.add(self.contig)
+        self.contig = None
+        self.counts = {}
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
@@ -2,11 +2,11 @@
 
 import sys
 import statistics as st
+import pileup_parser
 
-for entry in sys.stdin:
-    spent = entry.strip().split()
-    alts = [b for b in spent[4] if b in 'ACGTN.']#.replace("N",'')
-    quals = spent[5]#.replace("0",'')
+def detect_site(spent):
+    #the cleaned record of a split pileup line whose alternative alleles look like pcr errors with enough circle depth to be counted as real, or None.
+    alts, quals = pileup_parser.clean_site(spent[4], spent[5]) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     assert len(alts) == len(quals)
     nalts = ''
     nquals = ''
@@ -31,5 +31,20 @@ for entry in sys.stdin:
             filtered.pop(k)
     if len(filtered) > 1:
         if any([st.median(dv) < len(dv)/10 for dv in filtered.values()]):
-            nent = '\t'.join([spent[0],spent[1],spent[2],spent[3], nalts, nquals])
-            print(nent)
\ No newline at end of file
+            return [spent[0],spent[1],spent[2],spent[3], nalts, nquals]
+    return None
+
+def detect_pcr_dups(chunks):
+    #pipeline stage (see pileup_pipeline.py): the records of detect_site for each chunk of sites.
+    for chunk in chunks:
+        records = [detect_site(spent) for spent in pileup_parser.as_records(chunk, 'detect_pcr_dups')]
+        yield [r for r in records if r != None]
+
+def main():
+    for entry in sys.stdin:
+        nent = detect_site(entry.strip().split())
+        if nent != None:
+            print('\t'.join(nent))
+
+if __name__ == "__main__":
+    main()
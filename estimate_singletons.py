@@ -10,6 +10,8 @@ import argparse
 import itertools
 from scipy.stats import binom
 from Bio import SeqIO as sqio
+import bgzf
+import pileup_parser
 
 #define functions/classes
 
@@ -47,14 +49,15 @@ def collect_values(args):
     #get the genome file for context collection.
     genome = sqio.to_dict(sqio.parse(args.reference, format = 'fasta'))
     #iterate through the pileup.
-    with open(pileup) as inf:
+    with bgzf.open_input(pileup) as inf:
         for entry in inf:
             chro, loc, ref, depth, alts, quals = entry.strip().split()
             depth = int(depth)
             if depth == 0:
                 continue
-            alts = [a for a in alts if a in "ACGTN."]
-            assert len(alts) == depth
+            reads = pileup_parser.tokenize_site(alts, quals)[0] #one token per read, read marks and indel sequences removed and the strands folded together.
+            assert len(reads) == depth
+            alts = [a for a in reads if a in "ACGTN."]
             #get the prior and latter bases.
             prior, latter = get_context(genome, chro, loc)
             if any([b == 'N' for b in [prior, latter, ref]]) or prior == None or latter == None:
@@ -5,6 +5,7 @@
 import argparse
 import sys
 import numpy as np
+import bgzf
 
 def argparser():
     parser = argparse.ArgumentParser()
@@ -60,7 +61,7 @@ def iterator(paths, somatic = 'somatic.vcf', germline = 'germline.vcf', mode = '
 def parse_text(infile):
     header = None
     body = {}
-    with open(infile) as inf:
+    with bgzf.open_input(infile) as inf:
         for entry in inf:
             spent = entry.strip().split()
             body[(spent[0],spent[1],spent[3])] = entry.strip()
@@ -69,7 +70,7 @@ def parse_text(infile):
 def parse_vcf(infile):
     header = []
     body = {}
-    with open(infile) as inf:
+    with bgzf.open_input(infile) as inf:
         for entry in inf:
             if entry[0] == '#':
                 header.append(entry.strip())
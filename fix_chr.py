@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 
 import sys
+import pileup_parser
+
 change = {'0':"2L", '1':"2R", '2':"3L", '3':"3R", '4':'4', '5':"M", '6':'X'}
-for entry in sys.stdin:
-    if entry[0:2] == "##":
-        spent = entry.strip().split(',')
-        if spent[0][-1] in change:
-            spent[0] = spent[0][:-1] + change[spent[0][-1]]
-        print(','.join(spent))
-    else:   
-        spent = entry.strip().split()
-        if spent[0] in change:
-            spent[0] = change[spent[0]]
-        print('\t'.join(spent))
\ No newline at end of file
+
+def fix_record(spent, change = change):
+    #the split line with its contig renamed by change, when it is one of the numbered contigs.
+    if spent[0] in change:
+        spent = [change[spent[0]]] + spent[1:]
+    return spent
+
+def fix_chr(chunks, change = change):
+    #pipeline stage (see pileup_pipeline.py): the records of fix_record for each chunk of records.
+    for chunk in chunks:
+        yield [fix_record(spent, change) for spent in pileup_parser.as_records(chunk)]
+
+def main():
+    for entry in sys.stdin:
+        if entry[0:2] == "##":
+            spent = entry.strip().split(',')
+            if spent[0][-1] in change:
+                spent[0] = spent[0][:-1] + change[spent[0][-1]]
+            print(','.join(spent))
+        else:
+            print('\t'.join(fix_record(entry.strip().split())))
+
+if __name__ == "__main__":
+    main()
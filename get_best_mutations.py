@@ -1,54 +1,32 @@
 #!/usr/bin/env python3
 
+import argparse
 import sys
-import statistics as st
 import numpy as np
+import pileup_parser
+import pcr_thresholds
 
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
+def argparser():
+    parser = argparse.ArgumentParser()
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('--cap-report', dest = 'cap_report', action = 'store_true', help = 'Also rebuild every site with exact thresholds and report to stderr how many sites the --depth-cap loses, gains or changes, and how many thresholds each mode computed')
+    args = parser.parse_args()
+    return args
 
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
-
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
-
-def make_pileup_line(spent, mind = 10, pcr_duplicate_track = {}):
+def make_pileup_line(spent, mind = 10, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
     #convert a stripped and split mpileup line into a fake vcf line, filling in default values.
     #pileup: chrom loc ref depth vector_of_alts vector_of_quals
     #vcf: chrom loc ID(.) ref alt qual filter info(dp=...)
     #minimalist entry looking at the docs is just "DP" in info, qual is ., id is ., filter is PASS. So try those.
     chrom, loc, ref, ndepth, vector_of_alts, vector_of_quals = spent
+    vector_of_alts, vector_of_quals = pileup_parser.clean_site(vector_of_alts, vector_of_quals) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     #real depth isn't depth, its the length of the vector of alts without other symbols or Ns, because most Ns are introduced by the consensus builder and not in the original reads.
     # pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
     depth = len([v for v in vector_of_alts if v in 'ACGT.'])
     if depth >= mind:
         quality_alts = []
         quality_quals = []
-        cleaner = [b for b in vector_of_alts if b in 'ACGTN.']
+        cleaner = vector_of_alts
         assert len(cleaner) == len(vector_of_quals)
         for i,b in enumerate(cleaner):
             if b in 'ACGT.':
@@ -56,59 +34,103 @@ def make_pileup_line(spent, mind = 10, pcr_duplicate_track = {}):
                 if int(vector_of_quals[i]) > 1:
                     quality_alts.append(b)
                     quality_quals.append(vector_of_quals[i])
-        depth = len(quality_alts) #update depth
-        # for b in 'ACGT': #for all possible bases
-            # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
-                # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
-        #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
-        skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-        dindeces = get_dindex(quality_alts)
-        pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
-        for base in 'ACGT':
-            basecount = quality_alts.count(base)
-            if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                key = (len(quality_alts), basecount)
-                if key not in pcr_duplicate_track:
-                    pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                thresh = pcr_duplicate_track[key]
-                if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                    #print("QC: Base is skipped for clustering")
-                    skip += base
-                    #still count it once though
-                    pcrc.append(base)
-                #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
-            else:
+        return rebuild_line(chrom, loc, ref, quality_alts, quality_quals, pcr_duplicate_track)
+    else:
+        return None, pcr_duplicate_track
+
+def rebuild_line(chrom, loc, ref, quality_alts, quality_quals, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), dindeces = None):
+    #rebuild a cleaned pileup line from the quality filtered bases (reference dots included) of a site that passed the depth filter.
+    #split out of make_pileup_line so the batched reader below can hand over sites it has already cleaned in numpy.
+    record, pcr_duplicate_track = rebuild_record(chrom, loc, ref, quality_alts, quality_quals, pcr_duplicate_track, dindeces)
+    if record == None:
+        return None, pcr_duplicate_track
+    return '\t'.join(record), pcr_duplicate_track
+
+def rebuild_record(chrom, loc, ref, quality_alts, quality_quals, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), dindeces = None):
+    #rebuild_line, returning the split columns of the cleaned line instead.
+    depth = len(quality_alts) #update depth
+    # for b in 'ACGT': #for all possible bases
+        # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
+            # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
+    #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
+    skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+    dindeces = pcr_thresholds.get_dindex(quality_alts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+    pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
+    for base in 'ACGT':
+        basecount = quality_alts.count(base)
+        if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+            key = (len(quality_alts), basecount)
+            thresh = pcr_duplicate_track[key]
+            if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                #print("QC: Base is skipped for clustering")
                 skip += base
-        #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
-        #rebuild a cleaned pileup line 
-        capped = []
-        final_alts = []
-        final_quals = []
-        for i, b in enumerate(quality_alts):
-            q = quality_quals[i]
-            if b not in skip:
-                if b in pcrc and b not in capped:
-                    capped.append(b) #count one of them but not again
-                    final_alts.append(b)
-                    final_quals.append(str(q))
-                elif b not in pcrc: #not in a cluster, record.
-                    final_alts.append(b)
-                    final_quals.append(str(q))
-            else:
-                final_alts.append('.') #ignore these
-                final_quals.append(q)
-        #the assumption is also that germline variants have been cleaned out by pilon.
-        if depth == 0 or len(final_alts) == 0 or len(final_alts) == final_alts.count("."): #nothing but Ns or reference here.
-            return None, pcr_duplicate_track
+                #still count it once though
+                pcrc.append(base)
+            #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
         else:
-            pileup = '\t'.join([chrom, str(loc), ref, str(depth), ''.join(final_alts), ''.join(final_quals)])
-            return pileup, pcr_duplicate_track
-    else:
+            skip += base
+    #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
+    #rebuild a cleaned pileup line 
+    capped = []
+    final_alts = []
+    final_quals = []
+    for i, b in enumerate(quality_alts):
+        q = quality_quals[i]
+        if b not in skip:
+            if b in pcrc and b not in capped:
+                capped.append(b) #count one of them but not again
+                final_alts.append(b)
+                final_quals.append(str(q))
+            elif b not in pcrc: #not in a cluster, record.
+                final_alts.append(b)
+                final_quals.append(str(q))
+        else:
+            final_alts.append('.') #ignore these
+            final_quals.append(q)
+    #the assumption is also that germline variants have been cleaned out by pilon.
+    if depth == 0 or len(final_alts) == 0 or len(final_alts) == final_alts.count("."): #nothing but Ns or reference here.
         return None, pcr_duplicate_track
+    else:
+        return [chrom, str(loc), ref, str(depth), ''.join(final_alts), ''.join(final_quals)], pcr_duplicate_track
+
+def best_batch(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), mind = 100):
+    #the cleaned records of the sites of a pileup_parser batch that keep a pcr cluster or scattered mutation.
+    #apply the depth and quality filters of make_pileup_line to the whole batch at once.
+    #only sites where some base could be kept as a cluster or scattered mutation (2 <= count <= depth/4) can produce a line.
+    basedepth = batch.count(batch.is_base(b'ACGT.'))
+    quality = batch.is_base(b'ACGT.') & (batch.quals > 1)
+    counts = batch.base_counts(quality)
+    keepable = (counts >= 2) & (counts <= batch.count(quality)[:,None]/4)
+    sites = np.flatnonzero((basedepth >= mind) & np.any(keepable, axis = 1))
+    quality_alts = batch.strings(quality, sites)
+    quality_quals = batch.strings(quality, sites, quals = True)
+    dindeces = pcr_thresholds.site_dindeces(*batch.masked(quality), sites)
+    records = []
+    for j, i in enumerate(sites):
+        record, pcr_duplicate_track = rebuild_record(batch.chrom(i), batch.loc(i), batch.ref(i), quality_alts[j], quality_quals[j], pcr_duplicate_track = pcr_duplicate_track, dindeces = dindeces[j])
+        if record != None:
+            records.append(record)
+    return records
+
+def best_mutations(chunks, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), mind = 100):
+    #pipeline stage (see pileup_pipeline.py): the records of best_batch for each chunk of sites.
+    for chunk in chunks:
+        yield best_batch(pileup_parser.as_batch(chunk, 'get_best_mutations'), pcr_duplicate_track, mind)
+
+def main():
+    args = argparser()
+    pdt = pcr_thresholds.from_args(args)
+    report = pcr_thresholds.CapReport(args) if args.cap_report else None
+    for batch in pileup_parser.iter_batches(pileup_parser.open_pileup(), require = b'ACGT'):
+        batch = pileup_parser.as_batch(batch, 'get_best_mutations')
+        records = best_batch(batch, pdt)
+        if report != None:
+            report.compare(best_batch(batch, report.exact_track), records)
+        for record in records:
+            print('\t'.join(record))
+    pdt.save()
+    if report != None:
+        report.report(pdt)
 
-pdt = {}
-for entry in sys.stdin:
-    spent = entry.strip().split()
-    line, pdt = make_pileup_line(spent, mind = 100, pcr_duplicate_track = pdt)
-    if line != None:
-        print(line)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#shared output layer for the scripts that write pileup derived records (the vcf scripts in particular).
+#lines are collected and written in large blocks instead of one print per record.
+#outputs named .gz or .bgz (or any output when bgzip is set) are written as BGZF with bgzf.BgzfWriter, optionally compressing on a thread pool,
+#and VCFs written that way get a tabix index so bcftools, tabix, SnpEff and the like can seek into them.
+
+#import
+import os
+import sys
+import bgzf
+
+#define functions/classes
+
+BLOCKSIZE = 1 << 20 #characters buffered before a write.
+
+def wants_bgzip(path, bgzip = False):
+    return bgzip or (path != None and path.endswith(('.gz', '.bgz')))
+
+class OutputWriter:
+    '''
+    Buffered line writer for a path (or stdout when None). Lines are given without their newline.
+    Compressed output needs a path; with index set, a tabix index of the finished VCF is written on close.
+    With resume set to a byte size (see checkpoint.py), an existing uncompressed output is cut back to that size and written on from there.
+    '''
+    def __init__(self, path = None, bgzip = False, threads = 1, index = False, level = 6, blocksize = BLOCKSIZE, resume = None):
+        self.path = path
+        self.compressed = wants_bgzip(path, bgzip)
+        assert path != None or not self.compressed, 'bgzip output needs an output path'
+        self.index = index and self.compressed
+        if self.compressed:
+            self.handle = bgzf.BgzfWriter(path, level, threads)
+        elif path == None:
+            self.handle = sys.stdout
+        elif resume != None:
+            assert os.path.getsize(path) >= resume, path + ' is shorter than its checkpoint'
+            self.handle = open(path, 'r+')
+            self.handle.truncate(resume)
+            self.handle.seek(resume)
+        else:
+            self.handle = open(path, 'w+')
+        self.blocksize = blocksize
+        self.lines = []
+        self.size = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.blocksize:
+            self.flush()
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if not self.lines:
+            return
+        text = '\n'.join(self.lines) + '\n'
+        self.handle.write(text.encode() if self.compressed else text)
+        self.lines = []
+        self.size = 0
+
+    def sync(self):
+        #write out everything buffered so far, down to the disk, and return the byte size of the output; only for uncompressed output files.
+        self.flush()
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        return self.handle.tell()
+
+    def close(self):
+        self.flush()
+        if self.path == None:
+            self.handle.flush()
+            return
+        self.handle.close()
+        if self.index:
+            bgzf.write_tabix(self.path)
+
+def sample_path(prefix, name, suffix, bgzip = False):
+    #path of one sample's output for the --per-sample options: the prefix, the sample name and the suffix, plus .gz for BGZF output.
+    return prefix + name + suffix + ('.gz' if bgzip and not suffix.endswith(('.gz', '.bgz')) else '')
+
+def copy_header(path, writer, samples = None, meta = ()):
+    #write the lines of a header text file, stripped as the scripts have always done.
+    #for a multi-sample vcf, the meta lines go in ahead of the #CHROM line, which gets a FORMAT column and a column per sample.
+    with open(path) as tin:
+        lines = [entry.strip() for entry in tin]
+    if samples == None:
+        writer.write_lines(lines)
+        return
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + list(samples)
+    writer.write_lines([l for l in lines if not l.startswith('#CHROM')] + list(meta) + ['\t'.join(columns)])
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+#shared PCR duplicate cluster thresholds for the pileup scripts.
+#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
+#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
+#in this case, we only want to count the single A error rather than counting it 5 times.
+#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
+#the thresholds only depend on (length, count) and the threshold settings, so they are kept in a versioned cache file that every run can load and extend.
+#thresholds can also be computed exactly instead of by permutation (exact_index).
+#for ultra-deep sites a depth cap bounds the keys: deeper sites get a threshold at the cap, scaled to their length and base count (see ThresholdCache).
+#run this script directly to fill a cache with every key up to a given depth.
+
+#import
+import argparse
+import os
+import sys
+import time
+from multiprocessing import RawArray
+import numpy as np
+import statistics as st
+from math import comb
+from fractions import Fraction
+
+#define functions/classes
+
+CACHE_VERSION = 3 #2: thresholds drawn by the batched random_positions sampler. 3: backend column.
+BACKENDS = ['permutation', 'exact']
+
+def get_dindex(altstring):
+    distances = {}
+    for i,base in enumerate(altstring):
+        if base != '.':
+            if base not in distances:
+                last = i
+                distances[base] = []
+            else:
+                distances[base].append(i-last)
+                last = i
+    dindex = {}
+    for k,v in distances.items():
+        if len(v)> 0:
+            dindex[k] = st.median(v)
+    return dindex
+
+_ACGT_INDEX = np.full(256, 4, dtype = np.int64)
+for _i, _b in enumerate(b'ACGT'):
+    _ACGT_INDEX[_b] = _i
+
+def batch_dindex(bases, offsets):
+    #get_dindex for many sites at once. Site i is bases[offsets[i]:offsets[i+1]], a uint8 array of base characters.
+    #returns (medians, counts), nsites x 4 arrays for A, C, G and T: the median gap as get_dindex reports it (nan for a base seen less than twice)
+    #and how often the base appears. As in get_dindex, the gap recorded for each repeat of a base is measured back to the previous base of any kind
+    #other than '.', not to the previous copy of the same base.
+    nsites = len(offsets) - 1
+    bases = np.asarray(bases, dtype = np.uint8)
+    offsets = np.asarray(offsets, dtype = np.int64)
+    marked = np.flatnonzero(bases != ord('.'))
+    site = np.searchsorted(offsets, marked, side = 'right') - 1
+    back = np.zeros(len(marked), dtype = np.int64)
+    back[1:] = marked[1:] - marked[:-1]
+    codes = _ACGT_INDEX[bases[marked]]
+    acgt = codes < 4
+    group = site[acgt] * 4 + codes[acgt]
+    back = back[acgt]
+    counts = np.bincount(group, minlength = nsites * 4)
+    #stable sort keeps each group in read order; every member but the first of its group contributes its gap.
+    order = np.argsort(group, kind = 'stable')
+    group = group[order]
+    back = back[order]
+    repeat = np.zeros(len(group), dtype = bool)
+    repeat[1:] = group[1:] == group[:-1]
+    group = group[repeat]
+    gaps = back[repeat]
+    order = np.lexsort((gaps, group))
+    gaps = gaps[order]
+    ngaps = np.bincount(group, minlength = nsites * 4)
+    starts = np.zeros(nsites * 4, dtype = np.int64)
+    np.cumsum(ngaps[:-1], out = starts[1:])
+    medians = np.full(nsites * 4, np.nan)
+    has = ngaps > 0
+    medians[has] = (gaps[starts[has] + (ngaps[has] - 1) // 2] + gaps[starts[has] + ngaps[has] // 2]) / 2
+    return medians.reshape(nsites, 4), counts.reshape(nsites, 4)
+
+def site_dindeces(bases, offsets, sites, depths = None):
+    #get_dindex dictionaries for the given sites of a batch_dindex layout, for the per site functions of the pileup scripts.
+    #they only test bases seen from 2 to depth/4 times (depth being the length of the site's bases unless given), so sites without such a base
+    #get an empty dictionary, and bases without a gap map to nan.
+    medians, counts = batch_dindex(bases, offsets)
+    medians = medians[sites]
+    counts = counts[sites]
+    depths = np.diff(offsets)[sites] if depths is None else depths
+    tested = np.any((counts >= 2) & (counts <= depths[:,None] / 4), axis = 1)
+    return [dict(zip('ACGT', row)) if test else {} for row, test in zip(medians.tolist(), tested.tolist())]
+
+def make_random(length = 100, bases_to_use = 'A', num = 5, rng = None):
+    #rng is a numpy Generator; the global numpy random state is used when it is None.
+    string = list('.' * length)
+    for b in bases_to_use:
+        if rng == None:
+            locs = np.random.choice(length,num,replace = False)
+        else:
+            locs = rng.choice(length,num,replace = False)
+        for l in locs:
+            string[l] = b
+    return ''.join(string)
+
+def random_positions(length = 100, num = 5, pnum = 1000, rng = None):
+    #pnum rows of num distinct positions in range(length), each row sorted; the same placements as pnum calls of make_random, drawn at once.
+    random = np.random.random if rng == None else rng.random
+    integers = np.random.randint if rng == None else rng.integers
+    if num * num > length:
+        #dense placements: take the num smallest of length random keys per row, which is a uniform draw without replacement.
+        locs = np.argpartition(random((pnum, length)), num - 1, axis = 1)[:,:num]
+        locs.sort(axis = 1)
+        return locs
+    #sparse placements: draw with replacement and redraw the (few) rows that picked a position twice.
+    locs = np.sort(integers(0, length, (pnum, num)), axis = 1)
+    redo = np.flatnonzero(np.any(locs[:,1:] == locs[:,:-1], axis = 1))
+    while len(redo) > 0:
+        locs[redo] = np.sort(integers(0, length, (len(redo), num)), axis = 1)
+        redo = redo[np.any(locs[redo,1:] == locs[redo,:-1], axis = 1)]
+    return locs
+
+def perm_index(leng = 100, num = 3, pnum = 1000, dup_prob = .05, rng = None):
+    #the median gap between consecutive placements of each permuted row is what get_dindex measures on a make_random string.
+    gaps = np.diff(random_positions(length = leng, num = num, pnum = pnum, rng = rng), axis = 1)
+    return np.percentile(np.median(gaps, axis = 1),dup_prob * 100) #percentile.
+
+#exact null distribution of the median gap, as an alternative to permuting.
+#placing k = m + 1 alternatives uniformly in n positions gives m gaps of at least 1, plus the free space before the first and after the last alternative.
+#a given gap vector with total S fits in n - S ways, so placements can be counted with binomial coefficients over the gap lengths.
+def count_placements(n, m, short, t, w):
+    #number of placements where a fixed choice of `short` gaps are all in [1, t] and the other m - short gaps are all above w.
+    #inclusion-exclusion over the short gaps that exceed t.
+    base = n - 1 - short - (w + 1) * (m - short)
+    total = 0
+    for i in range(short + 1):
+        rest = base - t * i
+        if rest < 0:
+            break
+        total += (-1) ** i * comb(short, i) * comb(rest + m + 1, m + 1)
+    return total
+
+def count_short_gaps(n, m, t, need):
+    #number of placements with at least need of the m gaps no longer than t.
+    return sum(comb(m, j) * count_placements(n, m, j, t, t) for j in range(need, m + 1))
+
+def exact_index(leng = 100, num = 3, dup_prob = .05):
+    #smallest median gap whose exact cumulative probability reaches dup_prob, the counterpart of perm_index without sampling noise.
+    #integer counts are compared against dup_prob as a fraction, so the result is deterministic.
+    m = num - 1
+    target = Fraction(repr(float(dup_prob))) * comb(leng, num)
+    if m % 2 == 1:
+        #the median is the middle gap: it is at most t when at least (m + 1) / 2 gaps are.
+        for t in range(1, leng):
+            if count_short_gaps(leng, m, t, (m + 1) // 2) >= target:
+                return float(t)
+    #the median is the mean of the two middle gaps g(h) and g(h+1), so it moves in half steps: it is at most v / 2 when g(h) = u and g(h+1) <= v - u for some u <= v / 2.
+    #the placements with g(h) <= u and g(h+1) <= w are those with at least h gaps <= u, minus those with exactly h gaps <= u and none in (u, w].
+    h = m // 2
+    tails = {0: 0}
+    for v in range(2, 2 * leng):
+        count = 0
+        for u in range(1, v // 2 + 1):
+            if u not in tails:
+                tails[u] = count_short_gaps(leng, m, u, h)
+            below = comb(m, h) * count_placements(leng, m, h, u - 1, v - u) if u > 1 else 0
+            count += tails[u] - comb(m, h) * count_placements(leng, m, h, u, v - u) - tails[u - 1] + below
+        if count >= target:
+            return v / 2
+
+class ThresholdCache(dict):
+    '''
+    Dictionary of PCR duplicate cluster thresholds keyed by (length, basecount), as used by the pileup scripts' pcr_duplicate_track.
+    Missing keys are computed on lookup by the chosen backend. The permutation backend runs perm_index, with each key drawing from its own generator
+    seeded by (seed, length, basecount), so a threshold does not depend on the order keys are met in and is identical across runs and processes.
+    The exact backend uses exact_index, which has no sampling settings.
+    If a path is given, entries matching these settings are loaded from it and new ones are written back by save().
+    Entries for other settings in the same file are kept as they are.
+    With depth_cap set, a key (length, basecount) longer than the cap is answered from a key at the cap. Once a site is much longer than its base count,
+    the median gap scales as length / basecount times a spread that only depends on the base count, so the threshold of (depth_cap, basecount) is scaled
+    by length / depth_cap. Base counts above depth_cap // 8 use that count instead, to keep the gaps at the cap from being too coarse, at the cost of a
+    little more spread (a slightly lower threshold). The result stays within about a fifth of the threshold at the full length, in either direction,
+    and only keys up to the cap are ever computed or stored, whatever the depth.
+    '''
+    def __init__(self, path = None, pnum = 1000, dup_prob = .05, seed = 0, backend = 'permutation', depth_cap = None):
+        super().__init__()
+        assert backend in BACKENDS, 'unknown threshold backend ' + str(backend)
+        assert depth_cap == None or depth_cap >= 8, 'the depth cap needs to leave room for bases seen twice, at least 8'
+        self.path = path
+        self.depth_cap = depth_cap
+        self.backend = backend
+        self.pnum = pnum
+        self.dup_prob = dup_prob
+        self.seed = seed
+        self.added = 0
+        self.lookups = 0 #lookups and computed thresholds over the life of the cache, for reporting its hit rate.
+        self.computed = 0
+        self.seconds = 0.0 #time spent computing thresholds.
+        self.others = []
+        if path != None and os.path.exists(path):
+            self.load(path)
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        if self.depth_cap != None and key[0] > self.depth_cap:
+            key, scale = self.capped(key)
+            return super().__getitem__(key) * scale
+        return super().__getitem__(key)
+
+    def capped(self, key):
+        #the key standing in for key under the depth cap, and the factor its threshold is scaled by.
+        length, basecount = key
+        if self.depth_cap == None or length <= self.depth_cap:
+            return key, 1.0
+        count = min(basecount, max(2, self.depth_cap // 8))
+        return (self.depth_cap, count), length * count / (basecount * self.depth_cap)
+
+    def __missing__(self, key):
+        start = time.perf_counter()
+        if self.backend == 'exact':
+            thresh = exact_index(leng = key[0], num = key[1], dup_prob = self.dup_prob)
+        else:
+            rng = np.random.default_rng([self.seed, key[0], key[1]])
+            thresh = perm_index(leng = key[0], num = key[1], pnum = self.pnum, dup_prob = self.dup_prob, rng = rng)
+        self[key] = thresh
+        self.added += 1
+        self.computed += 1
+        self.seconds += time.perf_counter() - start
+        return thresh
+
+    def hit_rate(self):
+        #fraction of lookups answered without computing a threshold, or None before any lookup.
+        if self.lookups == 0:
+            return None
+        return 1 - self.computed / self.lookups
+
+    def merge(self, entries):
+        #add (key, threshold) pairs computed elsewhere, e.g. by worker processes with the same settings, so save() writes them too.
+        for key, thresh in entries:
+            if key not in self:
+                self[key] = thresh
+                self.added += 1
+
+    def _settings(self):
+        if self.backend == 'exact':
+            return [self.backend, '.', repr(float(self.dup_prob)), '.']
+        return [self.backend, str(self.pnum), repr(float(self.dup_prob)), str(self.seed)]
+
+    def load(self, path):
+        settings = self._settings()
+        with open(path) as inf:
+            header = inf.readline().strip().split('\t')
+            if header[:2] != ['#pcr_thresholds', 'version=' + str(CACHE_VERSION)]:
+                raise ValueError(path + " is not a version " + str(CACHE_VERSION) + " threshold cache")
+            for entry in inf:
+                if entry.startswith('#'):
+                    continue
+                spent = entry.strip().split('\t')
+                if spent[2:6] == settings:
+                    super().__setitem__((int(spent[0]), int(spent[1])), float(spent[6]))
+                else:
+                    self.others.append(entry.strip())
+
+    def save(self, path = None):
+        #write the cache (plus any entries for other settings) to a temporary file and move it into place, so an interrupted run never leaves a broken cache.
+        path = self.path if path == None else path
+        if path == None or (self.added == 0 and path == self.path):
+            return
+        settings = '\t'.join(self._settings())
+        with open(path + '.tmp', 'w+') as outf:
+            print('#pcr_thresholds\tversion=' + str(CACHE_VERSION), file = outf)
+            print('#length\tbasecount\tbackend\tpnum\tdup_prob\tseed\tthreshold', file = outf)
+            for entry in self.others:
+                print(entry, file = outf)
+            for (length, basecount), thresh in sorted(self.items()):
+                print('\t'.join([str(length), str(basecount), settings, repr(float(thresh))]), file = outf)
+        os.replace(path + '.tmp', path)
+        self.added = 0
+
+    def precompute(self, depth):
+        #fill every key the pileup scripts can ask for up to the given length (or the depth cap); they only test bases with 2 <= count <= length/4.
+        for length in range(8, (depth if self.depth_cap == None else min(depth, self.depth_cap)) + 1):
+            for basecount in range(2, length // 4 + 1):
+                self[(length, basecount)]
+
+def shared_table(maxlen, entries = ()):
+    #a float64 RawArray for SharedThresholds with a slot for every key of length up to maxlen, NaN except for the given (key, threshold) entries.
+    #it is handed to worker processes through their Pool initializer.
+    buffer = RawArray('d', (maxlen + 1) * (maxlen // 4 + 1))
+    table = table_view(buffer, maxlen)
+    table[:] = np.nan
+    for (length, basecount), thresh in entries:
+        if length <= maxlen and basecount <= maxlen // 4:
+            table[length, basecount] = thresh
+    return buffer
+
+def table_view(buffer, maxlen):
+    return np.frombuffer(buffer, dtype = np.float64).reshape(maxlen + 1, maxlen // 4 + 1)
+
+class SharedThresholds(ThresholdCache):
+    '''
+    ThresholdCache whose thresholds for lengths up to maxlen live in a table shared by every worker process of a run (see shared_table), NaN where not computed yet.
+    A threshold one worker computes is seen by the others, so each key is computed about once per run instead of once per process.
+    Thresholds are seeded per key, so two workers computing the same key at once write the same value.
+    Keys beyond the table are kept in the dictionary as in ThresholdCache, which also holds every threshold this process computed, for merging back into a cache file.
+    '''
+    def __init__(self, buffer, maxlen, pnum = 1000, dup_prob = .05, seed = 0, backend = 'permutation', depth_cap = None):
+        super().__init__(None, pnum, dup_prob, seed, backend, depth_cap)
+        self.table = table_view(buffer, maxlen)
+
+    def __getitem__(self, key):
+        key, scale = self.capped(key)
+        length, basecount = key
+        if length >= self.table.shape[0] or basecount >= self.table.shape[1]:
+            return super().__getitem__(key) * scale
+        thresh = self.table[length, basecount]
+        if thresh == thresh:
+            self.lookups += 1
+            return thresh * scale
+        thresh = super().__getitem__(key)
+        self.table[length, basecount] = thresh
+        return thresh * scale
+
+def add_arguments(parser, loaded = 'It is loaded at startup'):
+    #the threshold cache options of every script that tests sites for PCR duplicate clusters; loaded says what the script does with the cache file.
+    parser.add_argument('-c', '--thresholds', help = 'Path to a PCR duplicate threshold cache file (see pcr_thresholds.py). ' + loaded + ' and new thresholds are saved back to it. Default is no cache file', default = None)
+    parser.add_argument('--seed', type = int, help = 'Seed for the PCR duplicate threshold permutations. Default 0', default = 0)
+    parser.add_argument('-b', '--backend', choices = BACKENDS, help = 'Compute PCR duplicate thresholds by permutation or from the exact null distribution. Default permutation', default = 'permutation')
+    parser.add_argument('--depth-cap', dest = 'depth_cap', type = int, help = 'Test sites with more quality bases than this for PCR duplicate clusters with thresholds computed at this depth and scaled up (see pcr_thresholds.ThresholdCache), bounding the cost and number of thresholds of ultra-deep sites. Default is exact thresholds at every depth', default = None)
+
+def from_args(args, **settings):
+    #the threshold cache of the add_arguments options; settings such as dup_prob, path = None or depth_cap = None override them.
+    settings = dict({'path': args.thresholds, 'seed': args.seed, 'backend': args.backend, 'depth_cap': args.depth_cap}, **settings)
+    return ThresholdCache(**settings)
+
+class CapReport:
+    '''
+    The --cap-report of a script run with a --depth-cap: every batch is also called with exact thresholds, and the records the cap lost, gained or changed are counted.
+    Records are lists of columns, matched on their first key_fields columns (chrom and position, or chrom, position, reference and base for one record per mutated base).
+    Settings such as dup_prob go to the exact cache as in from_args.
+    '''
+    def __init__(self, args, key_fields = 2, **settings):
+        assert args.depth_cap != None, '--cap-report needs a --depth-cap'
+        self.depth_cap = args.depth_cap
+        self.exact_track = from_args(args, depth_cap = None, **settings)
+        self.key_fields = key_fields
+        self.tally = {'exact': 0, 'capped': 0, 'lost': 0, 'gained': 0, 'changed': 0}
+
+    def compare(self, exact_records, capped_records):
+        #add the records of one batch, called with exact thresholds and with the depth cap, to the tally.
+        exact = {tuple(r[:self.key_fields]): r for r in exact_records}
+        capped = {tuple(r[:self.key_fields]): r for r in capped_records}
+        self.tally['exact'] += len(exact)
+        self.tally['capped'] += len(capped)
+        self.tally['lost'] += len([k for k in exact if k not in capped])
+        self.tally['gained'] += len([k for k in capped if k not in exact])
+        self.tally['changed'] += len([k for k in exact if k in capped and exact[k] != capped[k]])
+
+    def report(self, capped_track):
+        #print the tally and the thresholds each cache computed to stderr.
+        print("Depth cap {}: {} records with exact thresholds, {} with the cap; {} lost, {} gained, {} changed".format(self.depth_cap, self.tally['exact'], self.tally['capped'],
+            self.tally['lost'], self.tally['gained'], self.tally['changed']), file = sys.stderr)
+        print("Thresholds computed: {} exact in {:.1f}s, {} capped in {:.1f}s".format(self.exact_track.computed, self.exact_track.seconds, capped_track.computed, capped_track.seconds), file = sys.stderr)
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
+    parser.add_argument('-o', '--output', help = 'Path to the threshold cache file to create or extend.')
+    parser.add_argument('-d', '--depth', type = int, help = 'Precompute all thresholds for lengths up to this depth. Default 200', default = 200)
+    parser.add_argument('-n', '--pnum', type = int, help = 'Number of permutations per threshold. Default 1000', default = 1000)
+    parser.add_argument('-p', '--pcr_dup_prob', type = float, help = 'Percentile (as a probability) of the permuted median gaps used as the threshold. Default .05', default = 0.05)
+    parser.add_argument('-s', '--seed', type = int, help = 'Seed for the permutations. Default 0', default = 0)
+    parser.add_argument('-b', '--backend', choices = BACKENDS, help = 'Compute thresholds by permutation or from the exact null distribution. Default permutation', default = 'permutation')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = argparser()
+    cache = ThresholdCache(args.output, pnum = args.pnum, dup_prob = args.pcr_dup_prob, seed = args.seed, backend = args.backend)
+    start = len(cache)
+    cache.precompute(args.depth)
+    cache.save()
+    if args.verbose:
+        print("{} thresholds computed, {} total in {}".format(len(cache) - start, len(cache), args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+#this script runs several of the pileup conversions over a single pass of the pileup.
+#each site is parsed once and the batch masks and PCR duplicate thresholds are shared, then the sites are handed to the call_batch functions of
+#pileup_to_vcf, pileup_to_vcf_snpg, pileup_to_plaintxt and collapse_pileup_to_mut, each writing its own output with its own settings.
+#the outputs are the same as running each script separately with the same threshold seed and backend.
+#outputs are written through output_writer, so any of them named .gz or .bgz (or all of them with -z) are BGZF, and the vcf outputs get a tabix index.
+
+#import
+import argparse
+import pileup_parser
+import pcr_thresholds
+import profiler
+import output_writer
+import pileup_to_vcf
+import pileup_to_vcf_snpg
+import pileup_to_plaintxt
+import collapse_pileup_to_mut
+
+#define functions/classes
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse. Default is standard in', default = None)
+    parser.add_argument('-a', '--header', help = 'File containing header text for a vcf of the given reference genome. Needed for --vcf and --snpg')
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only process this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only process the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('--vcf', help = 'Write the pileup_to_vcf output to this file.', default = None)
+    parser.add_argument('--vcf-mind', dest = 'vcf_mind', type = int, help = 'Minimum depth for the vcf output. Default 10', default = 10)
+    parser.add_argument('--vcf-germline', dest = 'vcf_germline', action = 'store_true', help = 'Retain germline mutations in the vcf output.')
+    parser.add_argument('--snpg', help = 'Write the pileup_to_vcf_snpg (SNPGenie) output to this file.', default = None)
+    parser.add_argument('--snpg-mind', dest = 'snpg_mind', type = int, help = 'Minimum depth for the SNPGenie output. Default 10', default = 10)
+    parser.add_argument('--snpg-germline', dest = 'snpg_germline', action = 'store_true', help = 'Retain germline mutations in the SNPGenie output.')
+    parser.add_argument('--plaintxt', help = 'Write the pileup_to_plaintxt output to this file.', default = None)
+    parser.add_argument('--plaintxt-mind', dest = 'plaintxt_mind', type = int, help = 'Minimum depth for the plain text output. Default 50', default = 50)
+    parser.add_argument('--plaintxt-germline', dest = 'plaintxt_germline', action = 'store_true', help = 'Retain germline mutations in the plain text output.')
+    parser.add_argument('-i', '--sample_id', help = 'value for the ID column of the plain text output', default = 'sample')
+    parser.add_argument('--collapse', help = 'Write the collapse_pileup_to_mut output to this file.', default = None)
+    parser.add_argument('--collapse-threshold', dest = 'collapse_threshold', type = int, help = 'Minimum number of times a base must be seen for the collapsed output. Default 2', default = 2)
+    parser.add_argument('-z', '--bgzip', action = 'store_true', help = 'Write every output as BGZF, with a tabix (.tbi) index for --vcf and --snpg. Implied for an output named .gz or .bgz')
+    parser.add_argument('--compress-threads', dest = 'compress_threads', type = int, help = 'Number of threads compressing each BGZF output. Default 1', default = 1)
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
+    args = parser.parse_args()
+    return args
+
+def make_callers(args, pdt):
+    #(output path, needs a vcf header, function of a batch returning its lines) for every requested output.
+    callers = []
+    if args.vcf != None:
+        callers.append((args.vcf, True, lambda batch: pileup_to_vcf.call_batch(batch, args.vcf_mind, args.vcf_germline, pdt)))
+    if args.snpg != None:
+        callers.append((args.snpg, True, lambda batch: pileup_to_vcf_snpg.call_batch(batch, args.snpg_mind, args.snpg_germline, pdt)))
+    if args.plaintxt != None:
+        callers.append((args.plaintxt, False, lambda batch: pileup_to_plaintxt.call_batch(batch, args.plaintxt_mind, args.plaintxt_germline, pdt, args.sample_id)))
+    if args.collapse != None:
+        callers.append((args.collapse, False, lambda batch: collapse_pileup_to_mut.call_batch(batch, args.collapse_threshold, pdt)))
+    return callers
+
+def main():
+    args = argparser()
+    pdt = pcr_thresholds.from_args(args)
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pdt)
+    callers = make_callers(args, pdt)
+    assert len(callers) > 0, 'no outputs requested; use any of --vcf, --snpg, --plaintxt and --collapse'
+    outfs = []
+    for path, header, caller in callers:
+        outf = output_writer.OutputWriter(path, args.bgzip, args.compress_threads, index = header)
+        if header:
+            assert args.header != None, '--vcf and --snpg need a header file (-a)'
+            output_writer.copy_header(args.header, outf)
+        outfs.append(outf)
+    #every conversion skips sites without an A, C, G or T in the read bases, so the shared parse can too.
+    #with profiling, the filter and pcr stages add up over all the requested outputs.
+    for batch in prof.timed(pileup_parser.read_batches(args.pileup, pileup_parser.get_regions(args.region, args.regions_bed), require = b'ACGT'), 'parse'):
+        pileup_parser.single_sample(batch, 'pileup_fanout')
+        for outf, (path, header, caller) in zip(outfs, callers):
+            lines = caller(batch)
+            start = prof.start()
+            outf.write_lines(lines)
+            prof.lap('write', start)
+    pdt.save()
+    for outf in outfs:
+        outf.close()
+    if args.profile != None:
+        prof.report(args.profile, 'pileup_fanout')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+
+#shared mpileup reading engine for the pileup_to_* family of scripts.
+#instead of re-splitting each line and walking the read base column one character at a time in python,
+#this reads large byte blocks and locates every column of every site in the block with numpy, then decodes the read base and quality columns
+#of the whole batch of sites into flat uint8 arrays plus an offset table. The per-base filtering (ACGTN. cleaning, quality thresholds, reference comparison)
+#then happens once per batch, and scripts only need python per-site work for the small fraction of sites that carry alternative alleles.
+#the read base column is tokenized as samtools writes it (see tokenize): read start marks and their mapping quality, read end marks and indel sequences are removed,
+#reverse strand reference matches (,) and lower case bases are folded into . and upper case with their strand kept, and every remaining read lines up with its quality character.
+
+#import
+import os
+import re
+import numpy as np
+import bgzf
+try:
+    import numba #optional; compiles the tokenizer state machine, otherwise the numpy version is used.
+except ImportError:
+    numba = None
+
+#define functions/classes
+
+BLOCKSIZE = 1 << 23 #bytes read per block; each block becomes one batch of sites.
+KEEP = b'ACGTN.' #the characters the pileup scripts have always kept from the read base column.
+QZERO = ord('0') #consensus quality values are single digit support counts.
+TAB = ord('\t')
+NEWLINE = ord('\n')
+
+_UPPER = np.arange(256, dtype = np.uint8)
+_UPPER[ord('a'):ord('z')+1] -= 32
+_ACGT_CODE = np.full(256, 4, dtype = np.int64)
+for _i, _b in enumerate(b'ACGT'):
+    _ACGT_CODE[_b] = _i
+#read characters folded to their forward strand form: reference matches to ., bases to upper case, deletions to * and reference skips to >.
+_FOLD = np.arange(256, dtype = np.uint8)
+_REVERSE = np.zeros(256, dtype = bool)
+for _f, _r in zip(b'ACGTN.*>', b'acgtn,#<'):
+    _FOLD[_r] = _f
+    _REVERSE[_r] = True
+_MARK = re.compile('[$^+-]')
+_LENGTH = re.compile('[0-9]+')
+_FOLD_TEXT = str.maketrans('acgtn,#<', 'ACGTN.*>')
+_REVERSED = re.compile('[acgtn,#<]')
+_DROPPED = re.compile('[^ACGTN.]')
+
+def segment_sums(mask, offsets):
+    #count the True elements of an element-level mask within each site segment described by offsets (length nsites + 1).
+    #only the selected elements are binned, so dense masks are counted through their (sparse) complement instead,
+    #and when neither is sparse (a fifth to a half selected) a running sum over the whole mask is cheaper.
+    lengths = np.diff(offsets)
+    selected = np.count_nonzero(mask)
+    if selected > len(mask) // 2:
+        return lengths - segment_sums(~mask, offsets)
+    if selected > len(mask) // 5:
+        running = np.zeros(len(mask) + 1, dtype = np.int32)
+        np.cumsum(mask, out = running[1:])
+        return running[offsets[1:]] - running[offsets[:-1]]
+    sites = np.searchsorted(offsets, np.flatnonzero(mask), side = 'right') - 1
+    return np.bincount(sites, minlength = len(lengths))
+
+def gather(block, starts, ends):
+    #concatenate the byte ranges block[starts[i]:ends[i]] into one uint8 array, with their lengths.
+    #slicing the bytes object in python is cheaper here than building a per-byte index array in numpy.
+    joined = b''.join([block[s:e] for s, e in zip(starts.tolist(), ends.tolist())])
+    return np.frombuffer(joined, dtype = np.uint8), ends - starts
+
+def any_of(values, chars):
+    #element mask of values that are one of chars. Chained comparisons are much faster than a lookup table index for a handful of characters.
+    mask = values == chars[0]
+    for c in chars[1:]:
+        mask |= values == c
+    return mask
+
+def _tokenize_numpy(raw, raw_offsets):
+    #the read tokens of the read base columns in raw (sites split by raw_offsets) in a few passes over the whole batch.
+    #most columns have no markup and no reverse strand characters at all, and a byte search rules each kind out far quicker than a numpy pass.
+    text = raw.tobytes()
+    drop = None
+    if b'^' in text:
+        #a read start is ^ followed by a mapping quality character, which can be any character, ^ included.
+        #so in a run of ^ the marks and their mapping qualities alternate from the start of the run.
+        drop = np.zeros(len(raw) + 1, dtype = bool)
+        carets = np.flatnonzero(raw == ord('^'))
+        first = np.ones(len(carets), dtype = bool)
+        first[1:] = carets[1:] != carets[:-1] + 1
+        run_start = np.maximum.accumulate(np.where(first, carets, 0))
+        marks = carets[(carets - run_start) % 2 == 0]
+        drop[marks] = True
+        drop[marks + 1] = True
+    if b'$' in text:
+        drop = np.zeros(len(raw) + 1, dtype = bool) if drop is None else drop
+        drop[np.flatnonzero(raw == ord('$'))] = True
+    if b'+' in text or b'-' in text:
+        #indels are + or - and a length, then that many inserted or deleted bases. Mapping quality characters are already dropped, so every + and - left starts one.
+        drop = np.zeros(len(raw) + 1, dtype = bool) if drop is None else drop
+        signs = np.flatnonzero(((raw == ord('+')) | (raw == ord('-'))) & ~drop[:-1])
+        #the lengths are a digit or two, so they are read a digit at a time for all the indels together.
+        ends = signs + 1
+        sizes = np.zeros(len(signs), dtype = np.int64)
+        while True:
+            more = np.flatnonzero(ends < len(raw))
+            more = more[(raw[ends[more]] >= QZERO) & (raw[ends[more]] <= ord('9'))]
+            if len(more) == 0:
+                break
+            sizes[more] = sizes[more] * 10 + raw[ends[more]] - QZERO
+            ends[more] += 1
+        spans = np.minimum(ends + sizes, len(raw)) - signs
+        drop[np.repeat(signs, spans) + np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)] = True
+    if drop is None:
+        reads = raw
+        offsets = raw_offsets.copy()
+    else:
+        kept = ~drop[:-1]
+        reads = raw[kept]
+        offsets = np.zeros(len(raw_offsets), dtype = np.int64)
+        np.cumsum(segment_sums(kept, raw_offsets), out = offsets[1:])
+    if drop is not None:
+        text = reads.tobytes()
+    if any([c in text for c in b'acgtn,#<']):
+        return _FOLD[reads], _REVERSE[reads], offsets
+    return reads, np.zeros(len(reads), dtype = bool), offsets
+
+def _tokenize_loop(raw, raw_offsets, fold, reverse_table, codes, reverse, offsets):
+    #the same tokenizer as a per-character state machine, written so numba can compile it. Fills codes, reverse and offsets and returns the number of reads.
+    k = 0
+    for s in range(len(raw_offsets) - 1):
+        i = raw_offsets[s]
+        end = raw_offsets[s+1]
+        while i < end:
+            c = raw[i]
+            if c == 94: #^ and its mapping quality.
+                i += 2
+            elif c == 36: #$
+                i += 1
+            elif c == 43 or c == 45: #+ or -, the length and the sequence.
+                i += 1
+                size = 0
+                while i < end and raw[i] >= 48 and raw[i] <= 57:
+                    size = size * 10 + raw[i] - 48
+                    i += 1
+                i += size
+            else:
+                codes[k] = fold[c]
+                reverse[k] = reverse_table[c]
+                k += 1
+                i += 1
+        offsets[s+1] = k
+    return k
+
+_tokenize_compiled = numba.njit(cache = True)(_tokenize_loop) if numba != None else None
+
+def tokenize(raw, raw_offsets, compiled = None):
+    #split the concatenated read base columns in raw (uint8, site i at raw_offsets[i]:raw_offsets[i+1]) into one token per read, as samtools writes them:
+    #the read character folded to its forward strand form (. A C G T N, * for a deletion and > for a reference skip), whether the read is on the reverse strand,
+    #and offsets of each site's reads, which line up one to one with its quality characters. Read start and end marks and indel sequences are dropped.
+    #the compiled state machine is used when numba is installed (compiled = False forces the numpy version).
+    if compiled == None:
+        compiled = _tokenize_compiled != None
+    if not compiled:
+        return _tokenize_numpy(raw, raw_offsets)
+    codes = np.empty(len(raw), dtype = np.uint8)
+    reverse = np.empty(len(raw), dtype = bool)
+    offsets = np.zeros(len(raw_offsets), dtype = np.int64)
+    n = _tokenize_compiled(raw, raw_offsets, _FOLD, _REVERSE, codes, reverse, offsets)
+    return codes[:n], reverse[:n], offsets
+
+def tokenize_site(bases, quals):
+    #the reads of one site's read base and quality columns, for the scripts that still work a line at a time:
+    #(folded read characters, reverse strand flags, quality characters), one per read, as tokenize gives them.
+    #a single column is quicker to walk from mark to mark with python's string searches than to hand to numpy.
+    pieces = []
+    i = 0
+    while True:
+        m = _MARK.search(bases, i)
+        if m == None:
+            pieces.append(bases[i:])
+            break
+        j = m.start()
+        pieces.append(bases[i:j])
+        if bases[j] == '^':
+            i = j + 2 #the mark and its mapping quality.
+        elif bases[j] == '$':
+            i = j + 1
+        else:
+            size = _LENGTH.match(bases, j + 1)
+            i = j + 1 if size == None else size.end() + int(size.group())
+    reads = ''.join(pieces)
+    assert len(reads) == len(quals), 'read base and quality columns disagree in length: ' + bases + ' ' + quals
+    if _REVERSED.search(reads) == None:
+        return reads, [False] * len(reads), quals
+    return reads.translate(_FOLD_TEXT), [c in 'acgtn,#<' for c in reads], quals
+
+def clean_site(bases, quals):
+    #the kept ACGTN. reads of one site and their quality characters, as two strings.
+    codes, reverse, quals = tokenize_site(bases, quals)
+    if _DROPPED.search(codes) == None:
+        return codes, quals
+    kept = [i for i, c in enumerate(codes) if c in 'ACGTN.']
+    return ''.join([codes[i] for i in kept]), ''.join([quals[i] for i in kept])
+
+class SiteBatch:
+    '''
+    A batch of mpileup sites with the read base and quality columns decoded into flat arrays.
+    bases holds only the ACGTN. reads of each site, folded to the forward strand (see tokenize), quals holds the matching quality digits as integers,
+    reverse marks the reads on the reverse strand (None where the source does not record it), and offsets[i]:offsets[i+1] is the slice belonging to site i. The text of every column stays in the original block and is only decoded on request.
+    For a multi-sample mpileup the bases and quals are those of sample_index, and sample() decodes another sample of the same sites.
+    '''
+    nsamples = 1
+    sample_index = 0
+    reverse = None
+
+    def __init__(self, block, starts, ends, bases, quals, offsets, sample_index = 0, reverse = None):
+        self.block = block
+        self.starts = starts
+        self.ends = ends
+        self.bases = bases
+        self.quals = quals
+        self.reverse = reverse
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+        self.masks = {} #is_base and base_ref results, shared by every script that looks at the same batch.
+        self.nsamples = max(1, (starts.shape[1] - 3) // 3)
+        self.sample_index = sample_index
+        buf = np.frombuffer(block, dtype = np.uint8)
+        self.refs = np.where(ends[:,2] > starts[:,2], buf[np.minimum(starts[:,2], len(buf)-1)], ord('N')).astype(np.uint8)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def sample(self, k):
+        #the same sites with the read base and quality columns of sample k; the batch itself for its own sample.
+        if k == self.sample_index:
+            return self
+        return decode_sample(self.block, self.starts, self.ends, k)
+
+    def column(self, i, col):
+        return self.block[self.starts[i,col]:self.ends[i,col]].decode()
+
+    def chrom(self, i):
+        return self.column(i, 0)
+
+    def loc(self, i):
+        return self.column(i, 1)
+
+    def ref(self, i):
+        return self.column(i, 2)
+
+    def contig_runs(self):
+        #(contig, first site, end site) of each run of sites on one contig. A pileup lists the sites of each contig together,
+        #so the ends of the runs are found by bisection with a few chrom lookups instead of decoding every site's contig.
+        runs = []
+        start = 0
+        while start < len(self):
+            contig = self.chrom(start)
+            lo, hi = start, len(self)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.chrom(mid) == contig:
+                    lo = mid
+                else:
+                    hi = mid
+            runs.append((contig, start, hi))
+            start = hi
+        return runs
+
+    def fields(self, i):
+        #the whitespace split columns of site i as strings, equivalent to entry.strip().split() for a well formed line.
+        return [self.column(i, c) for c in range(self.starts.shape[1]) if self.ends[i,c] > self.starts[i,c]]
+
+    def positions(self):
+        #the position column of every site as integers, parsed from its digits in one pass.
+        digits, lengths = gather(self.block, self.starts[:,1], self.ends[:,1])
+        ends = np.cumsum(lengths)
+        place = np.repeat(ends, lengths) - 1 - np.arange(len(digits))
+        values = (digits.astype(np.int64) - QZERO) * 10 ** place
+        return np.add.reduceat(values, ends - lengths) if len(digits) > 0 else np.zeros(len(self), dtype = np.int64)
+
+    def ref_codes(self, upper = False):
+        #reference byte of each site, optionally uppercased for the scripts that ignore soft masking.
+        return _UPPER[self.refs] if upper else self.refs
+
+    def base_ref(self, upper = False):
+        #per-element copy of each site's reference byte, for comparing bases against the reference in one pass.
+        if ('ref', upper) not in self.masks:
+            self.masks[('ref', upper)] = np.repeat(self.ref_codes(upper), self.lengths)
+        return self.masks[('ref', upper)]
+
+    def is_base(self, chars):
+        #element mask of bases that are one of chars. The result is reused, so callers combine it into new arrays rather than changing it in place.
+        if chars not in self.masks:
+            self.masks[chars] = any_of(self.bases, chars)
+        return self.masks[chars]
+
+    def count(self, mask):
+        #number of masked elements in each site.
+        return segment_sums(mask, self.offsets)
+
+    def base_counts(self, mask):
+        #nsites x 4 table of how often each of A, C, G and T appears among the masked elements of each site.
+        #the masks used by the scripts are sparse, so only the selected elements are binned.
+        selected = np.flatnonzero(mask)
+        sites = np.searchsorted(self.offsets, selected, side = 'right') - 1
+        codes = _ACGT_CODE[self.bases[selected]]
+        counts = np.bincount(sites * 5 + codes, minlength = len(self) * 5)
+        return counts.reshape(len(self), 5)[:,:4]
+
+    def masked(self, mask):
+        #the masked bases of every site as one uint8 array plus each site's offset into it, the layout pcr_thresholds.batch_dindex takes.
+        #the scripts ask for the same mask several times (bases, qualities, gaps), so the last one is kept; holding the mask itself means it is never confused with a new one.
+        last = self.masks.get('masked')
+        if last == None or last[0] is not mask:
+            ends = np.zeros(len(self) + 1, dtype = np.int64)
+            np.cumsum(self.count(mask), out = ends[1:])
+            last = (mask, self.bases[mask], ends)
+            self.masks['masked'] = last
+        return last[1], last[2]
+
+    def strings(self, mask, sites, quals = False):
+        #the masked bases (or quality digits) of each requested site as python strings, in their original order.
+        values, ends = self.masked(mask)
+        values = (self.quals[mask] + QZERO if quals else values).tobytes()
+        return [values[ends[i]:ends[i+1]].decode() for i in sites]
+
+class RecordBatch(SiteBatch):
+    '''
+    A SiteBatch of split pileup records (lists of chrom, position, reference, depth, read bases and qualities, as fields() returns them) instead of a text block.
+    Scripts chained in one process (see pileup_pipeline.py) hand their sites on this way, so nothing is written out and parsed back between them.
+    The read base column is tokenized and cleaned to the ACGTN. reads as parse_block does; the records themselves are kept as given.
+    Like a parsed block, it holds the columns of the first sample of multi-sample records and counts their samples in nsamples.
+    '''
+    def __init__(self, records):
+        self.records = records
+        self.nsamples = max([1] + [(len(r) - 3) // 3 for r in records])
+        #zero depth sites carry a '*' placeholder in both columns.
+        columns = [('', '') if str(r[3]) == '0' else (r[4], r[5]) for r in records]
+        raw = np.frombuffer(''.join([c[0] for c in columns]).encode(), dtype = np.uint8)
+        raw_offsets = np.zeros(len(records) + 1, dtype = np.int64)
+        np.cumsum([len(c[0]) for c in columns], out = raw_offsets[1:])
+        codes, reverse, read_offsets = tokenize(raw, raw_offsets)
+        quals = np.frombuffer(''.join([c[1] for c in columns]).encode(), dtype = np.uint8)
+        assert len(codes) == len(quals), 'read base and quality columns disagree in length in a pileup record'
+        keep = any_of(codes, KEEP)
+        self.offsets = np.zeros(len(records) + 1, dtype = np.int64)
+        np.cumsum(segment_sums(keep, read_offsets), out = self.offsets[1:])
+        self.bases = codes[keep]
+        self.quals = quals[keep] - QZERO
+        self.reverse = reverse[keep]
+        self.lengths = np.diff(self.offsets)
+        self.masks = {}
+        self.refs = np.array([ord(r[2][0]) if r[2] else ord('N') for r in records], dtype = np.uint8)
+
+    def __len__(self):
+        return len(self.records)
+
+    def column(self, i, col):
+        return str(self.records[i][col])
+
+    def fields(self, i):
+        return [str(v) for v in self.records[i]]
+
+    def positions(self):
+        return np.array([int(r[1]) for r in self.records], dtype = np.int64)
+
+def single_sample(batch, script, nsamples = None):
+    #the batch, for the scripts that read a single sample's columns. A multi-sample pileup stops them with an error rather than having all but its first sample quietly ignored.
+    nsamples = batch.nsamples if nsamples == None else nsamples
+    assert nsamples == 1, (script + ' reads single-sample pileups, but this one has ' + str(nsamples) + ' samples. '
+        + 'Cut out one sample\'s columns first, or call every sample with pileup_to_vcf, pileup_to_vcf_snpg or pileup_to_plaintxt')
+    return batch
+
+def as_batch(chunk, script = 'this pipeline stage'):
+    #the sites of a pipeline chunk, which is either a SiteBatch or a list of split pileup records, as a SiteBatch. The stages read single-sample pileups.
+    return single_sample(chunk if isinstance(chunk, SiteBatch) else RecordBatch(chunk), script)
+
+def as_records(chunk, script = None):
+    #the sites of a pipeline chunk as a list of split records. Stages that read the read base columns give their name as script, which holds them to single-sample pileups as in as_batch.
+    if script != None:
+        single_sample(chunk, script, chunk.nsamples if isinstance(chunk, SiteBatch) else max([1] + [(len(r) - 3) // 3 for r in chunk]))
+    if isinstance(chunk, RecordBatch):
+        return chunk.records
+    if isinstance(chunk, SiteBatch):
+        return [chunk.fields(i) for i in range(len(chunk))]
+    return chunk
+
+def raw_chars(chars):
+    #the read base column characters that tokenize folds into one of chars, such as b'ACGTacgt' for b'ACGT'.
+    return bytes([c for c in range(256) if _FOLD[c] in chars])
+
+def parse_block(block, require = None, sample = 0):
+    #turn a block of complete mpileup lines (bytes ending in a newline) into a SiteBatch of the given sample's columns; SiteBatch.sample gives the others.
+    #if require is given, only sites whose read base column contains at least one of those characters, on either strand, are decoded and kept.
+    #most sites of a deep pileup are pure reference, so scripts that only report alternative alleles can skip them without touching their columns.
+    buf = np.frombuffer(block, dtype = np.uint8)
+    #tabs and newlines are the only bytes at or below the newline value, so one pass finds both.
+    seps = np.flatnonzero(buf <= NEWLINE)
+    is_newline = buf[seps] == NEWLINE
+    newlines = seps[is_newline]
+    tabs = seps[~is_newline]
+    line_starts = np.zeros(len(newlines), dtype = np.int64)
+    line_starts[1:] = newlines[:-1] + 1
+    ncols = len(seps) // len(newlines)
+    if len(seps) == ncols * len(newlines) and np.all(is_newline[ncols-1::ncols]):
+        #every line has the same number of columns, so the tab positions simply reshape into the column table.
+        starts = np.empty((len(newlines), max(6, ncols)), dtype = np.int64)
+        ends = np.empty_like(starts)
+        starts[:,ncols:] = newlines[:,None]
+        ends[:,ncols:] = newlines[:,None]
+        grid = tabs.reshape(len(newlines), ncols - 1)
+        starts[:,0] = line_starts
+        starts[:,1:ncols] = grid + 1
+        ends[:,:ncols-1] = grid
+        ends[:,ncols-1] = newlines
+    else:
+        #locate which line every tab belongs to and which column it closes.
+        tab_line = np.searchsorted(newlines, tabs)
+        ntabs = np.bincount(tab_line, minlength = len(newlines))
+        first_tab = np.zeros(len(newlines), dtype = np.int64)
+        np.cumsum(ntabs[:-1], out = first_tab[1:])
+        rank = np.arange(len(tabs)) - first_tab[tab_line]
+        ncols = max(6, int(ntabs.max()) + 1)
+        #missing trailing columns come out as empty ranges at the end of their line.
+        starts = np.repeat(newlines[:,None], ncols, axis = 1)
+        ends = starts.copy()
+        starts[:,0] = line_starts
+        starts[tab_line, rank + 1] = tabs + 1
+        ends[tab_line, rank] = tabs
+    #a multi-sample mpileup repeats the depth, read base and quality columns for each sample.
+    nsamples = max(1, (starts.shape[1] - 3) // 3)
+    if require == None:
+        lines = np.flatnonzero(newlines > line_starts)
+    else:
+        #a range test is cheaper than one comparison per character over the whole block; the few candidates are then checked exactly.
+        #a site is kept if the read bases of any of its samples hold one of the characters. Reverse strand reads are matched in their raw form, before folding.
+        require = raw_chars(require)
+        hits = np.flatnonzero((buf >= min(require)) & (buf <= max(require)))
+        hits = hits[any_of(buf[hits], require)]
+        hit_line = np.searchsorted(newlines, hits)
+        inside = np.zeros(len(hits), dtype = bool)
+        for k in range(nsamples):
+            col = 4 + 3 * k
+            inside |= (hits >= starts[hit_line,col]) & (hits < ends[hit_line,col]) & ~empty_depth(buf, starts, ends, k)[hit_line]
+        lines = np.unique(hit_line[inside])
+    return decode_sample(block, starts[lines], ends[lines], sample)
+
+def empty_depth(buf, starts, ends, sample = 0):
+    #zero depth sites have no bases; samtools leaves the columns empty or writes a '*' placeholder.
+    col = 3 + 3 * sample
+    return (ends[:,col] - starts[:,col] == 1) & (buf[np.minimum(starts[:,col], len(buf)-1)] == QZERO)
+
+def decode_sample(block, starts, ends, sample = 0):
+    #decode the read base and quality columns of one sample of the located sites into a SiteBatch.
+    buf = np.frombuffer(block, dtype = np.uint8)
+    bcol, qcol = 4 + 3 * sample, 5 + 3 * sample
+    assert qcol < starts.shape[1], 'the pileup has no sample ' + str(sample)
+    empty = empty_depth(buf, starts, ends, sample)
+    bends = np.where(empty, starts[:,bcol], ends[:,bcol])
+    qends = np.where(empty, starts[:,qcol], ends[:,qcol])
+    raw, rawlengths = gather(block, starts[:,bcol], bends)
+    raw_offsets = np.zeros(len(starts) + 1, dtype = np.int64)
+    np.cumsum(rawlengths, out = raw_offsets[1:])
+    codes, reverse, read_offsets = tokenize(raw, raw_offsets)
+    quals, qlens = gather(block, starts[:,qcol], qends)
+    bad = np.flatnonzero(np.diff(read_offsets) != qlens)
+    assert len(bad) == 0, 'read base and quality columns disagree in length at line ' + block[starts[bad[0],0]:ends[bad[0],1]].decode()
+    keep = any_of(codes, KEEP)
+    if np.count_nonzero(keep) == len(codes):
+        #every read is a kept base, as in most pileups.
+        return SiteBatch(block, starts, ends, codes, quals - QZERO, read_offsets, sample, reverse)
+    offsets = np.zeros(len(starts) + 1, dtype = np.int64)
+    np.cumsum(segment_sums(keep, read_offsets), out = offsets[1:])
+    return SiteBatch(block, starts, ends, codes[keep], quals[keep] - QZERO, offsets, sample, reverse[keep])
+
+def iter_blocks(handle, blocksize = BLOCKSIZE):
+    #yield blocks of complete lines read from handle in large reads.
+    carry = b''
+    while True:
+        block = handle.read(blocksize)
+        if not block:
+            break
+        block = carry + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            carry = block
+            continue
+        carry = block[cut:]
+        yield block[:cut]
+    if carry:
+        yield carry + b'\n'
+
+def iter_batches(handle, blocksize = BLOCKSIZE, require = None):
+    #yield a SiteBatch for every block of the input. See parse_block for require.
+    for block in iter_blocks(handle, blocksize):
+        batch = parse_block(block, require)
+        if len(batch) > 0:
+            yield batch
+
+def split_ranges(path, chunksize = BLOCKSIZE, start = 0):
+    #cut a pileup file (from byte start, a line start) into (start, end) byte ranges of about chunksize bytes that each hold whole lines, for handing to separate workers.
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as inf:
+        while start < size:
+            inf.seek(min(start + chunksize, size))
+            inf.readline()
+            end = min(inf.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def iter_offset_batches(path, start = 0, blocksize = BLOCKSIZE, require = None):
+    #yield (SiteBatch, byte offset just past its block) for an uncompressed pileup file read from byte start, which must be a line start.
+    #the offsets are where a checkpointed run (see checkpoint.py) can continue reading.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as inf:
+        inf.seek(start)
+        offset = start
+        for block in iter_blocks(inf, blocksize):
+            offset = min(offset + len(block), size)
+            batch = parse_block(block, require)
+            if len(batch) > 0:
+                yield batch, offset
+
+def read_range(path, start, end):
+    #the bytes of one range from split_ranges, newline terminated.
+    with open(path, 'rb') as inf:
+        inf.seek(start)
+        block = inf.read(end - start)
+    if block and not block.endswith(b'\n'):
+        block += b'\n'
+    return block
+
+def sample_names(nsamples, names = None, prefix = 'sample'):
+    #names for the samples of a pileup: the given ones, which must match their number, or prefix1, prefix2 and so on.
+    if names == None:
+        return [prefix + str(k + 1) for k in range(nsamples)]
+    assert len(names) == nsamples, 'got ' + str(len(names)) + ' sample names for a pileup of ' + str(nsamples) + ' samples'
+    return list(names)
+
+def previous_line(path, start):
+    #the line ending just before byte start (a range start from split_ranges), or the empty string at the start of the file.
+    step = 1 << 16
+    with open(path, 'rb') as inf:
+        while True:
+            begin = max(0, start - step)
+            inf.seek(begin)
+            block = inf.read(start - begin)
+            cut = block.rfind(b'\n', 0, len(block) - 1)
+            if cut >= 0 or begin == 0:
+                return block[cut + 1:]
+            step *= 2
+
+def open_pileup(path = None):
+    #binary handle on a pileup path, or on standard in when no path is given. gzip and BGZF compressed pileups are decompressed as they are read,
+    #BGZF on a pool of bgzf.READ_THREADS threads.
+    return bgzf.open_input(path, text = False)
+
+def parse_region(region):
+    #samtools style region string, contig or contig:start-end with 1 based inclusive positions, as (contig, start, end).
+    if ':' not in region:
+        return (region, 1, float('inf'))
+    contig, span = region.rsplit(':', 1)
+    span = span.replace(',', '')
+    if '-' in span:
+        start, end = span.split('-')
+        return (contig, int(start), int(end) if end else float('inf'))
+    return (contig, int(span), float('inf'))
+
+def read_regions_bed(path):
+    #regions from the first three columns of a bed file (0 based, half open), as 1 based inclusive (contig, start, end).
+    regions = []
+    with open(path) as inf:
+        for entry in inf:
+            spent = entry.strip().split()
+            if len(spent) < 3 or spent[0].startswith('#') or spent[0] in ('track', 'browser'):
+                continue
+            regions.append((spent[0], int(spent[1]) + 1, int(spent[2])))
+    return regions
+
+def merge_regions(regions):
+    #sort the regions of each contig and merge overlapping ones so no site is read twice. Contigs keep the order they were first given in.
+    order = {}
+    for contig, start, end in regions:
+        order.setdefault(contig, []).append((start, end))
+    merged = []
+    for contig, spans in order.items():
+        spans.sort()
+        cstart, cend = spans[0]
+        for start, end in spans[1:]:
+            if start <= cend + 1:
+                cend = max(cend, end)
+            else:
+                merged.append((contig, cstart, cend))
+                cstart, cend = start, end
+        merged.append((contig, cstart, cend))
+    return merged
+
+def get_regions(region = None, regions_bed = None):
+    #combine --region strings and a --regions-bed file into one merged region list, or None when neither was given.
+    regions = [parse_region(r) for r in (region or [])]
+    if regions_bed != None:
+        regions.extend(read_regions_bed(regions_bed))
+    if not regions:
+        return None
+    return merge_regions(regions)
+
+def is_alignment(path):
+    #BAM and CRAM paths, which read_batches reads through bam_reader instead of as pileup text.
+    return path != None and path.endswith(('.bam', '.cram'))
+
+def read_batches(path = None, regions = None, blocksize = BLOCKSIZE, require = None, reference = None):
+    #yield a SiteBatch for every block of a pileup path (or standard in), closing the file when done.
+    #with regions, the pileup must be BGZF compressed and indexed with bgzf.py; only the blocks covering the regions are read.
+    #a site store directory built by site_store.py can be given in place of a pileup. It is imported here since it builds on this module.
+    #so can an indexed BAM or CRAM file with the reference fasta, which bam_reader turns into the batches samtools mpileup text would give; it needs pysam, so it is only imported then.
+    if path != None and os.path.isdir(path):
+        import site_store
+        for batch in site_store.iter_store_batches(path, regions, require = require):
+            yield batch
+        return
+    if is_alignment(path):
+        import bam_reader
+        for batch in bam_reader.iter_bam_batches(path, reference, regions, require = require):
+            yield batch
+        return
+    if regions == None:
+        pilein = open_pileup(path)
+        for batch in iter_batches(pilein, blocksize, require):
+            yield batch
+        if path != None:
+            pilein.close()
+        return
+    if path == None or not bgzf.is_bgzf(path) or not os.path.exists(bgzf.index_path(path)):
+        raise ValueError('regions need a BGZF compressed pileup file with a .pidx index; create them with bgzf.py')
+    for block in bgzf.iter_region_blocks(path, regions, blocksize):
+        batch = parse_block(block, require)
+        if len(batch) > 0:
+            yield batch
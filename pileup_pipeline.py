@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+#this script chains several of the pileup scripts in one process, in place of a shell pipeline such as
+#get_best_mutations.py < sample.pileup | remove_bad_entries.py | collapse_pileup_to_mut.py | fix_chr.py
+#each script's pipeline stage is a generator over chunks of sites (a pileup_parser.SiteBatch, or a list of split pileup records), so the sites are
+#handed from stage to stage in memory: the pileup is parsed once at the start and the records are written once at the end, and all the stages share one PCR duplicate threshold cache.
+#stages are given in order with -s, as the script name optionally followed by a colon and comma separated option=value settings, e.g. -s remove_bad_entries:threshold=3,remove_singleton=True
+#a pileup_to_vcf stage, which needs a header file (-s pileup_to_vcf:header=header.txt), writes a vcf and so can only be the last stage.
+#the output is the same as the shell pipeline of the scripts with the same settings, threshold seed and backend; --compare-shell also runs that pipeline and reports both throughputs.
+
+#import
+import argparse
+import os
+import subprocess
+import sys
+import time
+import pileup_parser
+import pcr_thresholds
+import output_writer
+import get_best_mutations
+import detect_pcr_dups
+import remove_bad_entries
+import collapse_pileup_to_mut
+import fix_chr
+import convert_id
+import pileup_to_vcf
+
+#define functions/classes
+
+#script name: (stage function, whether it takes the threshold cache, characters its input sites need when it reads the pileup (see pileup_parser.parse_block),
+#its options with their defaults, and the command line arguments of the script for those options).
+STAGES = {
+    'get_best_mutations': (get_best_mutations.best_mutations, True, b'ACGT', {}, lambda o: []),
+    'detect_pcr_dups': (detect_pcr_dups.detect_pcr_dups, False, b'ACGT', {}, lambda o: []),
+    'remove_bad_entries': (remove_bad_entries.remove_bad_entries, True, None, {'threshold': 2, 'remove_singleton': False},
+        lambda o: ['-t', str(o['threshold'])] + (['-s'] if o['remove_singleton'] else [])),
+    'collapse_pileup_to_mut': (collapse_pileup_to_mut.collapse_pileup_to_mut, True, b'ACGT', {'threshold': 2}, lambda o: ['-t', str(o['threshold'])]),
+    'fix_chr': (fix_chr.fix_chr, False, None, {}, lambda o: []),
+    'convert_id': (convert_id.convert_ids, False, None, {}, lambda o: []),
+    'pileup_to_vcf': (pileup_to_vcf.vcf_records, True, b'ACGT', {'header': '', 'mind': 10, 'germline': False},
+        lambda o: ['-a', o['header'], '-d', str(o['mind'])] + (['-g', 'True'] if o['germline'] else [])),
+}
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse. Default is standard in', default = None)
+    parser.add_argument('-o', '--output', help = 'Name of the output file. Default is stdout', default = None)
+    parser.add_argument('-s', '--stage', action = 'append', help = 'Add a stage, as one of ' + ', '.join(STAGES) + ', optionally followed by :option=value,option=value. Repeat in pipeline order')
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('--compare-shell', dest = 'compare_shell', action = 'store_true', help = 'Also run the same stages as a shell pipeline of the scripts, check that it gives the same output and report the throughput of both. Needs -p and -o')
+    args = parser.parse_args()
+    return args
+
+def parse_stage(spec):
+    #(script name, options) of a -s value, with the options converted to the types of their defaults.
+    name, _, settings = spec.partition(':')
+    assert name in STAGES, 'unknown stage ' + name + '; choose from ' + ', '.join(STAGES)
+    options = dict(STAGES[name][3])
+    for setting in [s for s in settings.split(',') if s]:
+        key, _, value = setting.partition('=')
+        assert key in options, 'stage ' + name + ' has no option ' + key + '; its options are ' + (', '.join(options) or 'none')
+        if type(options[key]) == bool:
+            options[key] = value in ('True', 'true', '1')
+        else:
+            options[key] = type(options[key])(value)
+    return name, options
+
+def build_pipeline(chunks, stages, pcr_duplicate_track):
+    #chain the stage generators over the chunks of the input.
+    for name, options in stages:
+        function, cached = STAGES[name][:2]
+        chunks = function(chunks, pcr_duplicate_track, **options) if cached else function(chunks, **options)
+    return chunks
+
+def run_pipeline(path, output, stages, pcr_duplicate_track):
+    #run the stages in this process and write their records to output. Returns the number of records written.
+    require = STAGES[stages[0][0]][2]
+    outf = output_writer.OutputWriter(output)
+    count = 0
+    for records in build_pipeline(pileup_parser.read_batches(path, require = require), stages, pcr_duplicate_track):
+        outf.write_lines(['\t'.join(record) for record in records])
+        count += len(records)
+    outf.close()
+    return count
+
+def shell_commands(stages, seed = 0, backend = 'permutation', depth_cap = None):
+    #the command of each script of the equivalent shell pipeline.
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = []
+    for name, options in stages:
+        command = [sys.executable, os.path.join(here, name + '.py')] + STAGES[name][4](options)
+        if STAGES[name][1]:
+            command += ['--seed', str(seed), '-b', backend] + (['--depth-cap', str(depth_cap)] if depth_cap != None else [])
+        commands.append(command)
+    return commands
+
+def run_shell(path, output, commands):
+    #run the commands as a pipeline from the pileup file to the output file, as the shell would.
+    procs = []
+    with open(path, 'rb') as inf, open(output, 'wb') as outf:
+        for i, command in enumerate(commands):
+            source = inf if i == 0 else procs[-1].stdout
+            procs.append(subprocess.Popen(command, stdin = source, stdout = outf if i == len(commands) - 1 else subprocess.PIPE))
+            if i > 0:
+                procs[-2].stdout.close() #so the earlier script sees a broken pipe if a later one exits.
+        for proc in procs:
+            proc.wait()
+    failed = [' '.join(c) for c, p in zip(commands, procs) if p.returncode != 0]
+    assert len(failed) == 0, 'shell pipeline command failed: ' + '; '.join(failed)
+
+def same_file(first, second):
+    with open(first, 'rb') as a, open(second, 'rb') as b:
+        while True:
+            ca = a.read(1 << 24)
+            cb = b.read(1 << 24)
+            if ca != cb:
+                return False
+            if not ca:
+                return True
+
+def main():
+    args = argparser()
+    assert args.stage, 'no stages given; add them in order with -s'
+    stages = [parse_stage(spec) for spec in args.stage]
+    assert 'pileup_to_vcf' not in [name for name, options in stages[:-1]], 'pileup_to_vcf writes a vcf, so it can only be the last stage'
+    pdt = pcr_thresholds.from_args(args)
+    start = time.time()
+    count = run_pipeline(args.pileup, args.output, stages, pdt)
+    seconds = time.time() - start
+    pdt.save()
+    if args.verbose:
+        print("Wrote", count, "records through", len(stages), "stages in {:.2f}s".format(seconds), file = sys.stderr)
+    if args.compare_shell:
+        assert args.pileup != None and args.output != None and os.path.isfile(args.pileup), '--compare-shell needs a pileup file (-p) and an output file (-o)'
+        commands = shell_commands(stages, args.seed, args.backend, args.depth_cap)
+        start = time.time()
+        run_shell(args.pileup, args.output + '.shell', commands)
+        shell_seconds = time.time() - start
+        megabytes = os.path.getsize(args.pileup) / 1e6
+        print("In process: {:.2f}s, {:.1f} MB/s".format(seconds, megabytes / seconds), file = sys.stderr)
+        print("Shell pipeline: {:.2f}s, {:.1f} MB/s".format(shell_seconds, megabytes / shell_seconds), file = sys.stderr)
+        print("Speedup: {:.2f}x".format(shell_seconds / seconds), file = sys.stderr)
+        if same_file(args.output, args.output + '.shell'):
+            print("Outputs are identical", file = sys.stderr)
+            os.remove(args.output + '.shell')
+        else:
+            print("Outputs differ; the shell pipeline output is kept in", args.output + '.shell', file = sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
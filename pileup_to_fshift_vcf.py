@@ -5,9 +5,14 @@
 
 #import
 import argparse
+import os
 import sys
 import numpy as np
-import statistics as st
+from multiprocessing import Pool
+import pileup_parser
+import bgzf
+import pcr_thresholds
+import output_writer
 
 #define functions/classes
 
@@ -15,135 +20,201 @@ def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     parser.add_argument('-a', '--header', help = 'File containing header text for a vcf of the given reference genome.')
-    parser.add_argument('-p', '--pileup', help = 'Pileup to parse and force into a VCF format. Default is standard in', default = None)
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse and force into a VCF format. Default is standard in', default = None)
     parser.add_argument('-o', '--output', help = 'Name of the vcf output file. Default is stdout', default = None)
     parser.add_argument('-g', '--germline', type = bool, help = 'Set to True to retain germline mutations. Default is False and ignores high frequency mutations', default = False)
     parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification. Default 10', default = 10)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('-t', '--threads', type = int, help = 'Number of processes to call sites with. Requires an uncompressed pileup file (-p), not a store; output order and content match a single process run. Default 1', default = 1)
+    parser.add_argument('-z', '--bgzip', action = 'store_true', help = 'Write the output as BGZF with a tabix (.tbi) index. Implied by an output name ending in .gz or .bgz')
+    parser.add_argument('--compress-threads', dest = 'compress_threads', type = int, help = 'Number of threads compressing BGZF output. Default 1', default = 1)
     args = parser.parse_args()
     return args
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
-
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
-
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
+#PCR duplicate errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
+#in this case, we only want to count the single A error rather than counting it 5 times. The thresholds for this come from pcr_thresholds.ThresholdCache, as in pileup_to_vcf.
 
-def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = {}, fixed_alts = None, depth = 0):
+def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), fixed_alts = None, depth = 0):
     #convert a stripped and split mpileup line into a fake vcf line, filling in default values.
     #pileup: chrom loc ref depth vector_of_alts vector_of_quals
     #vcf: chrom loc ID(.) ref alt qual filter info(dp=...)
     #minimalist entry looking at the docs is just "DP" in info, qual is ., id is ., filter is PASS. So try those.
     chrom, loc, ref, ndepth, vector_of_alts, vector_of_quals = spent
+    vector_of_alts, vector_of_quals = pileup_parser.clean_site(vector_of_alts, vector_of_quals) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     #real depth isn't depth, its the length of the vector of alts without other symbols or Ns, because most Ns are introduced by the consensus builder and not in the original reads.
     # pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
     new_depth = len([v for v in vector_of_alts if v in 'ACGT.'])
     if new_depth >= mind:
         quality_alts = []
-        cleaner = [b for b in vector_of_alts if b in 'ACGTN.']
+        cleaner = vector_of_alts
         assert len(cleaner) == len(vector_of_quals)
         for i,b in enumerate(cleaner):
             if b in 'ACGT':
                 #check if the qual value is high enough.
                 if int(vector_of_quals[i]) > 1:
                     quality_alts.append(b)
-        #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
-        #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
-        if not germline:
-            # for b in 'ACGT': #for all possible bases
-                # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
-                    # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
-            #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
-            skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-            dindeces = get_dindex(quality_alts)
-            pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
-            for base in 'ACGT':
-                basecount = quality_alts.count(base)
-                if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                    key = (len(quality_alts), basecount)
-                    if key not in pcr_duplicate_track:
-                        pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                    thresh = pcr_duplicate_track[key]
-                    if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                        #print("QC: Base is skipped for clustering")
-                        skip += base
-                        #still count it once though
-                        pcrc.append(base)
-                    #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
-                else:
+        return call_alts(chrom, loc, ref, new_depth, quality_alts, germline, pcr_duplicate_track, fixed_alts, depth)
+    else:
+        return None, pcr_duplicate_track, fixed_alts, 0 #no information about this spot, ignore any new data coming from it and return unused old data so no mutations are thrown out.
+
+def call_alts(chrom, loc, ref, new_depth, quality_alts, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), fixed_alts = None, depth = 0):
+    #carry the quality filtered alternative bases of a site that passed the depth filter forward, and emit the line for the previous site's alternatives.
+    #split out of make_vcf_line so the batched reader in main can hand over sites it has already cleaned in numpy.
+    #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
+    #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
+    if not germline:
+        # for b in 'ACGT': #for all possible bases
+            # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
+                # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
+        #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
+        skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+        dindeces = pcr_thresholds.get_dindex(quality_alts)
+        pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
+        for base in 'ACGT':
+            basecount = quality_alts.count(base)
+            if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+                thresh = pcr_duplicate_track[(len(quality_alts), basecount)]
+                if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                    #print("QC: Base is skipped for clustering")
                     skip += base
-        #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
-        new_fixed_alts = ','.join(pcrc + [q for q in quality_alts if q not in skip])
-        # fixed_alts = ','.join(list(set(quality_alts))) #ignoring any weirdness around the mpileup, at least for now. Also, removing duplicates of somatic mutations.
-        # print(len(fixed_alts), fixed_alts)
-        
-        #since this is a frameshifter, I only want to return a vcf line if I have the old data, and I only want to return the new data if it exists.
-        if fixed_alts == None and len(new_fixed_alts) > 0: #if there was no old data but there is new data, return new data only
-            return None, pcr_duplicate_track, new_fixed_alts, new_depth
-        elif fixed_alts == None and len(new_fixed_alts) == 0: #if there was neither old or new data, return none for both slots
-            return None, pcr_duplicate_track, None, new_depth
-        vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(depth) #there is old data, construct a line to return
-        if len(new_fixed_alts) == 0: #no new data, don't return anything for that
-            return vcf_line, pcr_duplicate_track, None, new_depth
+                    #still count it once though
+                    pcrc.append(base)
+                #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
+            else:
+                skip += base
+    #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
+    new_fixed_alts = ','.join(pcrc + [q for q in quality_alts if q not in skip])
+    # fixed_alts = ','.join(list(set(quality_alts))) #ignoring any weirdness around the mpileup, at least for now. Also, removing duplicates of somatic mutations.
+    # print(len(fixed_alts), fixed_alts)
+    
+    #since this is a frameshifter, I only want to return a vcf line if I have the old data, and I only want to return the new data if it exists.
+    if fixed_alts == None and len(new_fixed_alts) > 0: #if there was no old data but there is new data, return new data only
+        return None, pcr_duplicate_track, new_fixed_alts, new_depth
+    elif fixed_alts == None and len(new_fixed_alts) == 0: #if there was neither old or new data, return none for both slots
+        return None, pcr_duplicate_track, None, new_depth
+    vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(depth) #there is old data, construct a line to return
+    if len(new_fixed_alts) == 0: #no new data, don't return anything for that
+        return vcf_line, pcr_duplicate_track, None, new_depth
+    else:
+        return vcf_line, pcr_duplicate_track, new_fixed_alts, new_depth #both old and new data, return it all
+
+def call_sites(batch, mind, germline, pcr_duplicate_track, fixed_alts = None, depth = 0, begin = 0, stop = None):
+    #call sites begin to stop of a batch in order, starting from the carried alternatives and depth; returns the vcf lines and the carry after the last site.
+    #the depth and quality filtering of the whole batch happens at once, only the carry is passed from site to site.
+    stop = len(batch) if stop == None else stop
+    new_depth = batch.count(batch.is_base(b'ACGT.'))
+    quality = batch.is_base(b'ACGT') & (batch.quals > 1)
+    sites = np.arange(begin, stop)
+    lines = []
+    for i, quality_alts in zip(sites, batch.strings(quality, sites)):
+        if new_depth[i] >= mind:
+            nline, pcr_duplicate_track, fixed_alts, depth = call_alts(batch.chrom(i), batch.loc(i), batch.ref(i), int(new_depth[i]), quality_alts, germline, pcr_duplicate_track, fixed_alts, depth)
         else:
-            return vcf_line, pcr_duplicate_track, new_fixed_alts, new_depth #both old and new data, return it all
+            nline, depth = None, 0
+        if nline != None:
+            lines.append(nline)
+    return lines, fixed_alts, depth
+
+#the carry is not cleared by a new contig or by sites failing the depth filter, so the pileup can't simply be cut at contig boundaries.
+#it is however known to be empty after a site passing the depth filter when that site has no quality alternatives, or (without germline) when the depth
+#carried into it is below 8, since no base can then pass 2 <= basecount <= depth/4. A site failing the depth filter carries a depth of 0 into the next.
+#the carry after such a reset site is (None, its depth) whatever came before it, so the sites following it can be called without the rest of the file.
+def reset_sites(batch, mind, germline, before = 0):
+    #indeces of the reset sites of a batch, given the depth carried into its first site.
+    new_depth = batch.count(batch.is_base(b'ACGT.'))
+    passed = new_depth >= mind
+    carried = np.concatenate([[before], np.where(passed, new_depth, 0)[:-1]])
+    empty = batch.count(batch.is_base(b'ACGT') & (batch.quals > 1)) == 0
+    if not germline:
+        empty |= carried < 8
+    return np.flatnonzero(passed & empty)
+
+def carried_depth(batch, mind):
+    #depth carried out of the last site of a batch.
+    if len(batch) == 0:
+        return 0
+    last = int(batch.count(batch.is_base(b'ACGT.'))[-1])
+    return last if last >= mind else 0
+
+def following_blocks(path, pos, step = 1 << 16):
+    #newline aligned blocks of the file from byte pos on, growing in size, for reading only as far past the end of a range as needed.
+    with open(path, 'rb') as inf:
+        inf.seek(pos)
+        carry = b''
+        while True:
+            data = inf.read(step)
+            if not data:
+                if carry:
+                    yield carry + b'\n'
+                return
+            data = carry + data
+            cut = data.rfind(b'\n') + 1
+            carry = data[cut:]
+            if cut > 0:
+                yield data[:cut]
+            step *= 2
+
+#each worker process keeps its own threshold cache between ranges. Thresholds are seeded per key, so they are the same as a single process would compute.
+worker_track = None
+
+def init_worker(path, seed, backend, depth_cap = None):
+    global worker_track
+    worker_track = pcr_thresholds.ThresholdCache(path, seed = seed, backend = backend, depth_cap = depth_cap)
+
+def pool_call_range(args):
+    #call the sites of one byte range of the pileup from its first reset site on, continuing past the range end up to and including the first reset site there.
+    #the next range's worker starts after that same site, so joining the outputs in range order gives the single process output.
+    #the first range starts from the empty carry of the start of the file. Returns the vcf lines and the thresholds this worker had to compute.
+    path, start, end, mind, germline = args
+    known = len(worker_track)
+    batch = pileup_parser.single_sample(pileup_parser.parse_block(pileup_parser.read_range(path, start, end)), 'pileup_to_fshift_vcf')
+    if start == 0:
+        begin, fixalt, dep = 0, None, 0
     else:
-        return None, pcr_duplicate_track, fixed_alts, 0 #no information about this spot, ignore any new data coming from it and return unused old data so no mutations are thrown out.
+        before = carried_depth(pileup_parser.parse_block(pileup_parser.previous_line(path, start)), mind)
+        resets = reset_sites(batch, mind, germline, before)
+        if len(resets) == 0:
+            #the carry runs through this whole range; the worker of an earlier range calls it.
+            return [], list(worker_track.items())[known:]
+        begin, fixalt, dep = resets[0] + 1, None, int(batch.count(batch.is_base(b'ACGT.'))[resets[0]])
+    lines, fixalt, dep = call_sites(batch, mind, germline, worker_track, fixalt, dep, begin)
+    before = carried_depth(batch, mind)
+    for block in following_blocks(path, end):
+        batch = pileup_parser.parse_block(block)
+        resets = reset_sites(batch, mind, germline, before)
+        stop = resets[0] + 1 if len(resets) > 0 else len(batch)
+        more, fixalt, dep = call_sites(batch, mind, germline, worker_track, fixalt, dep, 0, stop)
+        lines.extend(more)
+        if len(resets) > 0:
+            break
+        before = carried_depth(batch, mind)
+    return lines, list(worker_track.items())[known:]
 
 def main():
     args = argparser()
     #insert code
-    if args.pileup == None:
-        pilein = sys.stdin
+    outf = output_writer.OutputWriter(args.output, args.bgzip, args.compress_threads, index = True)
+    output_writer.copy_header(args.header, outf)
+    pdt = pcr_thresholds.from_args(args)
+    ranged = args.pileup != None and os.path.isfile(args.pileup) and not bgzf.is_gzip(args.pileup)
+    if args.threads > 1 and not ranged and args.verbose:
+        print("--threads needs an uncompressed pileup file, using a single process", file = sys.stderr)
+    if args.threads > 1 and ranged:
+        #newline aligned byte ranges, called concurrently from their reset sites on; imap hands results back in range order, so the output keeps the pileup order.
+        tasks = [(args.pileup, start, end, args.mind, args.germline) for start, end in pileup_parser.split_ranges(args.pileup)]
+        with Pool(args.threads, initializer = init_worker, initargs = (args.thresholds, args.seed, args.backend, args.depth_cap)) as p:
+            for lines, found in p.imap(pool_call_range, tasks):
+                outf.write_lines(lines)
+                pdt.merge(found)
+            p.close()
+            p.join()
     else:
-        pilein = open(args.pileup)
-    if args.output == None:
-        outf = sys.stdout
-    else:
-        outf = open(args.output, 'w+')
-    # with open(args.output, 'w+') as outf:
-    with open(args.header) as tin:
-        for entry in tin:
-            print(entry.strip(), file = outf)
-    pdt = {}
-    fixalt = None
-    dep = 0
-    for entry in pilein:
-        nline, pdt, fixalt, dep = make_vcf_line(entry.strip().split(), args.mind, args.germline, pcr_duplicate_track=pdt, fixed_alts=fixalt, depth = dep)
-        if nline != None:
-            print(nline, file = outf)
-    if args.pileup != None:
-        pilein.close()
-    if args.output != None:
-        outf.close()
+        fixalt = None
+        dep = 0
+        for batch in pileup_parser.read_batches(args.pileup):
+            lines, fixalt, dep = call_sites(pileup_parser.single_sample(batch, 'pileup_to_fshift_vcf'), args.mind, args.germline, pdt, fixalt, dep)
+            outf.write_lines(lines)
+    pdt.save()
+    outf.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
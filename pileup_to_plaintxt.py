@@ -6,7 +6,10 @@
 import argparse
 import sys
 import numpy as np
-import statistics as st
+import pileup_parser
+import pcr_thresholds
+import profiler
+import output_writer
 
 #define functions/classes
 
@@ -14,135 +17,171 @@ def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     #parser.add_argument('-a', '--header', help = 'File containing header text for a vcf of the given reference genome.')
-    parser.add_argument('-p', '--pileup', help = 'Pileup to parse and force into a VCF format. Default is standard in', default = None)
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse; also takes an indexed BAM or CRAM with --reference. Default is standard in', default = None)
+    parser.add_argument('-f', '--reference', help = 'Reference fasta (with a .fai index) for BAM or CRAM input, which is read directly with pysam in place of a pileup (see bam_reader.py).', default = None)
     parser.add_argument('-o', '--output', help = 'Name of the text output file. Default is stdout', default = None)
     parser.add_argument('-g', '--germline', type = bool, help = 'Set to True to retain germline mutations. Default is False and ignores high frequency mutations', default = False)
     parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification. Default 50', default = 50)
     parser.add_argument('-i', '--sample_id', help = 'value for ID column', default = 'sample')
+    parser.add_argument('-n', '--names', nargs = '+', help = 'ID column values for the samples of a multi-sample pileup, in column order. Default the sample_id followed by 1, 2 and so on', default = None)
+    parser.add_argument('--per-sample', dest = 'per_sample', help = 'Write a separate file for each sample of the pileup, named this prefix plus the sample name plus .txt. Default is one output with the rows of every sample', default = None)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only process this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only process the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
     args = parser.parse_args()
     return args
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
-
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
-
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
 
-def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = {}, id = 'sample'):
+def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), id = 'sample'):
     #convert a stripped and split mpileup line into a fake vcf line, filling in default values.
     #pileup: chrom loc ref depth vector_of_alts vector_of_quals
     #vcf: chrom loc ID(.) ref alt qual filter info(dp=...)
     #minimalist entry looking at the docs is just "DP" in info, qual is ., id is ., filter is PASS. So try those.
     chrom, loc, ref, ndepth, vector_of_alts, vector_of_quals = spent
+    vector_of_alts, vector_of_quals = pileup_parser.clean_site(vector_of_alts, vector_of_quals) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     #real depth isn't depth, its the length of the vector of alts without other symbols or Ns, because most Ns are introduced by the consensus builder and not in the original reads.
     # pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
     basedepth = len([v for v in vector_of_alts if v in 'ACGT.'])
     if basedepth >= mind:# and ref != 'N':
-        depth = 0
-        altbase_counts = {}
         quality_alts = []
-        cleaner = [b for b in vector_of_alts if b in 'ACGTN.']
+        cleaner = vector_of_alts
         assert len(cleaner) == len(vector_of_quals)
         for i,b in enumerate(cleaner):
             if b in 'ACGT':
                 #check if the qual value is high enough.
                 if int(vector_of_quals[i]) > 1 and b != ref: #second rider is
                     quality_alts.append(b)
-                    depth += 1 #only count bases which have 2+ consensus representations as part of the depth
-                    altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
-        #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
-        #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
-        if not germline:
-            # for b in 'ACGT': #for all possible bases
-                # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
-                    # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
-            #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
-            skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-            dindeces = get_dindex(quality_alts)
-            pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
-            for base in 'ACGT':
-                basecount = quality_alts.count(base)
-                if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                    key = (len(quality_alts), basecount)
-                    if key not in pcr_duplicate_track:
-                        pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                    thresh = pcr_duplicate_track[key]
-                    if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                        #print("QC: Base is skipped for clustering")
-                        skip += base
-                        #still count it once though
-                        pcrc.append(base)
-                        altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
-                    #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
-                else:
-                    skip += base
-            #fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
-        #else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
-            #fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
-
-        if depth == 0 or len(quality_alts) == 0 or all([v < 2 for v in altbase_counts.values()]): #nothing but Ns here.
-            return None, pcr_duplicate_track
-        else:
-            choicebase = min([f for f,v in altbase_counts.items() if v > 1])
-            #report only the lowest one that has at least 2 representations.
-            vcf_line = chrom + '\t' + loc + '\t' + ref.upper() + '\t' + choicebase + '\t' + id
-            return vcf_line, pcr_duplicate_track
+        return call_alts(chrom, loc, ref, quality_alts, germline, pcr_duplicate_track, id)
     else:
         # if ref == 'N':
             # print("Ref is N, skipping", chrom, loc)
         return None, pcr_duplicate_track
 
+def call_alts(chrom, loc, ref, quality_alts, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), id = 'sample', dindeces = None):
+    #build the plaintext line from the quality filtered alternative bases of a site that passed the depth filter.
+    #split out of make_vcf_line so the batched reader in main can hand over sites it has already cleaned in numpy.
+    prof = profiler.active
+    start = prof.start()
+    depth = len(quality_alts) #only count bases which have 2+ consensus representations as part of the depth
+    altbase_counts = {}
+    for b in quality_alts:
+        altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
+    #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
+    #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
+    if not germline:
+        # for b in 'ACGT': #for all possible bases
+            # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
+                # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
+        #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
+        skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+        dindeces = pcr_thresholds.get_dindex(quality_alts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+        pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
+        for base in 'ACGT':
+            basecount = quality_alts.count(base)
+            if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+                key = (len(quality_alts), basecount)
+                thresh = pcr_duplicate_track[key]
+                if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                    #print("QC: Base is skipped for clustering")
+                    skip += base
+                    #still count it once though
+                    pcrc.append(base)
+                    prof.count('pcr_clusters')
+                    altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
+                #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
+            else:
+                skip += base
+        #fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
+    #else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
+        #fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
+    start = prof.lap('pcr_test', start)
+    if depth == 0 or len(quality_alts) == 0 or all([v < 2 for v in altbase_counts.values()]): #nothing but Ns here.
+        return None, pcr_duplicate_track
+    else:
+        choicebase = min([f for f,v in altbase_counts.items() if v > 1])
+        #report only the lowest one that has at least 2 representations.
+        vcf_line = chrom + '\t' + loc + '\t' + ref.upper() + '\t' + choicebase + '\t' + id
+        prof.lap('format', start)
+        return vcf_line, pcr_duplicate_track
+
+def call_batch(batch, mind = 50, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), id = 'sample'):
+    #apply the depth and quality filters of make_vcf_line to a whole pileup_parser batch at once, then only build lines for sites that can produce one.
+    return [line for i, line in call_sites(batch, mind, germline, pcr_duplicate_track, id)]
+
+def call_sites(batch, mind = 50, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), id = 'sample'):
+    #call_batch, returning (site index, line) pairs so the rows of several samples of the batch can be put in site order.
+    prof = profiler.active
+    start = prof.start()
+    basedepth = batch.count(batch.is_base(b'ACGT.'))
+    quality = batch.is_base(b'ACGT') & (batch.quals > 1) & (batch.bases != batch.base_ref())
+    counts = batch.base_counts(quality)
+    deep = basedepth >= mind
+    sites = np.flatnonzero(deep & (counts.max(axis = 1) >= 2))
+    alts = batch.strings(quality, sites)
+    #the pcr cluster gaps of all the sites in one go.
+    dindeces = [None] * len(sites) if germline else pcr_thresholds.site_dindeces(*batch.masked(quality), sites)
+    if prof.enabled:
+        prof.count('sites', len(batch))
+        prof.reject('depth', len(batch) - deep.sum())
+        prof.reject('quality', deep.sum() - len(sites))
+    prof.lap('filter', start)
+    lines = []
+    for i, quality_alts, dindex in zip(sites, alts, dindeces):
+        nline, pcr_duplicate_track = call_alts(batch.chrom(i), batch.loc(i), batch.ref(i), quality_alts, germline, pcr_duplicate_track=pcr_duplicate_track, id = id, dindeces = dindex)
+        if nline != None:
+            lines.append((i, nline))
+        else:
+            prof.reject('pcr_cluster')
+    return lines
+
+def call_samples(batch, mind = 50, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), ids = ['sample']):
+    #the rows of every sample of a multi-sample batch in one list, in site order and then sample order, each with its sample's ID.
+    rows = []
+    for k, id in enumerate(ids):
+        rows.extend([(i, k, line) for i, line in call_sites(batch.sample(k), mind, germline, pcr_duplicate_track, id)])
+    rows.sort(key = lambda x:x[:2])
+    return [line for i, k, line in rows]
+
 def main():
     args = argparser()
     #insert code
-    if args.pileup == None:
-        pilein = sys.stdin
-    else:
-        pilein = open(args.pileup)
-    if args.output == None:
+    if args.per_sample != None:
+        outf = None #opened per sample once the first batch gives the number of samples.
+    elif args.output == None:
         outf = sys.stdout
     else:
         outf = open(args.output, 'w+')
     # with open(args.output, 'w+') as outf:
 
-    pdt = {}
-    for entry in pilein:
-        nline, pdt = make_vcf_line(entry.strip().split(), args.mind, args.germline, pcr_duplicate_track=pdt, id = args.sample_id)
-        if nline != None:
-            print(nline, file = outf)
-    if args.pileup != None:
-        pilein.close()
-    if args.output != None:
+    pdt = pcr_thresholds.from_args(args)
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pdt)
+    outfs = None
+    for batch in prof.timed(pileup_parser.read_batches(args.pileup, pileup_parser.get_regions(args.region, args.regions_bed), require = b'ACGT', reference = args.reference), 'parse'):
+        if batch.nsamples == 1:
+            ids = [args.sample_id] if args.names == None else args.names
+        else:
+            ids = pileup_parser.sample_names(batch.nsamples, args.names, args.sample_id)
+        if args.per_sample != None:
+            if outfs == None:
+                outfs = [open(output_writer.sample_path(args.per_sample, id, '.txt'), 'w+') for id in ids]
+            outputs = [call_batch(batch.sample(k), args.mind, args.germline, pdt, id) for k, id in enumerate(ids)]
+        else:
+            outfs = [outf]
+            outputs = [call_batch(batch, args.mind, args.germline, pdt, ids[0]) if batch.nsamples == 1 else call_samples(batch, args.mind, args.germline, pdt, ids)]
+        start = prof.start()
+        for out, lines in zip(outfs, outputs):
+            for nline in lines:
+                print(nline, file = out)
+        prof.lap('write', start)
+    pdt.save()
+    if args.per_sample != None:
+        for out in (outfs or []):
+            out.close()
+    elif args.output != None:
         outf.close()
+    if args.profile != None:
+        prof.report(args.profile, 'pileup_to_plaintxt')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
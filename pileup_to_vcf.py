@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
 #this script creates a custom 'vcf' without doing genotyping for circleseq output. Takes a samtools mpileup and a header text file (which can be obtained by creating a vcf output with mpileup, -uv, and grepping the # lines.)
+#a multi-sample mpileup (samtools mpileup with several bams) is called sample by sample with the same filters, from a single read of the pileup,
+#into one vcf with a column per sample or, with --per-sample, into one ordinary vcf per sample.
 
 #import
 import argparse
+import os
 import sys
 import numpy as np
-import statistics as st
+from multiprocessing import Pool
+import pileup_parser
+import bgzf
+import pcr_thresholds
+import profiler
+import output_writer
+import checkpoint
 
 #define functions/classes
 
@@ -14,137 +23,294 @@ def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     parser.add_argument('-a', '--header', help = 'File containing header text for a vcf of the given reference genome.')
-    parser.add_argument('-p', '--pileup', help = 'Pileup to parse and force into a VCF format. Default is standard in', default = None)
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse and force into a VCF format; also takes an indexed BAM or CRAM with --reference. Default is standard in', default = None)
+    parser.add_argument('-f', '--reference', help = 'Reference fasta (with a .fai index) for BAM or CRAM input, which is read directly with pysam in place of a pileup (see bam_reader.py).', default = None)
     parser.add_argument('-o', '--output', help = 'Name of the vcf output file. Default is stdout', default = None)
     parser.add_argument('-g', '--germline', type = bool, help = 'Set to True to retain germline mutations. Default is False and ignores high frequency mutations', default = False)
     parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification. Default 10', default = 10)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('-t', '--threads', type = int, help = 'Number of processes to call sites with. Requires an uncompressed pileup file (-p), not a store, and no regions; output order and content match a single process run. Default 1', default = 1)
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only process this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only process the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--cap-report', dest = 'cap_report', action = 'store_true', help = 'Also call every site with exact thresholds and report to stderr how many calls the --depth-cap changes, and how many thresholds each mode computed. Single process only')
+    parser.add_argument('-z', '--bgzip', action = 'store_true', help = 'Write the output as BGZF with a tabix (.tbi) index. Implied by an output name ending in .gz or .bgz')
+    parser.add_argument('--compress-threads', dest = 'compress_threads', type = int, help = 'Number of threads compressing BGZF output. Default 1', default = 1)
+    parser.add_argument('-n', '--names', nargs = '+', help = 'Names of the samples of a multi-sample pileup, in column order. Default sample1, sample2 and so on', default = None)
+    parser.add_argument('--per-sample', dest = 'per_sample', help = 'Write a separate vcf for each sample of the pileup, named this prefix plus the sample name plus .vcf, instead of one vcf with a column per sample. -o is ignored', default = None)
+    parser.add_argument('--checkpoint-interval', dest = 'checkpoint_interval', type = int, help = 'Seconds between checkpoints (see checkpoint.py), saved as the output name plus .ckpt (the --per-sample prefix plus vcf.ckpt). Needs an uncompressed pileup file without regions and uncompressed output files. Default is no checkpoints (every 600 seconds with --resume)', default = None)
+    parser.add_argument('--resume', action = 'store_true', help = 'Continue an interrupted run with the same arguments from its last checkpoint.')
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
     args = parser.parse_args()
     return args
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
-
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
-
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
-
-def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = {}):
+
+def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
     #convert a stripped and split mpileup line into a fake vcf line, filling in default values.
     #pileup: chrom loc ref depth vector_of_alts vector_of_quals
     #vcf: chrom loc ID(.) ref alt qual filter info(dp=...)
     #minimalist entry looking at the docs is just "DP" in info, qual is ., id is ., filter is PASS. So try those.
     chrom, loc, ref, ndepth, vector_of_alts, vector_of_quals = spent
+    vector_of_alts, vector_of_quals = pileup_parser.clean_site(vector_of_alts, vector_of_quals) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     #real depth isn't depth, its the length of the vector of alts without other symbols or Ns, because most Ns are introduced by the consensus builder and not in the original reads.
     # pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
     basedepth = len([v for v in vector_of_alts if v in 'ACGT.'])
     if basedepth >= mind:# and ref != 'N':
-        depth = 0
-        altbase_counts = {}
         quality_alts = []
-        cleaner = [b for b in vector_of_alts if b in 'ACGTN.']
+        cleaner = vector_of_alts
         assert len(cleaner) == len(vector_of_quals)
         for i,b in enumerate(cleaner):
             if b in 'ACGT':
                 #check if the qual value is high enough.
                 if int(vector_of_quals[i]) > 1 and b != ref: #second rider is
                     quality_alts.append(b)
-                    depth += 1 #only count bases which have 2+ consensus representations as part of the depth
-                    altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
-        #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
-        #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
-        if not germline:
-            # for b in 'ACGT': #for all possible bases
-                # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
-                    # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
-            #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
-            skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-            dindeces = get_dindex(quality_alts)
-            pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
-            for base in 'ACGT':
-                basecount = quality_alts.count(base)
-                if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                    key = (len(quality_alts), basecount)
-                    if key not in pcr_duplicate_track:
-                        pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                    thresh = pcr_duplicate_track[key]
-                    if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                        #print("QC: Base is skipped for clustering")
-                        skip += base
-                        #still count it once though
-                        pcrc.append(base)
-                        altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
-                    #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
-                else:
-                    skip += base
-        #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
-            fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
-        else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
-            fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
-        aacountstr = ','.join([str(v) for k,v in sorted(altbase_counts.items())])
-        if depth == 0 or len(quality_alts) == 0 or all([v < 2 for v in altbase_counts.values()]): #nothing but Ns here.
-            return None, pcr_duplicate_track
-        else:
-            # choicebase, choicecount = min([(k,v) for k,v in altbase_counts.items() if v > 1], key = lambda x:x[1])
-            #report only the lowest one that has at least 2 representations.
-            vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(depth) + ';AC=' + aacountstr
-            return vcf_line, pcr_duplicate_track
+        return call_alts(chrom, loc, ref, quality_alts, germline, pcr_duplicate_track)
     else:
         # if ref == 'N':
             # print("Ref is N, skipping", chrom, loc)
         return None, pcr_duplicate_track
 
+def call_alts(chrom, loc, ref, quality_alts, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), dindeces = None):
+    #build the vcf line from the quality filtered alternative bases of a site that passed the depth filter.
+    #split out of make_vcf_line so the batched reader in main can hand over sites it has already cleaned in numpy.
+    prof = profiler.active
+    start = prof.start()
+    depth = len(quality_alts) #only count bases which have 2+ consensus representations as part of the depth
+    altbase_counts = {}
+    for b in quality_alts:
+        altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
+    #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
+    #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
+    if not germline:
+        # for b in 'ACGT': #for all possible bases
+            # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
+                # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
+        #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
+        skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+        dindeces = pcr_thresholds.get_dindex(quality_alts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+        pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
+        for base in 'ACGT':
+            basecount = quality_alts.count(base)
+            if 2 <= basecount <= depth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+                key = (len(quality_alts), basecount)
+                thresh = pcr_duplicate_track[key]
+                if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                    #print("QC: Base is skipped for clustering")
+                    skip += base
+                    #still count it once though
+                    pcrc.append(base)
+                    prof.count('pcr_clusters')
+                    altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
+                #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
+            else:
+                skip += base
+    #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
+        fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
+    else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
+        fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
+    aacountstr = ','.join([str(v) for k,v in sorted(altbase_counts.items())])
+    start = prof.lap('pcr_test', start)
+    if depth == 0 or len(quality_alts) == 0 or all([v < 2 for v in altbase_counts.values()]): #nothing but Ns here.
+        return None, pcr_duplicate_track
+    else:
+        # choicebase, choicecount = min([(k,v) for k,v in altbase_counts.items() if v > 1], key = lambda x:x[1])
+        #report only the lowest one that has at least 2 representations.
+        vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(depth) + ';AC=' + aacountstr
+        prof.lap('format', start)
+        return vcf_line, pcr_duplicate_track
+
+def call_batch(batch, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
+    #apply the depth and quality filters of make_vcf_line to a whole pileup_parser batch at once, then only build lines for sites that can produce one.
+    return [line for i, line in call_sites(batch, mind, germline, pcr_duplicate_track)]
+
+def call_sites(batch, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
+    #call_batch, returning (site index, line) pairs so the calls of several samples of the batch can be lined up.
+    prof = profiler.active
+    start = prof.start()
+    basedepth = batch.count(batch.is_base(b'ACGT.'))
+    quality = batch.is_base(b'ACGT') & (batch.quals > 1) & (batch.bases != batch.base_ref())
+    counts = batch.base_counts(quality)
+    deep = basedepth >= mind
+    sites = np.flatnonzero(deep & (counts.max(axis = 1) >= 2))
+    alts = batch.strings(quality, sites)
+    #the pcr cluster gaps of all the sites in one go.
+    dindeces = [None] * len(sites) if germline else pcr_thresholds.site_dindeces(*batch.masked(quality), sites)
+    if prof.enabled:
+        prof.count('sites', len(batch))
+        prof.reject('depth', len(batch) - deep.sum())
+        prof.reject('quality', deep.sum() - len(sites))
+    prof.lap('filter', start)
+    lines = []
+    for i, quality_alts, dindex in zip(sites, alts, dindeces):
+        nline, pcr_duplicate_track = call_alts(batch.chrom(i), batch.loc(i), batch.ref(i), quality_alts, germline, pcr_duplicate_track=pcr_duplicate_track, dindeces = dindex)
+        if nline != None:
+            lines.append((i, nline))
+        else:
+            #every alternative seen twice was collapsed as a pcr cluster.
+            prof.reject('pcr_cluster')
+    return lines
+
+def vcf_records(chunks, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), header = '', mind = 10, germline = False):
+    #pipeline stage (see pileup_pipeline.py): the lines of the header file, then the vcf lines of call_batch for each chunk of sites, as split records.
+    #it ends a pipeline, since what it hands on is a vcf rather than pileup records.
+    assert header != '', 'the pileup_to_vcf stage needs a header file, given as header=path'
+    with open(header) as tin:
+        yield [[entry.strip()] for entry in tin]
+    for chunk in chunks:
+        yield [line.split('\t') for line in call_batch(pileup_parser.as_batch(chunk, 'pileup_to_vcf'), mind, germline, pcr_duplicate_track)]
+
+SAMPLE_META = ['##INFO=<ID=NS,Number=1,Type=Integer,Description="Number of samples with a call">',
+    '##FORMAT=<ID=AL,Number=.,Type=String,Description="Alternative alleles called in the sample">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Quality alternative bases of the sample">',
+    '##FORMAT=<ID=AC,Number=.,Type=Integer,Description="Count of each quality alternative base of the sample">']
+
+def merge_samples(calls):
+    #join the call_sites results of each sample of a batch into multi-sample vcf lines, one per site called in any sample.
+    #ALT is the union of the sample alternatives and INFO has the summed depth and the number of samples called;
+    #each sample column holds the ALT, DP and AC of its own single sample line, or . without a call.
+    called = [dict(c) for c in calls]
+    lines = []
+    for i in sorted(set().union(*called)):
+        alts = set()
+        depth = 0
+        columns = []
+        for sample in called:
+            if i not in sample:
+                columns.append('.')
+                continue
+            fields = sample[i].split('\t')
+            dp, ac = fields[7].split(';')
+            alts.update([a for a in fields[4].split(',') if a])
+            depth += int(dp[3:])
+            columns.append(fields[4] + ':' + dp[3:] + ':' + ac[3:])
+        info = 'DP=' + str(depth) + ';NS=' + str(len(columns) - columns.count('.'))
+        lines.append('\t'.join(fields[:4] + [','.join(sorted(alts)), '.', 'PASS', info, 'AL:DP:AC'] + columns))
+    return lines
+
+def call_outputs(batch, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), per_sample = False):
+    #the lines of each output for a batch: one list for a single sample pileup or a multi-sample vcf, or one list per sample.
+    if batch.nsamples == 1:
+        return [call_batch(batch, mind, germline, pcr_duplicate_track)]
+    calls = [call_sites(batch.sample(k), mind, germline, pcr_duplicate_track) for k in range(batch.nsamples)]
+    if per_sample:
+        return [[line for i, line in c] for c in calls]
+    start = profiler.active.start()
+    lines = merge_samples(calls)
+    profiler.active.lap('format', start)
+    return [lines]
+
+def make_outputs(args, nsamples, resume = None):
+    #the output writers for a pileup of nsamples samples, with their headers written, or reopened at the byte sizes of a checkpoint.
+    names = pileup_parser.sample_names(nsamples, args.names)
+    if args.per_sample != None:
+        paths = [output_writer.sample_path(args.per_sample, name, '.vcf', args.bgzip) for name in names]
+    else:
+        paths = [args.output]
+    if resume != None:
+        return [output_writer.OutputWriter(path, args.bgzip, args.compress_threads, index = True, resume = size) for path, size in zip(paths, resume)]
+    outfs = [output_writer.OutputWriter(path, args.bgzip, args.compress_threads, index = True) for path in paths]
+    for outf in outfs:
+        output_writer.copy_header(args.header, outf, names if nsamples > 1 and args.per_sample == None else None, SAMPLE_META)
+    return outfs
+
+#each worker process keeps its own threshold cache between ranges. Thresholds are seeded per key, so they are the same as a single process would compute.
+worker_track = None
+
+def init_worker(path, seed, backend, profile = False, depth_cap = None):
+    global worker_track
+    worker_track = pcr_thresholds.ThresholdCache(path, seed = seed, backend = backend, depth_cap = depth_cap)
+    if profile:
+        profiler.enable().watch(worker_track)
+
+def pool_call_range(args):
+    #call the sites of one byte range of the pileup; returns the number of samples and the vcf lines of each output plus the thresholds this worker had to compute, for the main process cache,
+    #and the profile numbers of the range when profiling.
+    path, start, end, mind, germline, per_sample = args
+    known = len(worker_track)
+    prof = profiler.active
+    began = prof.start()
+    batch = pileup_parser.parse_block(pileup_parser.read_range(path, start, end), require = b'ACGT')
+    prof.lap('parse', began)
+    outputs = call_outputs(batch, mind, germline, worker_track, per_sample) if len(batch) > 0 else None
+    return batch.nsamples, outputs, list(worker_track.items())[known:], prof.take() if prof.enabled else None
+
 def main():
     args = argparser()
     #insert code
-    if args.pileup == None:
-        pilein = sys.stdin
+    pdt = pcr_thresholds.from_args(args)
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pdt)
+    per_sample = args.per_sample != None
+    if args.cap_report:
+        assert args.threads == 1, '--cap-report runs in a single process'
+    report = pcr_thresholds.CapReport(args) if args.cap_report else None
+    #the number of samples is only known from the first batch, so the outputs are opened then.
+    outfs = None
+    regions = pileup_parser.get_regions(args.region, args.regions_bed)
+    ranged = args.pileup != None and regions == None and os.path.isfile(args.pileup) and not bgzf.is_gzip(args.pileup) and not pileup_parser.is_alignment(args.pileup)
+    first = args.output if args.per_sample == None else args.per_sample + 'vcf'
+    ckpt = None
+    offset = 0
+    if checkpoint.supported(args.pileup, [first], regions, args.bgzip) and (checkpoint.interval(args) > 0 or args.resume):
+        ckpt = checkpoint.Checkpoint(checkpoint.checkpoint_path(first), args, [pdt], checkpoint.interval(args))
+    if args.resume:
+        assert ckpt != None, '--resume needs an uncompressed pileup file without regions and uncompressed output files'
+        state = ckpt.load()
+        if state != None:
+            offset = state['input_offset']
+            outfs = make_outputs(args, state['extra'], state['output_offsets'])
+            if args.verbose:
+                print("Resuming from byte", offset, "of", args.pileup, file = sys.stderr)
+        elif args.verbose:
+            print("No checkpoint to resume from, starting from the beginning", file = sys.stderr)
+    if args.threads > 1 and not ranged and args.verbose:
+        print("--threads needs an uncompressed pileup file without regions, using a single process", file = sys.stderr)
+    if args.threads > 1 and ranged:
+        #split the file into newline aligned byte ranges; imap hands results back in range order, so the output keeps the pileup order.
+        ranges = pileup_parser.split_ranges(args.pileup, start = offset)
+        tasks = [(args.pileup, start, end, args.mind, args.germline, per_sample) for start, end in ranges]
+        #leaving the with block on an error in a worker or the writer terminates the workers; close and join let them finish otherwise.
+        with Pool(args.threads, initializer = init_worker, initargs = (args.thresholds, args.seed, args.backend, prof.enabled, args.depth_cap)) as p:
+            for (nsamples, outputs, found, taken), (start, end) in zip(p.imap(pool_call_range, tasks), ranges):
+                outfs = make_outputs(args, nsamples) if outfs == None else outfs
+                began = prof.start()
+                for outf, lines in zip(outfs, outputs or []):
+                    outf.write_lines(lines)
+                prof.lap('write', began)
+                pdt.merge(found)
+                if taken != None:
+                    prof.merge(taken)
+                if ckpt != None and ckpt.due():
+                    ckpt.save(end, outfs, nsamples)
+            p.close()
+            p.join()
     else:
-        pilein = open(args.pileup)
-    if args.output == None:
-        outf = sys.stdout
-    else:
-        outf = open(args.output, 'w+')
-    # with open(args.output, 'w+') as outf:
-    with open(args.header) as tin:
-        for entry in tin:
-            print(entry.strip(), file = outf)
-    pdt = {}
-    for entry in pilein:
-        nline, pdt = make_vcf_line(entry.strip().split(), args.mind, args.germline, pcr_duplicate_track=pdt)
-        if nline != None:
-            print(nline, file = outf)
-    if args.pileup != None:
-        pilein.close()
-    if args.output != None:
+        if ckpt != None:
+            batches = pileup_parser.iter_offset_batches(args.pileup, offset, require = b'ACGT')
+        else:
+            batches = ((batch, None) for batch in pileup_parser.read_batches(args.pileup, regions, require = b'ACGT', reference = args.reference))
+        for batch, end in prof.timed(batches, 'parse'):
+            outfs = make_outputs(args, batch.nsamples) if outfs == None else outfs
+            outputs = call_outputs(batch, args.mind, args.germline, pdt, per_sample)
+            if report != None:
+                for exact_lines, lines in zip(call_outputs(batch, args.mind, args.germline, report.exact_track, per_sample), outputs):
+                    report.compare([line.split('\t') for line in exact_lines], [line.split('\t') for line in lines])
+            start = prof.start()
+            for outf, lines in zip(outfs, outputs):
+                outf.write_lines(lines)
+            prof.lap('write', start)
+            if ckpt != None and ckpt.due():
+                ckpt.save(end, outfs, batch.nsamples)
+    if outfs == None:
+        #nothing was read; write the header alone.
+        outfs = make_outputs(args, 1 if args.names == None else len(args.names))
+    pdt.save()
+    for outf in outfs:
         outf.close()
+    if ckpt != None:
+        ckpt.finish()
+    if report != None:
+        report.report(pdt)
+    if args.profile != None:
+        prof.report(args.profile, 'pileup_to_vcf')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -6,7 +6,10 @@
 import argparse
 import sys
 import numpy as np
-import statistics as st
+import pileup_parser
+import pcr_thresholds
+import profiler
+import output_writer
 
 #define functions/classes
 
@@ -14,134 +17,150 @@ def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     parser.add_argument('-a', '--header', help = 'File containing header text for a vcf of the given reference genome.')
-    parser.add_argument('-p', '--pileup', help = 'Pileup to parse and force into a VCF format. Default is standard in', default = None)
+    parser.add_argument('-p', '--pileup', help = 'Pileup (or site store directory from site_store.py) to parse and force into a VCF format; also takes an indexed BAM or CRAM with --reference. Default is standard in', default = None)
+    parser.add_argument('-f', '--reference', help = 'Reference fasta (with a .fai index) for BAM or CRAM input, which is read directly with pysam in place of a pileup (see bam_reader.py).', default = None)
     parser.add_argument('-o', '--output', help = 'Name of the vcf output file. Default is stdout', default = None)
     parser.add_argument('-g', '--germline', type = bool, help = 'Set to True to retain germline mutations. Default is False and ignores high frequency mutations', default = False)
     parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification. Default 10', default = 10)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('-z', '--bgzip', action = 'store_true', help = 'Write the output as BGZF with a tabix (.tbi) index. Implied by an output name ending in .gz or .bgz')
+    parser.add_argument('--compress-threads', dest = 'compress_threads', type = int, help = 'Number of threads compressing BGZF output. Default 1', default = 1)
+    parser.add_argument('-n', '--names', nargs = '+', help = 'Names of the samples of a multi-sample pileup, in column order. Default sample1, sample2 and so on', default = None)
+    parser.add_argument('--per-sample', dest = 'per_sample', help = 'Write a separate vcf for each sample of the pileup, named this prefix plus the sample name plus .vcf. Needed for multi-sample pileups, since SNPGenie reads single sample vcfs. -o is ignored', default = None)
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
     args = parser.parse_args()
     return args
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
-
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
 
-def perm_index(leng = 100, num = 3, pnum = 1000):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,5)
-
-def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = {}):
+def make_vcf_line(spent, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
     #convert a stripped and split mpileup line into a fake vcf line, filling in default values.
     #pileup: chrom loc ref depth vector_of_alts vector_of_quals
     #vcf: chrom loc ID(.) ref alt qual filter info(dp=...)
     #minimalist entry looking at the docs is just "DP" in info, qual is ., id is ., filter is PASS. So try those.
     chrom, loc, ref, ndepth, vector_of_alts, vector_of_quals = spent
+    vector_of_alts, vector_of_quals = pileup_parser.clean_site(vector_of_alts, vector_of_quals) #the ACGTN. reads, folded to the forward strand, without read marks or indel sequences.
     #real depth isn't depth, its the length of the vector of alts without other symbols or Ns, because most Ns are introduced by the consensus builder and not in the original reads.
     # pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
     basedepth = len([v for v in vector_of_alts if v in 'ACGT.'])
     if basedepth >= mind and ref != 'N':
-        depth = 0
-        altbase_counts = {}
         quality_alts = []
-        cleaner = [b for b in vector_of_alts if b in 'ACGTN.']
+        cleaner = vector_of_alts
         assert len(cleaner) == len(vector_of_quals)
         for i,b in enumerate(cleaner):
             if b in 'ACGT':
                 #check if the qual value is high enough.
                 if int(vector_of_quals[i]) > 1:
                     quality_alts.append(b)
-                    depth += 1 #only count bases which have 2+ consensus representations as part of the depth
-                    altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
-        #altbase_counts[ref] = basedepth - sum(altbase_counts.values()) #the rest of basedepth are all reference and need to be accounted as such
-        #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
-        #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
-        if not germline:
-            # for b in 'ACGT': #for all possible bases
-                # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
-                    # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
-            #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
-            skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
-            dindeces = get_dindex(quality_alts)
-            pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
-            for base in 'ACGT':
-                basecount = quality_alts.count(base)
-                if 2 <= basecount <= basedepth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                    key = (len(quality_alts), basecount)
-                    if key not in pcr_duplicate_track:
-                        pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1])
-                    thresh = pcr_duplicate_track[key]
-                    if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                        #print("QC: Base is skipped for clustering")
-                        skip += base
-                        #still count it once though
-                        pcrc.append(base)
-                        altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
-                    #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
-                else:
+        return call_alts(chrom, loc, ref, basedepth, quality_alts, germline, pcr_duplicate_track)
+    else:
+        return None, pcr_duplicate_track
+
+def call_alts(chrom, loc, ref, basedepth, quality_alts, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), dindeces = None):
+    #build the SNPGenie vcf line from the quality filtered alternative bases of a site that passed the depth and reference filters.
+    #split out of make_vcf_line so the batched reader in main can hand over sites it has already cleaned in numpy.
+    prof = profiler.active
+    start = prof.start()
+    depth = len(quality_alts) #only count bases which have 2+ consensus representations as part of the depth
+    altbase_counts = {}
+    for b in quality_alts:
+        altbase_counts[b] = altbase_counts.get(b,0) + 1 #count the number of altbases per quality base.
+    #altbase_counts[ref] = basedepth - sum(altbase_counts.values()) #the rest of basedepth are all reference and need to be accounted as such
+    #in quality alts, the majority or entirety of the set may all be the same base, which happens when its a germline mutation.
+    #note that I can't distinguish germline from somatic at low depths, but with Wri datasets at higher ones I can.
+    if not germline:
+        # for b in 'ACGT': #for all possible bases
+            # if quality_alts.count(b) > depth/4: #if that base is more than 25% of seen bases at this point
+                # quality_alts = [base for base in quality_alts if base != b] #remove it, it's almost certainly a germline mutation.
+        #if I'm removing germline I can apply an additional filter which should remove PCR duplicates
+        skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflation.
+        dindeces = pcr_thresholds.get_dindex(quality_alts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+        pcrc = [] #bases which appear to be in a pcr duplicate cluster get a copy here and then skipped by the main iterator
+        for base in 'ACGT':
+            basecount = quality_alts.count(base)
+            if 2 <= basecount <= basedepth/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+                key = (len(quality_alts), basecount)
+                thresh = pcr_duplicate_track[key]
+                if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                    #print("QC: Base is skipped for clustering")
                     skip += base
-        #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
-            fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
-        else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
-            fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
-        aacountstr = ','.join([str(v/basedepth) for k,v in sorted(altbase_counts.items())])
-        if depth == 0 or len(fixed_alts) == 0: #nothing but Ns or reference here.
-            return None, pcr_duplicate_track
+                    #still count it once though
+                    pcrc.append(base)
+                    prof.count('pcr_clusters')
+                    altbase_counts[base] = 1 #set its count representation to 1. Note that all members are still counted separately for depth.
+                #if a base exists at appropriate levels but stays above the cluster threshold, it's collected in the fixed alts statement below
+            else:
+                skip += base
+    #collect individual bases not counted as a pcr cluster, plus a singleton of each cluster base
+        fixed_alts = ','.join(sorted(list(set(pcrc + [q for q in quality_alts if q not in skip])))) #save in order ACGT
+    else: #retain higher frequencies, including PCR clusters which are indistinguishable from higher frequency mutations.
+        fixed_alts = ','.join(sorted(list(set(quality_alts)))) #save in order ACGT
+    aacountstr = ','.join([str(v/basedepth) for k,v in sorted(altbase_counts.items())])
+    start = prof.lap('pcr_test', start)
+    if depth == 0 or len(fixed_alts) == 0: #nothing but Ns or reference here.
+        return None, pcr_duplicate_track
+    else:
+        vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(basedepth) + ';AF=' + aacountstr
+        prof.lap('format', start)
+        return vcf_line, pcr_duplicate_track
+
+def call_batch(batch, mind = 10, germline = False, pcr_duplicate_track = pcr_thresholds.ThresholdCache()):
+    #apply the depth, reference and quality filters of make_vcf_line to a whole pileup_parser batch at once, then only build lines for sites that can produce one.
+    prof = profiler.active
+    start = prof.start()
+    basedepth = batch.count(batch.is_base(b'ACGT.'))
+    quality = batch.is_base(b'ACGT') & (batch.quals > 1)
+    deep = (basedepth >= mind) & (batch.refs != ord('N'))
+    sites = np.flatnonzero(deep & (batch.count(quality) > 0))
+    alts = batch.strings(quality, sites)
+    #the pcr cluster gaps of all the sites in one go.
+    dindeces = [None] * len(sites) if germline else pcr_thresholds.site_dindeces(*batch.masked(quality), sites, basedepth[sites])
+    if prof.enabled:
+        prof.count('sites', len(batch))
+        prof.reject('depth', len(batch) - deep.sum())
+        prof.reject('quality', deep.sum() - len(sites))
+    prof.lap('filter', start)
+    lines = []
+    for i, quality_alts, dindex in zip(sites, alts, dindeces):
+        nline, pcr_duplicate_track = call_alts(batch.chrom(i), batch.loc(i), batch.ref(i), int(basedepth[i]), quality_alts, germline, pcr_duplicate_track=pcr_duplicate_track, dindeces = dindex)
+        if nline != None:
+            lines.append(nline)
         else:
-            vcf_line = chrom + '\t' + loc + '\t.\t' + ref + '\t' + fixed_alts + '\t.\tPASS\tDP=' + str(basedepth) + ';AF=' + aacountstr
-            return vcf_line, pcr_duplicate_track
+            prof.reject('pcr_cluster')
+    return lines
+
+def make_outputs(args, nsamples):
+    #the output writer, or with --per-sample one per sample of the pileup, with their headers written.
+    assert nsamples == 1 or args.per_sample != None, 'a multi-sample pileup needs --per-sample'
+    if args.per_sample == None:
+        paths = [args.output]
     else:
-        return None, pcr_duplicate_track
+        paths = [output_writer.sample_path(args.per_sample, name, '.vcf', args.bgzip) for name in pileup_parser.sample_names(nsamples, args.names)]
+    outfs = [output_writer.OutputWriter(path, args.bgzip, args.compress_threads, index = True) for path in paths]
+    for outf in outfs:
+        output_writer.copy_header(args.header, outf)
+    return outfs
 
 def main():
     args = argparser()
     #insert code
-    if args.pileup == None:
-        pilein = sys.stdin
-    else:
-        pilein = open(args.pileup)
-    if args.output == None:
-        outf = sys.stdout
-    else:
-        outf = open(args.output, 'w+')
-    # with open(args.output, 'w+') as outf:
-    with open(args.header) as tin:
-        for entry in tin:
-            print(entry.strip(), file = outf)
-    pdt = {}
-    for entry in pilein:
-        nline, pdt = make_vcf_line(entry.strip().split(), args.mind, args.germline, pcr_duplicate_track=pdt)
-        if nline != None:
-            print(nline, file = outf)
-    if args.pileup != None:
-        pilein.close()
-    if args.output != None:
+    pdt = pcr_thresholds.from_args(args)
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pdt)
+    #the number of samples is only known from the first batch, so the outputs are opened then.
+    outfs = None
+    for batch in prof.timed(pileup_parser.read_batches(args.pileup, require = b'ACGT', reference = args.reference), 'parse'):
+        outfs = make_outputs(args, batch.nsamples) if outfs == None else outfs
+        for k, outf in enumerate(outfs):
+            lines = call_batch(batch.sample(k), args.mind, args.germline, pdt)
+            start = prof.start()
+            outf.write_lines(lines)
+            prof.lap('write', start)
+    if outfs == None:
+        outfs = make_outputs(args, 1 if args.names == None else len(args.names))
+    pdt.save()
+    for outf in outfs:
         outf.close()
+    if args.profile != None:
+        prof.report(args.profile, 'pileup_to_vcf_snpg')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
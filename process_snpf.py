@@ -8,6 +8,7 @@ from sqlite3 import OperationalError
 import pandas as pd
 from multiprocessing import Pool
 import sys
+import bgzf
 #define functions/classes
 translate = {'TTT':'F','TTC':'F','TTA':'L','TTG':'L','TCT':'S','TCC':'S','TCA':'S','TCG':'S',
             'TAT':'Y','TAC':'Y','TAA':'Stop','TAG':'Stop','TGT':'C','TGC':'C','TGA':'Stop','TGG':'W',
@@ -26,10 +27,7 @@ def parse_annvars(path):
     '''
     variants = {}
     novariant_depth = 0
-    if path == None:
-        inf = sys.stdin
-    else:
-        inf = open(path)
+    inf = bgzf.open_input(path) #plain, gzip or BGZF, from standard in when path is None.
     for entry in inf:
         if entry[0] != '#':
             var_pres = False
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#stage level profiling for the pileup scripts, switched on with their --profile option.
+#a run records the wall time and number of calls of each stage (parsing, the depth and quality filters, the PCR cluster test, formatting the output lines, writing them),
+#the number of sites rejected by each filter, and the hits and misses of the PCR duplicate threshold caches,
+#then prints a summary table to stderr and writes the same numbers as json at exit.
+#with worker processes (pileup_to_vcf --threads) the stage times are summed over the workers, so they can add up to more than the wall time.
+#the scripts always call the module level active profile; it is a NullProfile whose methods do nothing unless enable() was called, so a run without --profile only pays for a few empty calls per batch and per called site.
+
+#import
+import json
+import sys
+import time
+
+#define functions/classes
+
+class NullProfile:
+    '''
+    Stand in for Profile when profiling is off. Every method does nothing.
+    '''
+    enabled = False
+
+    def start(self):
+        return 0
+
+    def lap(self, stage, start):
+        return 0
+
+    def count(self, name, n = 1):
+        pass
+
+    def reject(self, name, n = 1):
+        pass
+
+    def watch(self, cache):
+        pass
+
+    def timed(self, iterable, stage):
+        return iterable
+
+class Profile:
+    '''
+    Cumulative stage timings and counters of one run.
+    Stage times are added with lap(stage, start), where start is the value of an earlier start() or lap(), so consecutive stages can be timed with one clock read each.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.began = time.perf_counter()
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+        self.rejected = {}
+        self.caches = []
+        self.cache_base = [0, 0, 0.0] #cache totals already handed over by take().
+        self.cache_extra = [0, 0, 0.0] #cache totals merged in from worker processes.
+
+    def start(self):
+        return time.perf_counter()
+
+    def lap(self, stage, start):
+        #add the time since start to stage and return the current time, to start the next stage from.
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0) + now - start
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        return now
+
+    def count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def reject(self, name, n = 1):
+        #record n sites removed by the named filter.
+        self.rejected[name] = self.rejected.get(name, 0) + int(n)
+
+    def watch(self, cache):
+        #include a pcr_thresholds.ThresholdCache in the hit and miss counts.
+        self.caches.append(cache)
+
+    def timed(self, iterable, stage):
+        #yield from iterable, timing the production of each item as stage. Used to time the pileup readers, which are generators.
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.lap(stage, start)
+            yield item
+
+    def cache_totals(self):
+        #lookups, computed thresholds and seconds spent computing them, over the watched caches and the merged worker results.
+        totals = [sum([c.lookups for c in self.caches]), sum([c.computed for c in self.caches]), sum([c.seconds for c in self.caches])]
+        return [t + e for t, e in zip(totals, self.cache_extra)]
+
+    def take(self):
+        #return the numbers recorded since the last take and start over, so a worker process can send them back with each result.
+        totals = self.cache_totals()
+        result = {'times': self.times, 'calls': self.calls, 'counts': self.counts, 'rejected': self.rejected, 'cache': [t - b for t, b in zip(totals, self.cache_base)]}
+        self.times, self.calls, self.counts, self.rejected = {}, {}, {}, {}
+        self.cache_base = totals
+        return result
+
+    def merge(self, taken):
+        #add the output of another profile's take().
+        for name in ('times', 'calls', 'counts', 'rejected'):
+            mine = getattr(self, name)
+            for key, value in taken[name].items():
+                mine[key] = mine.get(key, 0) + value
+        self.cache_extra = [e + v for e, v in zip(self.cache_extra, taken['cache'])]
+
+    def summary(self, script = None):
+        lookups, computed, seconds = self.cache_totals()
+        return {'script': script, 'wall_seconds': time.perf_counter() - self.began,
+            'stages': {stage: {'seconds': self.times[stage], 'calls': self.calls[stage]} for stage in self.times},
+            'counts': self.counts, 'rejected': self.rejected,
+            'cache': {'lookups': lookups, 'hits': lookups - computed, 'misses': computed, 'hit_rate': None if lookups == 0 else 1 - computed / lookups, 'compute_seconds': seconds}}
+
+    def report(self, path, script = None):
+        #print the summary table to stderr and write the json to path.
+        summary = self.summary(script)
+        wall = summary['wall_seconds']
+        print('stage\tseconds\tpercent\tcalls', file = sys.stderr)
+        for stage, values in sorted(summary['stages'].items(), key = lambda x:-x[1]['seconds']):
+            print('{}\t{:.3f}\t{:.1f}\t{}'.format(stage, values['seconds'], 100 * values['seconds'] / wall if wall > 0 else 0, values['calls']), file = sys.stderr)
+        print('total\t{:.3f}\t100.0\t.'.format(wall), file = sys.stderr)
+        for name, value in sorted(summary['counts'].items()):
+            print('count\t' + name + '\t' + str(value), file = sys.stderr)
+        for name, value in sorted(summary['rejected'].items()):
+            print('rejected\t' + name + '\t' + str(value), file = sys.stderr)
+        cache = summary['cache']
+        rate = '.' if cache['hit_rate'] == None else '{:.4f}'.format(cache['hit_rate'])
+        print('thresholds\thits {}\tmisses {}\thit rate {}\tcompute {:.3f}s'.format(cache['hits'], cache['misses'], rate, cache['compute_seconds']), file = sys.stderr)
+        with open(path, 'w+') as outf:
+            json.dump(summary, outf, indent = 1)
+
+active = NullProfile()
+
+def enable():
+    #switch profiling on for this process and return the new active profile.
+    global active
+    active = Profile()
+    return active
@@ -2,21 +2,38 @@
 
 #script to remove Ns, bases without enough support from the original consensus reads, and PCR duplicates from the raw mpileup of consensus reads.
 #additionally filters on depth to return only regions where somatic and germline mutations can be distinguished and pcr duplicates identified
+#entries are written as each batch is filtered, so memory use does not grow with the input. With --vcf the filtered sites are also handed straight to
+#pileup_to_vcf in the same process, giving the vcf that running pileup_to_vcf on the filtered pileup would.
 
 #import
 import argparse
-import sys
 import numpy as np
-import statistics as st
+import pileup_parser
+import pcr_thresholds
+import profiler
+import output_writer
+import checkpoint
+import pileup_to_vcf
 
 def argparser():
     parser = argparse.ArgumentParser()
     #parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
     parser.add_argument('-t', '--threshold', type = int, help = 'Set a minimum number of times a base must be seen. default 2', default = 2)
-    parser.add_argument('-i', '--input', help = 'path to input file.', default = None)
-    parser.add_argument('-o', '--output', help = 'name of output pileup, default is stdout', default = None)
+    parser.add_argument('-i', '--input', help = 'path to input pileup file or site store directory (see site_store.py).', default = None)
+    parser.add_argument('-o', '--output', help = 'name of output pileup, default is stdout (or no pileup output with --vcf)', default = None)
     parser.add_argument('-s', '--remove_singleton', help = 'Use to also remove all singleton sites.', action = 'store_true')
     parser.add_argument('-p', '--pcr_dup_prob', type = float, help = 'Set to a threshold probability to identify a cluster as being a non-random pcr cluster that should be removed. Default = .05', default = 0.05)
+    pcr_thresholds.add_arguments(parser)
+    parser.add_argument('--cap-report', dest = 'cap_report', action = 'store_true', help = 'Also filter every site with exact thresholds and report to stderr how many pileup entries the --depth-cap loses, gains or changes, and how many thresholds each mode computed')
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only process this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only process the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--vcf', help = 'Also call the filtered sites with pileup_to_vcf in this process and write the vcf to this path.', default = None)
+    parser.add_argument('-a', '--header', help = 'File containing header text for the --vcf output.', default = None)
+    parser.add_argument('-d', '--mind', type = int, help = 'Minimum depth for somatic mutation identification in the --vcf output. Default 10', default = 10)
+    parser.add_argument('-g', '--germline', action = 'store_true', help = 'Retain germline mutations in the --vcf output.')
+    parser.add_argument('--checkpoint-interval', dest = 'checkpoint_interval', type = int, help = 'Seconds between checkpoints (see checkpoint.py), saved as the output name (or the --vcf name without -o) plus .ckpt. Needs an uncompressed input pileup file without regions and uncompressed output files. Default is no checkpoints (every 600 seconds with --resume)', default = None)
+    parser.add_argument('--resume', action = 'store_true', help = 'Continue an interrupted run with the same arguments from its last checkpoint.')
+    parser.add_argument('--profile', help = 'Write stage timings, filter rejection counts and threshold cache hits to this json file, plus a summary table to stderr (see profiler.py). Default is no profiling', default = None)
     args = parser.parse_args()
     return args
 
@@ -30,122 +47,171 @@ def count_bases(path):
                         counts[base] += 1
     return counts
 
-#the following functions are intended to construct a tracking structure which can identify and ignore likely PCR duplicate errors
-#these errors generally manifest as a series of alternative alleles which come from adjacently mapping consensus sequences, e.g. a line of alternative alleles will appear as "......AAAAAA......"
-#in this case, we only want to count the single A error rather than counting it 5 times.
-#we use a permuter which generates random sequences with an equal length and number of alternatives, measures median distance between each instances of the alternative allele, and determines whether a given read has an average density of alternative alleles which falls below this threshold
-def get_dindex(altstring):
-    distances = {}
-    for i,base in enumerate(altstring):
-        if base != '.':
-            if base not in distances:
-                last = i
-                distances[base] = []
-            else:
-                distances[base].append(i-last)
-                last = i
-    dindex = {}
-    for k,v in distances.items():
-        if len(v)> 0:
-            dindex[k] = st.median(v)
-    return dindex
+def filter_site(spent, nalts, nquals, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), remove_singleton = False, pcr_dup_prob = .05, dindeces = None):
+    #the pileup entry of filter_record as a line.
+    nent, pcr_duplicate_track = filter_record(spent, nalts, nquals, pcr_duplicate_track, remove_singleton, pcr_dup_prob, dindeces)
+    return '\t'.join(nent), pcr_duplicate_track
 
-def make_random(length = 100, bases_to_use = 'A', num = 5):
-    string = list('.' * length)
-    for b in bases_to_use:
-        locs = np.random.choice(length,num,replace = False)
-        for l in locs:
-            string[l] = b
-    return ''.join(string)
+def filter_record(spent, nalts, nquals, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), remove_singleton = False, pcr_dup_prob = .05, dindeces = None):
+    #rebuild a pileup entry from the quality filtered bases of a site, collapsing pcr duplicate clusters to a single instance.
+    #spent is the split entry, nalts and nquals are its bases and qualities with Ns and low quality alleles already stripped out.
+    #now, apply the pcr duplicate permutation filter structure from pcr_thresholds. The cluster percentile is a setting of the pcr_duplicate_track cache, so pcr_dup_prob should match it.
+    prof = profiler.active
+    start = prof.start()
+    skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflationf.
+    dindeces = pcr_thresholds.get_dindex(nalts) if dindeces == None else dindeces #batch callers hand over rows of pcr_thresholds.batch_dindex.
+    for base in 'ACGT':
+        basecount = nalts.count(base)
+        if 2 <= basecount <= len(nalts)/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
+            key = (len(nalts), nalts.count(base))
+            thresh = pcr_duplicate_track[key]
+            if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
+                #print("QC: Base is skipped for clustering")
+                skip += base
+                prof.count('pcr_clusters')
+        else:
+            #print("QC: Base is singleton or too high frequency in pileup")
+            skip += base
+    start = prof.lap('pcr_test', start)
+    #now actually go through and count the scattered mutations.
+    recorded = []
+    dnalts = ''
+    dnquals = ''
 
-def perm_index(leng = 100, num = 3, pnum = 1000, dup_prob = .05):
-    indeces = []
-    for p in range(pnum):
-        tstr = make_random(length = leng, num = num, bases_to_use='A')
-        index = get_dindex(tstr)
-        indeces.append(index['A'])
-    return np.percentile(indeces,dup_prob * 100) #percentile.
+    #add a counter with nalts to allow removal of marked singletons
+    nalt_counter = {b:nalts.count(b) for b in set(list(nalts))}
+    for i,base in enumerate(nalts):
+        if base in skip and base in recorded:
+            continue
+        if remove_singleton and (nalt_counter[base] == 1 or base in skip):
+            #ignore bases that are natural singletons, or have already been marked to only record once (pcr duplications.)
+            continue
+        recorded.append(base) #it can only go in once if it's in skip from the pcr duplicate remover.
+        dnalts += base
+        dnquals += str(nquals[i])
+    #reconstruct the entry and append it to the output.
+    nent = spent
+    nent[4] = dnalts
+    nent[5] = dnquals
+    nent[3] = len(dnalts)
+    prof.lap('format', start)
+    return [str(v) for v in nent], pcr_duplicate_track
 
-def main():
-    args = argparser()
+def filter_batch(batch, threshold = 2, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), remove_singleton = False, pcr_dup_prob = .05):
+    #the filtered pileup entries of one pileup_parser batch.
+    return ['\t'.join(nent) for nent in filter_records(batch, threshold, pcr_duplicate_track, remove_singleton, pcr_dup_prob)]
+
+def filter_records(batch, threshold = 2, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), remove_singleton = False, pcr_dup_prob = .05):
+    #filter_batch, returning the split columns of the filtered entries.
+    prof = profiler.active
+    #strip out Ns and low quality alleles for the whole batch at once.
+    start = prof.start()
+    quality = (batch.quals >= threshold) & (batch.bases != ord('N'))
+    depth = batch.count(quality)
+    nonref = batch.count(quality & (batch.bases != ord('.')))
+    #apply filters for calling mutations here.
+    #first, the depth must be at least five in order to differentiate between germline and somatic mutations.
+    #depth being the non-N content of the alternative allele string.
+    #second, any mutations which exist at higher than a 25% frequency in the string are probably germline and should be ignored for somatic mutation analysis.
+    somatic = np.all(batch.base_counts(quality) < depth[:,None]/4, axis = 1)
+    deep = (batch.ref_codes(upper = True) != ord('N')) & (depth > 5)
+    sites = np.flatnonzero(deep & somatic)
+    nalts = batch.strings(quality, sites)
+    nquals = batch.strings(quality, sites, quals = True)
+    #the pcr cluster gaps of all the sites in one go.
+    dindeces = pcr_thresholds.site_dindeces(*batch.masked(quality), sites)
+    if prof.enabled:
+        prof.count('sites', len(batch))
+        prof.reject('depth', len(batch) - deep.sum())
+        prof.reject('germline', deep.sum() - len(sites))
+    prof.lap('filter', start)
     good_entries = []
+    for j, i in enumerate(sites):
+        spent = batch.fields(i)
+        if nonref[i] == 0:
+            #nothing but reference bases survive, so there are no clusters or singletons to remove.
+            start = prof.start()
+            spent[3:6] = [str(len(nalts[j])), nalts[j], nquals[j]]
+            good_entries.append(spent)
+            prof.lap('format', start)
+            continue
+        nent, pcr_duplicate_track = filter_record(spent, nalts[j], nquals[j], pcr_duplicate_track, remove_singleton, pcr_dup_prob, dindeces[j])
+        good_entries.append(nent)
+    return good_entries
 
-    pcr_duplicate_track = {} #using dynamic programming to save compute cycles for this qc measure
-    if args.input == None:
-        inputf = sys.stdin
-    else:
-        inputf = open(args.input)
-    for entry in inputf:
-        spent = entry.strip().split()
-        ref = spent[2].upper()
-        if len(spent) > 4 and ref != "N" and spent[3] != '0': #ignore empty lines from end of files etc
-            spent = entry.strip().split()
-            alts = [b for b in spent[4] if b in 'ACGTN.']
-            quals = spent[5]
-            if len(alts) != len(quals):
-                print(entry)
-            assert len(alts) == len(quals)
-            nalts = ''
-            nquals = ''
-            for i, base in enumerate(alts):
-                if int(quals[i]) >= args.threshold and base != 'N': #strip out Ns and low quality alleles
-                    nalts += base
-                    nquals += quals[i]
-            #apply filters for calling mutations here.
-            #first, the depth must be at least five in order to differentiate between germline and somatic mutations.
-            #depth being the non-N content of the alternative allele string.
-            #second, any mutations which exist at higher than a 25% frequency in the string are probably germline and should be ignored for somatic mutation analysis.
-            if len(nalts) > 5 and all([nalts.count(b) < len(nalts)/4 for b in 'ACGT']):
-                #now, apply the pcr duplicate permutation filter structure using functions above.
-                skip = '' #record no more than one of the bases that will be included here because of pcr duplicate inflationf.
-                dindeces = get_dindex(nalts)
-                for base in 'ACGT':
-                    basecount = nalts.count(base)
-                    if 2 <= basecount <= len(nalts)/4: #doesn't make sense to calculate for singletons, which I intend to skip by default now.
-                        key = (len(nalts), nalts.count(base))
-                        if key not in pcr_duplicate_track:
-                            pcr_duplicate_track[key] = perm_index(leng = key[0], num = key[1], dup_prob = args.pcr_dup_prob)
-                        thresh = pcr_duplicate_track[key]
-                        if dindeces[base] < thresh: #less than 5% chance of getting a cluster like this. Lock this one to 1 instance
-                            #print("QC: Base is skipped for clustering")
-                            skip += base
-                    else:
-                        #print("QC: Base is singleton or too high frequency in pileup")
-                        skip += base
-                #now actually go through and count the scattered mutations.
-                recorded = []
-                dnalts = ''
-                dnquals = ''
-                
-                #add a counter with nalts to allow removal of marked singletons
-                nalt_counter = {b:nalts.count(b) for b in set(list(nalts))}
-                for i,base in enumerate(nalts):
-                    if base in skip and base in recorded:
-                        continue
-                    if args.remove_singleton and (nalt_counter[base] == 1 or base in skip):
-                        #ignore bases that are natural singletons, or have already been marked to only record once (pcr duplications.)
-                        continue
-                    recorded.append(base) #it can only go in once if it's in skip from the pcr duplicate remover.
-                    dnalts += base
-                    dnquals += str(nquals[i])
-                #reconstruct the entry and append it to the output.
-                nent = spent
-                nent[4] = dnalts
-                nent[5] = dnquals
-                nent[3] = len(dnalts)
-                good_entries.append('\t'.join([str(v) for v in nent]))
-            else:
-                # print("QC: Read is skipped for having no alts")
-                continue
-    if args.output == None:
-        outf = sys.stdout
+def remove_bad_entries(chunks, pcr_duplicate_track = pcr_thresholds.ThresholdCache(), threshold = 2, remove_singleton = False, pcr_dup_prob = .05):
+    #pipeline stage (see pileup_pipeline.py): the records of filter_records for each chunk of sites.
+    for chunk in chunks:
+        yield filter_records(pileup_parser.as_batch(chunk, 'remove_bad_entries'), threshold, pcr_duplicate_track, remove_singleton, pcr_dup_prob)
+
+def main():
+    args = argparser()
+    pcr_duplicate_track = pcr_thresholds.from_args(args, dup_prob = args.pcr_dup_prob) #using dynamic programming to save compute cycles for this qc measure
+    prof = profiler.enable() if args.profile != None else profiler.active
+    prof.watch(pcr_duplicate_track)
+    report = pcr_thresholds.CapReport(args, dup_prob = args.pcr_dup_prob) if args.cap_report else None
+    regions = pileup_parser.get_regions(args.region, args.regions_bed)
+    paths = [path for path in (args.output, args.vcf) if path != None]
+    caches = [pcr_duplicate_track]
+    if args.vcf != None:
+        assert args.header != None, '--vcf needs a header file (-a)'
+        #pileup_to_vcf always uses the default cluster percentile. The thresholds can be shared when this run uses it too,
+        #otherwise the vcf ones are computed separately and not saved to the cache file.
+        if args.pcr_dup_prob == .05:
+            vcf_track = pcr_duplicate_track
+        else:
+            vcf_track = pcr_thresholds.from_args(args, path = None)
+            prof.watch(vcf_track)
+            caches.append(vcf_track)
+    ckpt = None
+    state = None
+    if checkpoint.supported(args.input, paths, regions) and (checkpoint.interval(args) > 0 or args.resume):
+        ckpt = checkpoint.Checkpoint(checkpoint.checkpoint_path(paths[0]), args, caches, checkpoint.interval(args))
+    if args.resume:
+        assert ckpt != None, '--resume needs an uncompressed input pileup file without regions and uncompressed output files'
+        state = ckpt.load()
+    resume = [None, None] if state == None else state['output_offsets']
+    outf = output_writer.OutputWriter(args.output, resume = resume[0]) if args.output != None or args.vcf == None else None
+    writers = [outf] if outf != None else []
+    if args.vcf != None:
+        vcf_out = output_writer.OutputWriter(args.vcf, index = True, resume = resume[-1])
+        if state == None:
+            output_writer.copy_header(args.header, vcf_out)
+        writers.append(vcf_out)
+    if ckpt != None:
+        batches = pileup_parser.iter_offset_batches(args.input, 0 if state == None else state['input_offset'])
     else:
-        outf = open(args.output, 'w+')
-    for nen in good_entries:
-        print(nen, file = outf)   
-    if args.input != None:
-        inputf.close()
-    elif args.output != None:
+        batches = ((batch, None) for batch in pileup_parser.read_batches(args.input, regions))
+    for batch, end in prof.timed(batches, 'parse'):
+        good_records = filter_records(pileup_parser.single_sample(batch, 'remove_bad_entries'), args.threshold, pcr_duplicate_track, args.remove_singleton, args.pcr_dup_prob)
+        if report != None:
+            report.compare(filter_records(batch, args.threshold, report.exact_track, args.remove_singleton, args.pcr_dup_prob), good_records)
+        start = prof.start()
+        if outf != None:
+            outf.write_lines(['\t'.join(nent) for nent in good_records])
+        prof.lap('write', start)
+        if args.vcf != None and good_records:
+            #hand the filtered records straight to pileup_to_vcf as a batch, without writing them out as text and parsing them back.
+            start = prof.start()
+            filtered = pileup_parser.RecordBatch(good_records)
+            prof.lap('parse', start)
+            lines = pileup_to_vcf.call_batch(filtered, args.mind, args.germline, vcf_track)
+            start = prof.start()
+            vcf_out.write_lines(lines)
+            prof.lap('write', start)
+        if ckpt != None and ckpt.due():
+            ckpt.save(end, writers)
+    pcr_duplicate_track.save()
+    if outf != None:
         outf.close()
+    if args.vcf != None:
+        vcf_out.close()
+    if ckpt != None:
+        ckpt.finish()
+    if report != None:
+        report.report(pcr_duplicate_track)
+    if args.profile != None:
+        prof.report(args.profile, 'remove_bad_entries')
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+#this script writes a synthetic consensus mpileup for testing and benchmarking the pileup scripts.
+#sites get a depth drawn from a chosen distribution, scattered alternative alleles, Ns, and optionally injected PCR duplicate clusters
+#(a run of adjacent reads carrying the same alternative, the pattern get_dindex and perm_index are meant to catch) and samtools read/indel markup.
+#quality values are single digit consensus support counts, as in the pileups the other scripts read.
+#markup is written so that it never adds characters the scripts keep (ACGTN.): inserted and deleted sequence is lower case and read start
+#mapping qualities avoid those letters, so every site still has one quality digit per kept base.
+
+#import
+import argparse
+import sys
+import numpy as np
+
+#define functions/classes
+
+BASES = np.frombuffer(b'ACGT', dtype = np.uint8)
+MAPQ = np.frombuffer(b'!#%&+05<?@FIK]~', dtype = np.uint8) #read start mapping quality characters outside ACGTN.
+
+def parse_depth(spec):
+    #depth distribution from a string: uniform:lo,hi poisson:mean or negbin:mean,dispersion.
+    kind, _, values = spec.partition(':')
+    values = [float(v) for v in values.split(',')] if values else []
+    assert kind in ('uniform', 'poisson', 'negbin'), 'unknown depth distribution ' + spec
+    return kind, values
+
+def draw_depths(rng, n, depth):
+    kind, values = depth
+    if kind == 'uniform':
+        return rng.integers(int(values[0]), int(values[1]) + 1, n)
+    if kind == 'poisson':
+        return rng.poisson(values[0], n)
+    mean, dispersion = values
+    return rng.negative_binomial(dispersion, dispersion / (dispersion + mean), n)
+
+def simulate_chunk(rng, n, depth = ('uniform', [20, 150]), alt_rate = .002, n_rate = .005, pcr_rate = .01, pcr_size = (3, 8), indel_rate = 0, edge_rate = 0):
+    #(refs, depths, base strings, quality strings) for n sites.
+    depths = draw_depths(rng, n, depth)
+    refs = BASES[rng.integers(0, 4, n)]
+    total = int(depths.sum())
+    offsets = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum(depths, out = offsets[1:])
+    site = np.repeat(np.arange(n), depths)
+    bases = np.full(total, ord('.'), dtype = np.uint8)
+    draw = rng.random(total)
+    alts = draw < alt_rate
+    #an alternative is one of the three bases other than the reference.
+    shift = rng.integers(1, 4, int(alts.sum()))
+    bases[alts] = BASES[(np.searchsorted(BASES, refs[site[alts]]) + shift) % 4]
+    bases[(draw >= alt_rate) & (draw < alt_rate + n_rate)] = ord('N')
+    #pcr clusters: a run of adjacent reads all carrying one alternative.
+    for i in np.flatnonzero(rng.random(n) < pcr_rate):
+        size = int(rng.integers(pcr_size[0], pcr_size[1] + 1))
+        if depths[i] <= size * 4:
+            continue
+        start = offsets[i] + int(rng.integers(0, depths[i] - size + 1))
+        bases[start:start+size] = BASES[(np.searchsorted(BASES, refs[i]) + int(rng.integers(1, 4))) % 4]
+    quals = rng.integers(ord('0'), ord('9') + 1, total).astype(np.uint8)
+    btext = bases.tobytes()
+    qtext = quals.tobytes()
+    bstrings = [btext[offsets[i]:offsets[i+1]].decode() for i in range(n)]
+    qstrings = [qtext[offsets[i]:offsets[i+1]].decode() for i in range(n)]
+    #samtools markup only for the few sites that get it, so it costs nothing when disabled.
+    for i in np.flatnonzero(rng.random(n) < indel_rate):
+        if depths[i] == 0:
+            continue
+        cut = int(rng.integers(1, depths[i] + 1))
+        size = int(rng.integers(1, 4))
+        token = ('+' if rng.random() < .5 else '-') + str(size) + ''.join(rng.choice(list('acgt'), size))
+        bstrings[i] = bstrings[i][:cut] + token + bstrings[i][cut:]
+    if edge_rate > 0:
+        for i in np.flatnonzero(rng.random(n) < 1 - (1 - edge_rate) ** np.maximum(depths, 1)):
+            chars = []
+            pos = 0
+            for c in bstrings[i]:
+                #read starts and ends only go next to a read base, not inside an indel token.
+                if c in 'ACGTN.' and pos < depths[i]:
+                    if rng.random() < edge_rate:
+                        chars.append('^' + chr(rng.choice(MAPQ)))
+                    chars.append(c)
+                    if rng.random() < edge_rate:
+                        chars.append('$')
+                    pos += 1
+                else:
+                    chars.append(c)
+            bstrings[i] = ''.join(chars)
+    for i in np.flatnonzero(depths == 0):
+        bstrings[i] = '*'
+        qstrings[i] = '*'
+    return refs, depths, bstrings, qstrings
+
+def simulate(outf, nsites, contigs = 1, chunk = 100000, seed = 0, **settings):
+    #write nsites sites spread evenly over contigs chr1..chrN.
+    rng = np.random.default_rng(seed)
+    per_contig = -(-nsites // contigs)
+    written = 0
+    for c in range(contigs):
+        name = 'chr' + str(c + 1)
+        count = min(per_contig, nsites - written)
+        for start in range(0, count, chunk):
+            n = min(chunk, count - start)
+            refs, depths, bstrings, qstrings = simulate_chunk(rng, n, **settings)
+            outf.write(''.join([name + '\t' + str(start + i + 1) + '\t' + chr(refs[i]) + '\t' + str(depths[i]) + '\t' + bstrings[i] + '\t' + qstrings[i] + '\n' for i in range(n)]))
+        written += count
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--sites', type = int, help = 'Number of sites to write. Default 100000', default = 100000)
+    parser.add_argument('-o', '--output', help = 'Path of the pileup to write. Default is stdout', default = None)
+    parser.add_argument('-c', '--contigs', type = int, help = 'Number of contigs to spread the sites over. Default 1', default = 1)
+    parser.add_argument('-d', '--depth', help = 'Depth distribution, uniform:lo,hi poisson:mean or negbin:mean,dispersion. Default uniform:20,150', default = 'uniform:20,150')
+    parser.add_argument('-a', '--alt_rate', type = float, help = 'Chance of each read base being an alternative allele. Default .002', default = .002)
+    parser.add_argument('-N', '--n_rate', type = float, help = 'Chance of each read base being an N. Default .005', default = .005)
+    parser.add_argument('-p', '--pcr_rate', type = float, help = 'Chance of a site carrying a PCR duplicate cluster. Default .01', default = .01)
+    parser.add_argument('--pcr_size', help = 'Smallest and largest PCR cluster size. Default 3,8', default = '3,8')
+    parser.add_argument('-i', '--indel_rate', type = float, help = 'Chance of a site carrying an indel token. Default 0', default = 0)
+    parser.add_argument('-e', '--edge_rate', type = float, help = 'Chance of each read base carrying a read start (^ and mapping quality) or read end ($) mark. Default 0', default = 0)
+    parser.add_argument('-s', '--seed', type = int, help = 'Random seed. Default 0', default = 0)
+    args = parser.parse_args()
+    return args
+
+def settings_from_args(args):
+    return {'depth': parse_depth(args.depth), 'alt_rate': args.alt_rate, 'n_rate': args.n_rate, 'pcr_rate': args.pcr_rate,
+        'pcr_size': tuple([int(v) for v in args.pcr_size.split(',')]), 'indel_rate': args.indel_rate, 'edge_rate': args.edge_rate}
+
+def main():
+    args = argparser()
+    outf = sys.stdout if args.output == None else open(args.output, 'w+')
+    simulate(outf, args.sites, args.contigs, seed = args.seed, **settings_from_args(args))
+    if args.output != None:
+        outf.close()
+
+if __name__ == "__main__":
+    main()
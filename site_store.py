@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+#columnar binary store of the sites of a pileup, for repeated runs over the same data with different settings.
+#the text pileup is parsed once into a directory of .npy arrays that are memory mapped when read back:
+#contig id, position and reference byte per site, the cleaned ACGTN. read bases and their quality digits with an offset table (in read order, as get_dindex needs them),
+#and a sites x 6 x 10 table counting each of A, C, G, T, N and . at each quality digit, so depth at any quality threshold is a sum over the table.
+#any script that reads its input through pileup_parser.read_batches takes the store directory in place of the pileup.
+#run this script directly to build a store.
+
+#import
+import argparse
+import os
+import shutil
+import numpy as np
+import pileup_parser
+
+#define functions/classes
+
+STORE_VERSION = 1
+SYMBOLS = b'ACGTN.'
+COLUMNS = {'contig': np.int32, 'pos': np.int64, 'ref': np.uint8, 'offsets': np.int64, 'bases': np.uint8, 'quals': np.uint8, 'counts': np.uint32}
+BATCHSITES = 1 << 18 #sites per batch when reading a store.
+
+_SYMBOL_CODE = np.zeros(256, dtype = np.int64)
+for _i, _b in enumerate(SYMBOLS):
+    _SYMBOL_CODE[_b] = _i
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'contigs.txt'))
+
+def quality_counts(batch):
+    #sites x 6 x 10 counts of each symbol of SYMBOLS at each quality digit.
+    sites = np.repeat(np.arange(len(batch)), batch.lengths)
+    flat = sites * 60 + _SYMBOL_CODE[batch.bases] * 10 + np.clip(batch.quals, 0, 9)
+    return np.bincount(flat, minlength = len(batch) * 60).reshape(len(batch), 6, 10)
+
+def write_npy(path, raw, dtype, shape):
+    #wrap a file of raw values into a .npy file with the given shape.
+    with open(path, 'wb') as outf:
+        np.lib.format.write_array_header_1_0(outf, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+        with open(raw, 'rb') as inf:
+            shutil.copyfileobj(inf, outf, 1 << 24)
+    os.remove(raw)
+
+def build_store(pileup, outdir, regions = None):
+    #parse a pileup (path, or standard in when None) into a store directory. Columns are appended as raw values per batch and given their .npy headers at the end.
+    os.makedirs(outdir, exist_ok = True)
+    raws = {name: open(os.path.join(outdir, name + '.raw'), 'wb') for name in COLUMNS}
+    contigs = {}
+    nsites = 0
+    nbases = 0
+    raws['offsets'].write(np.zeros(1, dtype = np.int64).tobytes())
+    for batch in pileup_parser.read_batches(pileup, regions):
+        pileup_parser.single_sample(batch, 'site_store')
+        names = [batch.block[s:e] for s, e in zip(batch.starts[:,0].tolist(), batch.ends[:,0].tolist())]
+        for name in set(names):
+            if name not in contigs:
+                contigs[name] = len(contigs)
+        columns = {'contig': [contigs[name] for name in names], 'pos': batch.positions(), 'ref': batch.refs,
+            'offsets': batch.offsets[1:] + nbases, 'bases': batch.bases, 'quals': batch.quals, 'counts': quality_counts(batch)}
+        for name, values in columns.items():
+            raws[name].write(np.asarray(values, dtype = COLUMNS[name]).tobytes())
+        nsites += len(batch)
+        nbases += len(batch.bases)
+    shapes = {'contig': (nsites,), 'pos': (nsites,), 'ref': (nsites,), 'offsets': (nsites + 1,), 'bases': (nbases,), 'quals': (nbases,), 'counts': (nsites, 6, 10)}
+    for name, raw in raws.items():
+        raw.close()
+        write_npy(os.path.join(outdir, name + '.npy'), os.path.join(outdir, name + '.raw'), COLUMNS[name], shapes[name])
+    with open(os.path.join(outdir, 'contigs.txt'), 'w+') as outf:
+        print('#site_store\tversion=' + str(STORE_VERSION), file = outf)
+        for name in sorted(contigs, key = contigs.get):
+            print(name.decode(), file = outf)
+    return nsites
+
+def load_store(path):
+    #dictionary of the memory mapped store columns, plus 'names', the contig names in id order.
+    with open(os.path.join(path, 'contigs.txt')) as inf:
+        header = inf.readline().strip().split('\t')
+        if header != ['#site_store', 'version=' + str(STORE_VERSION)]:
+            raise ValueError(path + " is not a version " + str(STORE_VERSION) + " site store")
+        store = {'names': [entry.strip() for entry in inf]}
+    for name in COLUMNS:
+        store[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r')
+    return store
+
+class StoreBatch(pileup_parser.SiteBatch):
+    '''
+    A SiteBatch read from a site store instead of a text block, for the sites with the given store indices.
+    The read base and quality columns it reports are the cleaned ACGTN. bases and their digits, and the depth column is their number.
+    '''
+    def __init__(self, store, sites):
+        self.names = store['names']
+        self.contigs = np.asarray(store['contig'][sites])
+        self.pos = np.asarray(store['pos'][sites])
+        self.refs = np.asarray(store['ref'][sites])
+        first = np.asarray(store['offsets'][sites])
+        self.lengths = np.asarray(store['offsets'][sites + 1]) - first
+        self.offsets = np.zeros(len(sites) + 1, dtype = np.int64)
+        np.cumsum(self.lengths, out = self.offsets[1:])
+        #sites are usually one contiguous run, which slices straight out of the memory map.
+        if len(sites) > 0 and sites[-1] - sites[0] == len(sites) - 1:
+            span = slice(first[0], first[0] + self.offsets[-1])
+        else:
+            span = np.repeat(first - self.offsets[:-1], self.lengths) + np.arange(self.offsets[-1])
+        self.bases = np.asarray(store['bases'][span])
+        self.quals = np.asarray(store['quals'][span])
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.pos)
+
+    def column(self, i, col):
+        if col == 0:
+            return self.names[self.contigs[i]]
+        if col == 1:
+            return str(self.pos[i])
+        if col == 2:
+            return chr(self.refs[i])
+        if col == 3:
+            return str(self.lengths[i])
+        if col == 4:
+            return self.bases[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+        return (self.quals[self.offsets[i]:self.offsets[i+1]] + pileup_parser.QZERO).tobytes().decode()
+
+    def fields(self, i):
+        return [self.column(i, c) for c in range(6)]
+
+    def positions(self):
+        return self.pos
+
+def contig_spans(store):
+    #dictionary of contig name to the store index range (lo, hi) of its sites, from a single pass over the contig column.
+    #sites of a contig are contiguous in a store built from a sorted pileup.
+    contig = np.asarray(store['contig'])
+    cuts = np.flatnonzero(np.diff(contig)) + 1
+    los = np.concatenate([[0], cuts]) if len(contig) > 0 else cuts
+    his = np.concatenate([cuts, [len(contig)]])
+    assert len(np.unique(contig[los])) == len(los), 'the sites of each contig need to be contiguous in the store; build it from a sorted pileup'
+    return {store['names'][contig[lo]]: (int(lo), int(hi)) for lo, hi in zip(los, his)}
+
+def region_ranges(store, regions):
+    #store index ranges (lo, hi) of the sites in each region, found by binary search on the positions of the region's contig, which are sorted.
+    spans = contig_spans(store)
+    ranges = []
+    for contig, start, end in regions:
+        if contig not in spans:
+            continue
+        lo, hi = spans[contig]
+        pos = store['pos'][lo:hi]
+        ranges.append((lo + np.searchsorted(pos, start, side = 'left'), lo + np.searchsorted(pos, end, side = 'right')))
+    return ranges
+
+def iter_store_batches(path, regions = None, batchsites = BATCHSITES, require = None):
+    #yield a StoreBatch for every batchsites sites of a store, optionally restricted to regions.
+    #require works as in pileup_parser.parse_block and is answered from the count table without touching the bases.
+    store = load_store(path)
+    if require != None:
+        assert all([c in SYMBOLS for c in require]), 'a store only keeps the ' + SYMBOLS.decode() + ' read bases'
+        codes = [SYMBOLS.index(c) for c in require]
+    ranges = [(0, len(store['pos']))] if regions == None else region_ranges(store, regions)
+    for lo, hi in ranges:
+        for start in range(lo, hi, batchsites):
+            sites = np.arange(start, min(start + batchsites, hi))
+            if require != None:
+                sites = sites[np.asarray(store['counts'][sites[0]:sites[-1]+1][:,codes,:]).sum(axis = (1, 2)) > 0]
+            if len(sites) > 0:
+                yield StoreBatch(store, sites)
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', type = bool, help = "Set to True to print status updates. Default True", default = True)
+    parser.add_argument('-p', '--pileup', help = 'Pileup to convert. Default is standard in', default = None)
+    parser.add_argument('-o', '--output', help = 'Directory to write the site store to.')
+    parser.add_argument('-r', '--region', action = 'append', help = 'Only store this region, given as contig or contig:start-end (1 based, inclusive). Can be repeated. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    parser.add_argument('--regions-bed', dest = 'regions_bed', help = 'Only store the regions in this bed file. Needs a bgzip compressed pileup indexed with bgzf.py', default = None)
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = argparser()
+    nsites = build_store(args.pileup, args.output, pileup_parser.get_regions(args.region, args.regions_bed))
+    if args.verbose:
+        print("{} sites stored in {}".format(nsites, args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import io
+import os
+import sys
+import pytest
+
+#the scripts are flat modules in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulate_pileup
+
+VCF_HEADER = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+def run_main(monkeypatch, module, argv):
+    #run a script's main in this process, as if it was called with argv.
+    monkeypatch.setattr(sys, 'argv', [module.__name__ + '.py'] + [str(a) for a in argv])
+    module.main()
+
+@pytest.fixture
+def vcf_header(tmp_path):
+    #a minimal vcf header file for the -a option of the vcf scripts.
+    header = tmp_path / 'header.txt'
+    header.write_text(VCF_HEADER)
+    return str(header)
+
+@pytest.fixture
+def simulated_pileup(tmp_path):
+    #writes a simulated pileup into tmp_path and returns its path: nsites sites of one simulate_pileup.simulate call with the given settings,
+    #or stretches of (nsites, seed, settings), each simulated on its own and put on contig chr<seed>.
+    def write(nsites = None, stretches = None, name = 'sim.pileup', **settings):
+        pileup = tmp_path / name
+        with open(pileup, 'w+') as outf:
+            if stretches == None:
+                simulate_pileup.simulate(outf, nsites, **settings)
+            for nsites, seed, settings in stretches or []:
+                text = io.StringIO()
+                simulate_pileup.simulate(text, nsites, seed = seed, **settings)
+                outf.write(text.getvalue().replace('chr1\t', 'chr' + str(seed) + '\t'))
+        return str(pileup)
+    return write
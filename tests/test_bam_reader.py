@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import pytest
+if os.environ.get('CI'):
+    import pysam #the BAM input mode must be tested in CI, not skipped.
+else:
+    pysam = pytest.importorskip('pysam')
+import bam_reader
+import pileup_parser
+import pileup_to_vcf
+from conftest import run_main
+
+def write_inputs(tmp_path):
+    #a 40 base reference and a sorted, indexed BAM with one forward read matching it and one reverse strand read with a mismatch at position 11.
+    reference = 'ACGTACGTAC' * 4
+    fasta = str(tmp_path / 'ref.fa')
+    with open(fasta, 'w') as outf:
+        outf.write('>chr1\n' + reference + '\n')
+    pysam.faidx(fasta)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': len(reference)}]}
+    path = str(tmp_path / 'reads.bam')
+    with pysam.AlignmentFile(path, 'wb', header = header) as bam:
+        for name, flag, sequence in (('fwd', 0, reference[:20]), ('rev', 16, reference[:10] + 'T' + reference[11:20])):
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = 0
+            read.mapping_quality = 60
+            read.cigarstring = '20M'
+            read.query_sequence = sequence
+            read.query_qualities = pysam.qualitystring_to_array('I' * 20)
+            bam.write(read)
+    pysam.index(path)
+    return path, fasta
+
+def test_require_keeps_reverse_strand_mismatch(tmp_path):
+    path, fasta = write_inputs(tmp_path)
+    batches = list(bam_reader.iter_bam_batches(path, fasta, require = b'ACGT'))
+    assert [b.pos.tolist() for b in batches] == [[11]]
+    batch = batches[0]
+    assert sorted(batch.bases.tobytes().decode()) == ['.', 'T']
+    assert batch.reverse.tolist() == [False, True]
+
+def simulate_alignments(tmp_path, suffix = '.bam', seed = 1):
+    #two random contigs and a few thousand reads on both strands with mismatches, Ns, deletions, insertions and soft clips,
+    #a range of base and mapping qualities (some under mpileup's default -Q 13) and some duplicate, secondary and qc failed reads it skips.
+    rng = np.random.default_rng(seed)
+    contigs = {'chr1': 3000, 'chr2': 1500}
+    sequences = {c: ''.join(rng.choice(list('ACGT'), n)) for c, n in contigs.items()}
+    fasta = str(tmp_path / 'ref.fa')
+    with open(fasta, 'w') as outf:
+        for contig, sequence in sequences.items():
+            outf.write('>' + contig + '\n' + sequence + '\n')
+    pysam.faidx(fasta)
+    reads = []
+    for rid, (contig, length) in enumerate(contigs.items()):
+        for k in range(length // 2):
+            span = int(rng.integers(40, 100))
+            start = int(rng.integers(0, length - span - 10))
+            query = list(sequences[contig][start:start+span])
+            for j in np.flatnonzero(rng.random(span) < .03):
+                query[j] = rng.choice([b for b in 'ACGTN' if b != query[j]])
+            cigar = [(0, span)]
+            kind = rng.random()
+            cut = int(rng.integers(10, span - 10))
+            if kind < .1:
+                size = int(rng.integers(1, 4))
+                query = query[:cut] + query[cut+size:]
+                cigar = [(0, cut), (2, size), (0, span - cut - size)]
+            elif kind < .2:
+                inserted = list(rng.choice(list('ACGT'), int(rng.integers(1, 4))))
+                query = query[:cut] + inserted + query[cut:]
+                cigar = [(0, cut), (1, len(inserted)), (0, span - cut)]
+            elif kind < .3:
+                clip = int(rng.integers(1, 6))
+                query = list(rng.choice(list('ACGT'), clip)) + query
+                cigar = [(4, clip), (0, span)]
+            read = pysam.AlignedSegment()
+            read.query_name = contig + '_' + str(k)
+            read.flag = int(rng.choice([0, 16])) | int(rng.choice([0, 0x400, 0x100, 0x200], p = [.94, .03, .02, .01]))
+            read.reference_id = rid
+            read.reference_start = start
+            read.mapping_quality = int(rng.choice([0, 10, 60, 60]))
+            read.cigartuples = cigar
+            read.query_sequence = ''.join(query)
+            read.query_qualities = np.asarray(rng.integers(2, 42, len(query)), dtype = np.uint8)
+            reads.append(read)
+    reads.sort(key = lambda r: (r.reference_id, r.reference_start))
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': c, 'LN': n} for c, n in contigs.items()]}
+    path = str(tmp_path / ('reads' + suffix))
+    with pysam.AlignmentFile(path, 'wc' if suffix == '.cram' else 'wb', header = header, reference_filename = fasta) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(path)
+    #the pileup text of the same alignments, from the samtools mpileup that pysam bundles.
+    pileup = str(tmp_path / 'reads.pileup')
+    with open(pileup, 'w') as outf:
+        outf.write(pysam.mpileup('-B', '-f', fasta, path))
+    return path, fasta, pileup
+
+def site_rows(batches):
+    #every column of every site, with the kept reads, their quality values and strands.
+    rows = []
+    for batch in batches:
+        for i in range(len(batch)):
+            reads = slice(batch.offsets[i], batch.offsets[i+1])
+            rows.append(batch.fields(i)[:4] + [batch.bases[reads].tobytes(), batch.quals[reads].tobytes(), batch.reverse[reads].tobytes()])
+    return rows
+
+@pytest.mark.parametrize('suffix', ['.bam', '.cram'])
+def test_sites_match_mpileup_text(tmp_path, suffix):
+    path, fasta, pileup = simulate_alignments(tmp_path, suffix)
+    text = site_rows(pileup_parser.read_batches(pileup))
+    assert len(text) > 4000
+    assert site_rows(pileup_parser.read_batches(path, reference = fasta)) == text
+    regions = [('chr1', 100, 900), ('chr2', 1, float('inf'))]
+    in_regions = [row for row in text if any([row[0] == c and s <= int(row[1]) <= e for c, s, e in regions])]
+    assert site_rows(bam_reader.iter_bam_batches(path, fasta, regions)) == in_regions
+
+def test_calls_match_mpileup_text(tmp_path, monkeypatch, vcf_header):
+    path, fasta, pileup = simulate_alignments(tmp_path, seed = 2)
+    outputs = []
+    for argv in (['-p', pileup], ['-p', path, '-f', fasta]):
+        output = tmp_path / ('out' + str(len(outputs)) + '.vcf')
+        run_main(monkeypatch, pileup_to_vcf, ['-a', vcf_header, '-o', output, '-d', '5', '-g', 'True'] + argv)
+        outputs.append(output.read_bytes())
+    assert outputs[0].count(b'\n') > 50
+    assert outputs[1] == outputs[0]
@@ -0,0 +1,59 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import benchmark_pileup
+import simulate_pileup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#the keys of a results file; --compare reads files written by older commits, so changing these breaks comparisons.
+RUN_KEYS = {'time', 'commit', 'python', 'numpy', 'host', 'settings', 'results'}
+SETTING_KEYS = {'depth', 'alt_rate', 'n_rate', 'pcr_rate', 'pcr_size', 'indel_rate', 'edge_rate', 'seed'}
+RESULT_KEYS = {'script', 'sites', 'seconds', 'sites_per_sec', 'peak_rss_mb', 'output_lines', 'cache_lookups', 'cache_misses', 'cache_hit_rate'}
+
+def simulated(seed, chunk = 700, **settings):
+    text = io.StringIO()
+    simulate_pileup.simulate(text, 2000, contigs = 2, chunk = chunk, seed = seed, **settings)
+    return text.getvalue()
+
+def test_simulator_is_deterministic(tmp_path):
+    settings = {'depth': ('negbin', [60, 4]), 'alt_rate': .02, 'pcr_rate': .05, 'indel_rate': .02, 'edge_rate': .01}
+    first = simulated(5, **settings)
+    assert simulated(5, **settings) == first
+    assert simulated(6, **settings) != first
+    lines = first.splitlines()
+    assert len(lines) == 2000
+    assert [line.split('\t')[0] for line in lines] == ['chr1'] * 1000 + ['chr2'] * 1000
+    assert all([len(line.split('\t')) == 6 for line in lines])
+    #the command line writes the same sites as the function, whose chunk size does not change them.
+    output = tmp_path / 'sim.pileup'
+    subprocess.run([sys.executable, os.path.join(ROOT, 'simulate_pileup.py'), '-n', '2000', '-c', '2', '-s', '5', '-d', 'negbin:60,4', '-a', '.02', '-p', '.05', '-i', '.02', '-e', '.01', '-o', str(output)], check = True)
+    assert output.read_text() == simulated(5, chunk = 100000, **settings)
+
+def run_harness(workdir, output, *argv):
+    command = [sys.executable, os.path.join(ROOT, 'benchmark_pileup.py'), '-n', '300', '-w', str(workdir), '-o', str(output), '-a', '.02', '-p', '.05'] + list(argv)
+    return subprocess.run(command, check = True, capture_output = True, text = True)
+
+def test_harness_smoke(tmp_path):
+    workdir = tmp_path / 'bench'
+    first = tmp_path / 'first.json'
+    run_harness(workdir, first)
+    results = json.loads(first.read_text())
+    assert set(results) == RUN_KEYS
+    assert set(results['settings']) == SETTING_KEYS
+    assert [r['script'] for r in results['results']] == benchmark_pileup.SCRIPTS
+    for r in results['results']:
+        assert set(r) == RESULT_KEYS
+        assert r['sites'] == 300 and r['seconds'] > 0 and r['peak_rss_mb'] > 0
+        assert r['cache_hit_rate'] == None or 0 <= r['cache_hit_rate'] <= 1
+    assert results['results'][0]['output_lines'] > 0 and results['results'][0]['cache_lookups'] > 0
+    #a second run reuses the pileup and compares the scripts it ran against the first.
+    pileups = sorted([name for name in os.listdir(workdir) if name.startswith('sim_')])
+    assert len(pileups) == 1
+    second = run_harness(workdir, tmp_path / 'second.json', '-s', 'pileup_to_vcf', 'remove_bad_entries', '--compare', str(first))
+    assert sorted([name for name in os.listdir(workdir) if name.startswith('sim_')]) == pileups
+    rows = [line.split('\t') for line in second.stdout.splitlines()]
+    assert rows[0] == ['script', 'sites', 'sites_per_sec', 'before', 'ratio']
+    assert [row[:2] for row in rows[1:]] == [['pileup_to_vcf', '300'], ['remove_bad_entries', '300']]
@@ -0,0 +1,118 @@
+import gzip
+import struct
+import numpy as np
+import pytest
+import bgzf
+
+def pileup_text(contigs = (('chr1', 9000), ('chr2', 40), ('chr3', 7000)), seed = 4):
+    #a sorted pileup long enough to fill many BGZF blocks, with a short contig that starts and ends inside one.
+    rng = np.random.default_rng(seed)
+    lines = []
+    for contig, nsites in contigs:
+        for pos in np.sort(rng.choice(nsites * 3, nsites, replace = False)) + 1:
+            depth = int(rng.integers(1, 12))
+            lines.append('\t'.join([contig, str(pos), 'A', str(depth), '.' * depth, '5' * depth]))
+    return ('\n'.join(lines) + '\n').encode()
+
+@pytest.fixture
+def compressed(tmp_path):
+    text = pileup_text()
+    plain = tmp_path / 'sites.pileup'
+    plain.write_bytes(text)
+    path = str(tmp_path / 'sites.pileup.gz')
+    bgzf.compress_pileup(str(plain), path)
+    return text, path
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_round_trip(tmp_path, threads):
+    text = pileup_text()
+    path = str(tmp_path / 'out.gz')
+    writer = bgzf.BgzfWriter(path, threads = threads)
+    for i in range(0, len(text), 5000):
+        writer.write(text[i:i+5000])
+    writer.close()
+    assert bgzf.is_bgzf(path) and bgzf.is_gzip(path)
+    assert gzip.open(path).read() == text
+    reader = bgzf.BgzfReader(path, threads)
+    assert reader.read() == text
+    reader.close()
+    assert bgzf.open_input(path).read() == text.decode()
+
+def test_seek_to_tell(compressed):
+    text, path = compressed
+    reader = bgzf.BgzfReader(path)
+    reader.read(123456)
+    voffset = reader.tell()
+    rest = reader.read()
+    reader.seek(voffset)
+    assert reader.read() == rest == text[123456:]
+    reader.close()
+
+def test_index_and_regions(compressed):
+    text, path = compressed
+    bgzf.write_index(path, bgzf.build_index(path))
+    index = bgzf.load_index(path)
+    assert list(index) == ['chr1', 'chr2', 'chr3']
+    regions = [('chr1', 1, 50), ('chr1', 12000, 20000), ('chr2', 1, 1000), ('chr3', 500, 9000), ('chr4', 1, 10)]
+    for contig, start, end in regions:
+        expected = [line for line in text.split(b'\n')[:-1] if bgzf.site_key(line)[0] == contig and start <= bgzf.site_key(line)[1] <= end]
+        got = b''.join(bgzf.iter_region_blocks(path, [(contig, start, end)], blocksize = 1000, index = index))
+        assert got.split(b'\n')[:-1] == expected
+
+def test_index_version(compressed):
+    text, path = compressed
+    with open(bgzf.index_path(path), 'w') as outf:
+        print('#pileup_index\tversion=0', file = outf)
+    with pytest.raises(ValueError):
+        bgzf.load_index(path)
+
+def test_tabix_chunks_cover_every_record(tmp_path):
+    lines = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+    for contig in ('chr1', 'chr2'):
+        for pos in range(1, 60000, 7):
+            lines.append('\t'.join([contig, str(pos), '.', 'A', 'T', '.', 'PASS', '.']))
+    path = str(tmp_path / 'calls.vcf.gz')
+    writer = bgzf.BgzfWriter(path)
+    writer.write(('\n'.join(lines) + '\n').encode())
+    writer.close()
+    bgzf.write_tabix(path)
+    tbi = gzip.open(path + '.tbi').read()
+    assert tbi[:4] == b'TBI\x01'
+    nref, fmt, col_seq, col_beg, col_end, meta, skip, lnm = struct.unpack('<8i', tbi[4:36])
+    assert (nref, fmt, col_seq, col_beg, col_end, meta, skip) == (2, 2, 1, 2, 0, ord('#'), 0)
+    assert tbi[36:36+lnm] == b'chr1\x00chr2\x00'
+    #read back each contig's bins and linear index.
+    at = 36 + lnm
+    refs = []
+    for _ in range(nref):
+        nbin, = struct.unpack('<i', tbi[at:at+4])
+        at += 4
+        bins = {}
+        for _ in range(nbin):
+            b, nchunk = struct.unpack('<Ii', tbi[at:at+8])
+            at += 8
+            bins[b] = [struct.unpack('<QQ', tbi[at+16*i:at+16*i+16]) for i in range(nchunk)]
+            at += 16 * nchunk
+        nintv, = struct.unpack('<i', tbi[at:at+4])
+        linear = struct.unpack('<' + str(nintv) + 'Q', tbi[at+4:at+4+8*nintv])
+        at += 4 + 8 * nintv
+        refs.append((bins, linear))
+    assert at == len(tbi)
+    records = {}
+    for line, vstart, vend in bgzf.iter_lines(path):
+        if not line.startswith(b'#'):
+            contig, pos = line.split(b'\t')[:2]
+            records[(contig.decode(), int(pos))] = vstart
+    reader = bgzf.BgzfReader(path)
+    for (contig, pos), vstart in records.items():
+        bins, linear = refs[['chr1', 'chr2'].index(contig)]
+        chunks = bins[bgzf.reg2bin(pos - 1, pos)]
+        assert any([start <= vstart < end for start, end in chunks])
+        assert linear[(pos - 1) >> 14] <= vstart
+    #every chunk starts on a record of its own contig.
+    for name, (bins, linear) in zip([b'chr1', b'chr2'], refs):
+        for chunks in bins.values():
+            for start, end in chunks:
+                reader.seek(start)
+                assert reader.read(len(name) + 1) == name + b'\t'
+    reader.close()
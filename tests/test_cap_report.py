@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+import pytest
+import simulate_pileup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope = 'module')
+def deep_pileup(tmp_path_factory):
+    #sites far deeper than the cap, many with a pcr cluster, so capped thresholds are looked up at most sites.
+    pileup = tmp_path_factory.mktemp('cap') / 'deep.pileup'
+    with open(pileup, 'w+') as outf:
+        simulate_pileup.simulate(outf, 300, seed = 3, depth = ('uniform', [1000, 3000]), alt_rate = .01, pcr_rate = .2, pcr_size = (10, 40))
+    return pileup
+
+def run(script, pileup, *argv):
+    #the stdout (or -o output) lines and stderr of one script run.
+    command = [sys.executable, os.path.join(ROOT, script)] + [str(a) for a in argv]
+    if script == 'remove_bad_entries.py':
+        output = str(pileup) + '.out'
+        done = subprocess.run(command + ['-i', str(pileup), '-o', output], capture_output = True, text = True, check = True)
+        return open(output).read().splitlines(), done.stderr
+    if script == 'collapse_pileup_to_mut.py':
+        done = subprocess.run(command + ['-e', str(pileup)], capture_output = True, text = True, check = True)
+    else:
+        with open(pileup) as inf:
+            done = subprocess.run(command, stdin = inf, capture_output = True, text = True, check = True)
+    return done.stdout.splitlines(), done.stderr
+
+def report_counts(err):
+    line = [line for line in err.splitlines() if line.startswith('Depth cap')][0]
+    numbers = [int(word.strip(',;')) for word in line.split(':')[1].split() if word.strip(',;').isdigit()]
+    return dict(zip(['exact', 'capped', 'lost', 'gained', 'changed'], numbers))
+
+@pytest.mark.parametrize('script', ['remove_bad_entries.py', 'get_best_mutations.py', 'collapse_pileup_to_mut.py'])
+def test_cap_report_counts_the_outputs(deep_pileup, script):
+    exact, _ = run(script, deep_pileup)
+    capped, err = run(script, deep_pileup, '--depth-cap', 200, '--cap-report')
+    counts = report_counts(err)
+    assert counts['exact'] == len(exact) > 100
+    assert counts['capped'] == len(capped)
+    differ = len(set(exact) ^ set(capped))
+    if script == 'collapse_pileup_to_mut.py':
+        #every base tested for a cluster is recorded once either way, so the cap only changes the order of a site's records, never the records or the mutation tracks.
+        assert sorted(exact) == sorted(capped) and counts['lost'] == counts['gained'] == counts['changed'] == 0
+    else:
+        assert 0 < counts['lost'] + counts['gained'] + counts['changed'] <= differ
@@ -0,0 +1,81 @@
+import functools
+import os
+import pytest
+import checkpoint
+import pileup_parser
+import pileup_to_vcf
+import remove_bad_entries
+from conftest import run_main
+
+class Interrupted(Exception):
+    pass
+
+@pytest.fixture
+def inputs(simulated_pileup, vcf_header):
+    return simulated_pileup(20000, contigs = 2, seed = 5, alt_rate = .02, pcr_rate = .05), vcf_header
+
+def interrupt_after(monkeypatch, module, name, batches):
+    #make module.name raise after it has handled the given number of batches, as if the run was killed there.
+    original = getattr(module, name)
+    calls = []
+    def wrapped(*args, **kwargs):
+        calls.append(1)
+        if len(calls) > batches:
+            raise Interrupted()
+        return original(*args, **kwargs)
+    monkeypatch.setattr(module, name, wrapped)
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    #many small batches, with a checkpoint after each one.
+    monkeypatch.setattr(pileup_parser, 'iter_offset_batches', functools.partial(pileup_parser.iter_offset_batches, blocksize = 1 << 16))
+    monkeypatch.setattr(checkpoint.Checkpoint, 'due', lambda self: True)
+
+def read(path):
+    with open(path) as inf:
+        return inf.read()
+
+def test_no_checkpoint_by_default(tmp_path, monkeypatch, inputs):
+    pileup, header = inputs
+    output = str(tmp_path / 'out.vcf')
+    monkeypatch.setattr(checkpoint.Checkpoint, 'save', lambda *args: pytest.fail('checkpoint saved without --checkpoint-interval'))
+    run_main(monkeypatch, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output])
+    assert not os.path.exists(checkpoint.checkpoint_path(output))
+
+def test_pileup_to_vcf_resume(tmp_path, monkeypatch, inputs, small_blocks):
+    pileup, header = inputs
+    full = str(tmp_path / 'full.vcf')
+    output = str(tmp_path / 'out.vcf')
+    run_main(monkeypatch, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', full])
+    with monkeypatch.context() as m:
+        interrupt_after(m, pileup_to_vcf, 'call_outputs', 5)
+        with pytest.raises(Interrupted):
+            run_main(m, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output, '--checkpoint-interval', '1'])
+    assert os.path.exists(checkpoint.checkpoint_path(output))
+    assert read(output) != read(full)
+    run_main(monkeypatch, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output, '--resume'])
+    assert read(output) == read(full)
+    assert not os.path.exists(checkpoint.checkpoint_path(output))
+
+def test_resume_needs_same_settings(tmp_path, monkeypatch, inputs, small_blocks):
+    pileup, header = inputs
+    output = str(tmp_path / 'out.vcf')
+    with monkeypatch.context() as m:
+        interrupt_after(m, pileup_to_vcf, 'call_outputs', 2)
+        with pytest.raises(Interrupted):
+            run_main(m, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output, '--checkpoint-interval', '1'])
+    with pytest.raises(AssertionError, match = 'different settings: mind'):
+        run_main(monkeypatch, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output, '--resume', '-d', '20'])
+
+def test_remove_bad_entries_resume(tmp_path, monkeypatch, inputs, small_blocks):
+    pileup, header = inputs
+    full, output = str(tmp_path / 'full.pileup'), str(tmp_path / 'out.pileup')
+    base = ['-i', pileup, '-a', header]
+    run_main(monkeypatch, remove_bad_entries, base + ['-o', full, '--vcf', full + '.vcf'])
+    with monkeypatch.context() as m:
+        interrupt_after(m, remove_bad_entries, 'filter_records', 4)
+        with pytest.raises(Interrupted):
+            run_main(m, remove_bad_entries, base + ['-o', output, '--vcf', output + '.vcf', '--checkpoint-interval', '1'])
+    run_main(monkeypatch, remove_bad_entries, base + ['-o', output, '--vcf', output + '.vcf', '--resume'])
+    assert read(output) == read(full)
+    assert read(output + '.vcf') == read(full + '.vcf')
@@ -0,0 +1,52 @@
+import os
+import pytest
+import cohort_plaintxt
+import pileup_to_plaintxt
+from conftest import run_main
+
+SAMPLES = ['S1', 'S2', 'S3']
+
+@pytest.fixture
+def manifest(tmp_path, simulated_pileup):
+    manifest = tmp_path / 'manifest.txt'
+    with open(manifest, 'w+') as outf:
+        for i, sample_id in enumerate(SAMPLES):
+            pileup = simulated_pileup(3000, name = sample_id + '.pileup', seed = i, depth = ('uniform', [40, 150]), alt_rate = .02, pcr_rate = .05, edge_rate = .01)
+            outf.write(sample_id + '\t' + pileup + '\n')
+    return str(manifest)
+
+def test_rerun_only_calls_missing_samples(tmp_path, monkeypatch, capsys, manifest):
+    output = tmp_path / 'cohort.txt'
+    argv = ['-m', manifest, '-o', str(output), '-t', '2', '-c', str(tmp_path / 'thresholds.txt')]
+    run_main(monkeypatch, cohort_plaintxt, argv)
+    workdir = str(output) + '.parts'
+    parts = {s: open(cohort_plaintxt.part_path(workdir, s), 'rb').read() for s in SAMPLES}
+    stamps = {s: os.stat(cohort_plaintxt.part_path(workdir, s)).st_mtime_ns for s in SAMPLES}
+    combined = output.read_bytes()
+    assert combined == b''.join([parts[s] for s in SAMPLES])
+    assert all([parts[s].count(b'\n') > 10 for s in SAMPLES])
+    #the cohort matches calling each sample on its own with pileup_to_plaintxt.
+    for s in SAMPLES:
+        single = tmp_path / (s + '.txt')
+        run_main(monkeypatch, pileup_to_plaintxt, ['-p', str(tmp_path / (s + '.pileup')), '-o', str(single), '-i', s])
+        assert single.read_bytes() == parts[s]
+    capsys.readouterr()
+    os.remove(cohort_plaintxt.part_path(workdir, 'S2'))
+    output.unlink()
+    run_main(monkeypatch, cohort_plaintxt, argv)
+    err = capsys.readouterr().err
+    assert 'Reusing 2 finished samples' in err
+    assert [line.split()[1] for line in err.splitlines() if line.startswith('[')] == ['S2:']
+    assert {s: os.stat(cohort_plaintxt.part_path(workdir, s)).st_mtime_ns for s in ('S1', 'S3')} == {s: stamps[s] for s in ('S1', 'S3')}
+    assert open(cohort_plaintxt.part_path(workdir, 'S2'), 'rb').read() == parts['S2']
+    assert output.read_bytes() == combined
+
+def test_shared_thresholds_are_saved(tmp_path, monkeypatch, manifest):
+    #thresholds computed by the workers in the shared table end up in the cache file, so a second cohort run computes none.
+    cache = tmp_path / 'thresholds.txt'
+    run_main(monkeypatch, cohort_plaintxt, ['-m', manifest, '-o', str(tmp_path / 'first.txt'), '-t', '2', '-c', str(cache)])
+    saved = cache.read_text()
+    assert saved.count('\n') > 3
+    run_main(monkeypatch, cohort_plaintxt, ['-m', manifest, '-o', str(tmp_path / 'second.txt'), '-t', '2', '-c', str(cache)])
+    assert cache.read_text() == saved
+    assert (tmp_path / 'second.txt').read_bytes() == (tmp_path / 'first.txt').read_bytes()
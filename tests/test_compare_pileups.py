@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+import pytest
+import compare_pileups
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'compare_pileups.py')
+CONTIGS = ['CP001391.1', 'NT_479533.1', 'NT_479534.1', 'NT_479535.1', 'NT_479536.1', 'NW_001.1', 'NC_029795.1']
+
+def write_pileup(path, offset):
+    #a few sites on each contig, including an unplaced scaffold, with some positions only in one of the two pileups.
+    with open(path, 'w+') as outf:
+        for chro in CONTIGS:
+            for pos in range(1 + offset, 30, 3):
+                outf.write('\t'.join([chro, str(pos), 'A', str(pos * 2 + offset), '.' * 3, '555']) + '\n')
+
+def old_rows(first, second):
+    #the rows the whole-file version of the script wrote: the default contigs in W, 2L, 2R, 3L, 3R, X order, positions sorted.
+    bdeps = {k: {} for k in ['W', '2L', '2R', '3L', '3R', 'X']}
+    for i, path in enumerate((first, second)):
+        with open(path) as inf:
+            for entry in inf:
+                spent = entry.split()
+                if spent[0] in compare_pileups.DEFAULT_CONTIGS:
+                    bdeps[compare_pileups.DEFAULT_CONTIGS[spent[0]]].setdefault(int(spent[1]), [0, 0])[i] = int(spent[3])
+    return [[chro, str(l), str(d[0]), str(d[1]), str(d[1] - d[0])] for chro, locd in bdeps.items() for l, d in sorted(locd.items())]
+
+def run(tmp_path, *options):
+    first, second, output = [str(tmp_path / name) for name in ('a.pileup', 'b.pileup', 'out.txt')]
+    write_pileup(first, 0)
+    write_pileup(second, 1)
+    printed = subprocess.run([sys.executable, SCRIPT, '-a', first, '-b', second, '-o', output] + list(options), capture_output = True, text = True, check = True).stdout
+    with open(output) as inf:
+        return first, second, [line.split() for line in inf], printed
+
+def test_default_contigs_match_old_output(tmp_path):
+    first, second, rows, printed = run(tmp_path)
+    assert rows == old_rows(first, second)
+    sums = [sum([int(r[2]) for r in rows]), sum([int(r[3]) for r in rows])]
+    assert printed.splitlines() == ['Sum of depth in pileup b1: ' + str(sums[0]), 'Sum of depth in pileup b2: ' + str(sums[1])]
+
+def test_all_contigs(tmp_path):
+    first, second, rows, printed = run(tmp_path, '--all-contigs')
+    assert [r[0] for r in rows if r[1] == '1'] == CONTIGS
+
+def test_contig_in_one_pileup_only(tmp_path):
+    #Wolbachia is only in the second pileup, so it is met there first; it must still rank before 2L in both.
+    first, second, output = [str(tmp_path / name) for name in ('a.pu', 'b.pu', 'out.txt')]
+    with open(first, 'w+') as outf:
+        outf.write('NT_479533.1\t5\tA\t3\t...\t555\nNT_479534.1\t7\tA\t2\t..\t55\n')
+    with open(second, 'w+') as outf:
+        outf.write('CP001391.1\t1\tA\t4\t....\t5555\nNT_479533.1\t5\tA\t1\t.\t5\nNT_479534.1\t7\tA\t2\t..\t55\n')
+    subprocess.run([sys.executable, SCRIPT, '-a', first, '-b', second, '-o', output], capture_output = True, text = True, check = True)
+    with open(output) as inf:
+        assert [line.split() for line in inf] == [['W', '1', '0', '4', '4'], ['2L', '5', '3', '1', '-2'], ['2R', '7', '2', '2', '0']]
+    subprocess.run([sys.executable, SCRIPT, '-a', first, '-b', second, '-o', output, '--all-contigs'], capture_output = True, text = True, check = True)
+    with open(output) as inf:
+        assert [line.split()[0] for line in inf] == ['CP001391.1', 'NT_479533.1', 'NT_479534.1']
+
+def test_reference_index_order(tmp_path):
+    #with -r the contig order comes from the .fai, so X listed first is no longer out of order.
+    first, second, output, fai = [str(tmp_path / name) for name in ('a.pu', 'b.pu', 'out.txt', 'ref.fa.fai')]
+    with open(first, 'w+') as outf:
+        outf.write('NC_029795.1\t2\tA\t1\t.\t5\nNT_479533.1\t5\tA\t3\t...\t555\n')
+    with open(second, 'w+') as outf:
+        outf.write('NT_479533.1\t5\tA\t1\t.\t5\n')
+    with open(fai, 'w+') as outf:
+        outf.write('NC_029795.1\t100\t13\t60\t61\nNT_479533.1\t100\t130\t60\t61\n')
+    subprocess.run([sys.executable, SCRIPT, '-a', first, '-b', second, '-o', output, '-r', fai], capture_output = True, text = True, check = True)
+    with open(output) as inf:
+        assert [line.split() for line in inf] == [['X', '2', '1', '0', '-1'], ['2L', '5', '3', '1', '-2']]
+
+def test_merge_contig_orders():
+    assert compare_pileups.merge_contig_orders(['a', 'c'], ['b', 'c', 'd']) == ['a', 'b', 'c', 'd']
+
+def test_default_contigs_in_pileup_order(tmp_path):
+    #Wolbachia appended after the fly arms, as in a combined reference: the rows follow the pileups and match the old rows, in another order.
+    first, second, output = [str(tmp_path / name) for name in ('a.pu', 'b.pu', 'out.txt')]
+    for path, offset in ((first, 0), (second, 1)):
+        with open(path, 'w+') as outf:
+            for chro in ['NT_479533.1', 'NW_001.1', 'NC_029795.1', 'CP001391.1']:
+                for pos in range(1, 8, 3):
+                    outf.write('\t'.join([chro, str(pos), 'A', str(pos + offset), '.', '5']) + '\n')
+    subprocess.run([sys.executable, SCRIPT, '-a', first, '-b', second, '-o', output], capture_output = True, text = True, check = True)
+    with open(output) as inf:
+        rows = [line.split() for line in inf]
+    assert len(rows) == 9
+    assert sorted(rows) == sorted(old_rows(first, second))
+    assert [r[0] for r in rows] == ['2L'] * 3 + ['X'] * 3 + ['W'] * 3
+
+def test_different_contig_orders_stop():
+    with pytest.raises(ValueError):
+        compare_pileups.merge_contig_orders(['a', 'b'], ['b', 'a'])
+    with pytest.raises(ValueError):
+        compare_pileups.ContigOrder(['a'])['b']
@@ -0,0 +1,61 @@
+import collections
+import pytest
+import pileup_parser
+import pcr_thresholds
+import density_tracks
+import collapse_pileup_to_mut
+import simulate_pileup
+
+def naive_counts(pileup, size, records):
+    #mutation, callable site and depth counts per (contig, window), counted line by line with collapse_pileup_to_mut's depth filter.
+    counts = [collections.Counter() for _ in density_tracks.TRACKS]
+    for record in records:
+        counts[0][(record[0], (int(record[1]) - 1) // size)] += 1
+    with open(pileup) as inf:
+        for line in inf:
+            spent = line.rstrip('\n').split('\t')
+            reads, quals = pileup_parser.clean_site(spent[4], spent[5])
+            depth = sum([1 for b, q in zip(reads, quals) if int(q) >= 2 and b != 'N'])
+            if depth > 5 and spent[2].upper() != 'N':
+                window = (spent[0], (int(spent[1]) - 1) // size)
+                counts[1][window] += 1
+                counts[2][window] += depth
+    return counts
+
+def read_track(prefix, size, track):
+    values = {}
+    with open(density_tracks.track_path(prefix, size, track)) as inf:
+        for line in inf:
+            contig, start, end, value = line.split()
+            assert int(end) - int(start) == size
+            values[(contig, int(start) // size)] = int(value)
+    return values
+
+@pytest.mark.parametrize('contigs', [1, 3])
+def test_tracks_match_naive_counts(tmp_path, contigs):
+    pileup = str(tmp_path / 'sim.pileup')
+    with open(pileup, 'w+') as outf:
+        simulate_pileup.simulate(outf, 9000, contigs = contigs, seed = 3, depth = ('uniform', [2, 40]), alt_rate = .01, n_rate = .05, edge_rate = .02)
+    #small blocks, so windows and contigs are split across batches.
+    sizes = [100, 1000]
+    prefix = str(tmp_path / 'tracks')
+    tracks = density_tracks.WindowTracks(prefix, sizes)
+    records = []
+    for batch in pileup_parser.read_batches(pileup, blocksize = 1 << 15):
+        records.extend(collapse_pileup_to_mut.call_records(batch, 2, pcr_thresholds.ThresholdCache(pnum = 200), tracks))
+    tracks.close()
+    assert len(records) > 0
+    for size in sizes:
+        expected = naive_counts(pileup, size, records)
+        windows = set(expected[0]) | set(expected[1])
+        for track, counts in zip(density_tracks.TRACKS, expected):
+            got = read_track(prefix, size, track)
+            assert set(got) == windows
+            assert got == {window: counts[window] for window in windows}
+
+def test_unsorted_contigs_are_refused(tmp_path):
+    tracks = density_tracks.WindowTracks(str(tmp_path / 'tracks'), [10])
+    tracks.add('chr1', [1, 2], [6, 7], [2])
+    tracks.add('chr2', [1], [6], [])
+    with pytest.raises(AssertionError):
+        tracks.add('chr1', [50], [6], [])
@@ -0,0 +1,48 @@
+import io
+import pytest
+import pileup_parser
+import pcr_thresholds
+import simulate_pileup
+import pileup_to_vcf
+import pileup_to_plaintxt
+import collapse_pileup_to_mut
+import remove_bad_entries
+import get_best_mutations
+import detect_pcr_dups
+
+def sample_blocks(nsites = 2000):
+    #a two sample pileup, and each sample's columns cut out as a single-sample pileup.
+    texts = []
+    for seed in (6, 7):
+        text = io.StringIO()
+        simulate_pileup.simulate(text, nsites, seed = seed, alt_rate = .02, pcr_rate = .05)
+        texts.append(text.getvalue().splitlines())
+    joined = [a + '\t' + '\t'.join(b.split('\t')[3:]) for a, b in zip(*texts)]
+    #the reference column comes from the first sample in both single-sample pileups.
+    second = ['\t'.join(a.split('\t')[:3] + b.split('\t')[3:]) for a, b in zip(*texts)]
+    return [('\n'.join(lines) + '\n').encode() for lines in (joined, texts[0], second)]
+
+def test_samples_match_single_sample_pileups():
+    joined, first, second = sample_blocks()
+    batch = pileup_parser.parse_block(joined, require = b'ACGT')
+    assert batch.nsamples == 2
+    for k, single in enumerate((first, second)):
+        expected = pileup_to_vcf.call_batch(pileup_parser.parse_block(single, require = b'ACGT'), pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+        found = pileup_to_vcf.call_batch(batch.sample(k), pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+        #sites kept for either sample are called for both, and the calls of this sample are the same.
+        assert found == expected
+        lines = pileup_to_plaintxt.call_batch(pileup_parser.parse_block(single, require = b'ACGT'), mind = 10, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+        assert pileup_to_plaintxt.call_batch(batch.sample(k), mind = 10, pcr_duplicate_track = pcr_thresholds.ThresholdCache()) == lines
+
+@pytest.mark.parametrize('stage', [collapse_pileup_to_mut.collapse_pileup_to_mut, remove_bad_entries.remove_bad_entries, get_best_mutations.best_mutations])
+def test_single_sample_stages_refuse_samples(stage):
+    batch = pileup_parser.parse_block(sample_blocks(50)[0])
+    with pytest.raises(AssertionError, match = 'single-sample pileups, but this one has 2 samples'):
+        list(stage([batch], pcr_thresholds.ThresholdCache()))
+    with pytest.raises(AssertionError, match = 'has 2 samples'):
+        list(stage([pileup_parser.as_records(batch)], pcr_thresholds.ThresholdCache()))
+
+def test_detect_pcr_dups_refuses_samples():
+    batch = pileup_parser.parse_block(sample_blocks(50)[0])
+    with pytest.raises(AssertionError, match = 'has 2 samples'):
+        list(detect_pcr_dups.detect_pcr_dups([pileup_parser.as_records(batch)]))
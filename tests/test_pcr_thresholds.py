@@ -0,0 +1,150 @@
+import argparse
+import itertools
+import statistics as st
+from math import comb
+from fractions import Fraction
+import numpy as np
+import pytest
+import pcr_thresholds
+import remove_bad_entries
+
+def random_sites(nsites = 300, seed = 2):
+    rng = np.random.default_rng(seed)
+    sites = [''.join(rng.choice(list('....ACGT*'), size = rng.integers(0, 40))) for _ in range(nsites)]
+    bases = np.frombuffer(''.join(sites).encode(), dtype = np.uint8)
+    offsets = np.zeros(nsites + 1, dtype = np.int64)
+    np.cumsum([len(s) for s in sites], out = offsets[1:])
+    return sites, bases, offsets
+
+def brute_index(leng, num, dup_prob):
+    #the smallest median gap reached by at least dup_prob of all placements, counted one by one.
+    medians = sorted([st.median(np.diff(locs)) for locs in itertools.combinations(range(leng), num)])
+    target = Fraction(repr(float(dup_prob))) * comb(leng, num)
+    for i, median in enumerate(medians):
+        if i + 1 >= target and (i + 1 == len(medians) or medians[i + 1] != median):
+            return float(median)
+
+def test_batch_dindex_matches_get_dindex():
+    sites, bases, offsets = random_sites()
+    medians, counts = pcr_thresholds.batch_dindex(bases, offsets)
+    for i, site in enumerate(sites):
+        dindex = pcr_thresholds.get_dindex(site.replace('*', 'N'))
+        for j, base in enumerate('ACGT'):
+            assert counts[i, j] == site.count(base)
+            if base in dindex:
+                assert medians[i, j] == dindex[base]
+            else:
+                assert np.isnan(medians[i, j])
+
+def test_site_dindeces_tests_bases_like_the_scripts():
+    sites, bases, offsets = random_sites()
+    chosen = np.arange(0, len(sites), 3)
+    dindeces = pcr_thresholds.site_dindeces(bases, offsets, chosen)
+    for i, dindex in zip(chosen, dindeces):
+        site = sites[i]
+        tested = any([2 <= site.count(b) <= len(site) / 4 for b in 'ACGT'])
+        assert (dindex != {}) == tested
+        if tested:
+            assert set(dindex) == set('ACGT')
+
+@pytest.mark.parametrize('leng,num', [(8, 2), (10, 3), (12, 4), (13, 5), (14, 6)])
+@pytest.mark.parametrize('dup_prob', [.01, .05, .3])
+def test_exact_index_matches_enumeration(leng, num, dup_prob):
+    assert pcr_thresholds.exact_index(leng, num, dup_prob) == brute_index(leng, num, dup_prob)
+
+@pytest.mark.parametrize('length,num', [(20, 8), (1000, 5)])
+def test_random_positions_rows(length, num):
+    locs = pcr_thresholds.random_positions(length, num, 500, np.random.default_rng(3))
+    assert locs.shape == (500, num)
+    assert locs.min() >= 0 and locs.max() < length
+    assert np.all(np.diff(locs, axis = 1) > 0)
+
+def test_thresholds_do_not_depend_on_lookup_order():
+    keys = [(40, 3), (60, 5), (9, 2), (200, 12)]
+    first = pcr_thresholds.ThresholdCache(pnum = 200)
+    second = pcr_thresholds.ThresholdCache(pnum = 200)
+    assert [first[k] for k in keys] == [second[k] for k in reversed(keys)][::-1]
+    assert first.hit_rate() == 0
+    first[(40, 3)]
+    assert first.hit_rate() == 1 - 4 / 5
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'thresholds.txt')
+    cache = pcr_thresholds.ThresholdCache(path, pnum = 200)
+    cache.precompute(20)
+    cache.save()
+    other = pcr_thresholds.ThresholdCache(path, pnum = 300)
+    other[(12, 3)]
+    other.save()
+    loaded = pcr_thresholds.ThresholdCache(path, pnum = 200)
+    assert dict(loaded) == dict(cache)
+    assert loaded.computed == 0
+    assert dict(pcr_thresholds.ThresholdCache(path, pnum = 300)) == dict(other)
+
+def test_cache_version_mismatch(tmp_path):
+    path = tmp_path / 'thresholds.txt'
+    path.write_text('#pcr_thresholds\tversion=1\n')
+    with pytest.raises(ValueError):
+        pcr_thresholds.ThresholdCache(str(path))
+
+def test_merge_adds_missing_entries(tmp_path):
+    cache = pcr_thresholds.ThresholdCache(pnum = 200)
+    cache[(20, 2)]
+    worker = pcr_thresholds.ThresholdCache(pnum = 200)
+    worker[(20, 2)]
+    worker[(30, 4)]
+    cache.merge(worker.items())
+    assert dict(cache) == dict(worker)
+    assert cache.added == 2
+
+@pytest.mark.parametrize('length,basecount', [(1000, 100), (2000, 40), (1000, 20), (10000, 30), (3000, 600)])
+def test_depth_cap_stays_near_the_full_threshold(length, basecount):
+    cache = pcr_thresholds.ThresholdCache(depth_cap = 200)
+    full = pcr_thresholds.perm_index(length, basecount, rng = np.random.default_rng([0, length, basecount]))
+    assert .75 <= cache[(length, basecount)] / full <= 1.25
+    assert all([key[0] == 200 for key in cache])
+
+def test_depth_cap_keeps_keys_at_the_cap():
+    cache = pcr_thresholds.ThresholdCache(pnum = 200, depth_cap = 50)
+    plain = pcr_thresholds.ThresholdCache(pnum = 200)
+    assert cache[(40, 5)] == plain[(40, 5)]
+    assert cache[(200, 5)] == plain[(50, 5)] * 4
+    assert cache[(400, 60)] == plain[(50, 6)] * 400 * 6 / (60 * 50)
+    assert set(cache) == {(40, 5), (50, 5), (50, 6)}
+    cache.precompute(500)
+    assert max([length for length, _ in cache]) == 50
+
+def test_depth_cap_keeps_scattered_bases():
+    #40 randomly scattered A's at depth 1000 are no cluster, with or without the cap.
+    rng = np.random.default_rng(7)
+    nalts = ['.'] * 1000
+    for i in rng.choice(1000, 40, replace = False):
+        nalts[i] = 'A'
+    nalts = ''.join(nalts)
+    for cache in (pcr_thresholds.ThresholdCache(), pcr_thresholds.ThresholdCache(depth_cap = 200)):
+        entry, _ = remove_bad_entries.filter_record(['chr1', '1', 'C', '1000', nalts, 'I' * 1000], nalts, 'I' * 1000, cache)
+        assert entry[4].count('A') == 40
+
+def test_shared_thresholds_match_cache():
+    keys = [(12, 2), (40, 3), (60, 15), (90, 4)]
+    cache = pcr_thresholds.ThresholdCache(pnum = 200)
+    buffer = pcr_thresholds.shared_table(64, [((12, 2), cache[(12, 2)])])
+    shared = pcr_thresholds.SharedThresholds(buffer, 64, pnum = 200)
+    assert [shared[k] for k in keys] == [cache[k] for k in keys]
+    #(12, 2) was in the table already and (90, 4) lies beyond it, so this process computed and kept the other two.
+    assert set(shared) == {(40, 3), (60, 15), (90, 4)}
+    other = pcr_thresholds.SharedThresholds(buffer, 64, pnum = 200)
+    assert other[(40, 3)] == cache[(40, 3)]
+    assert other.computed == 0
+
+def test_from_args_reads_the_shared_options(tmp_path):
+    parser = argparse.ArgumentParser()
+    pcr_thresholds.add_arguments(parser)
+    path = str(tmp_path / 'thresholds.txt')
+    args = parser.parse_args(['-c', path, '--seed', '3', '-b', 'exact', '--depth-cap', '50'])
+    cache = pcr_thresholds.from_args(args)
+    assert (cache.path, cache.seed, cache.backend, cache.depth_cap, cache.dup_prob) == (path, 3, 'exact', 50, .05)
+    exact = pcr_thresholds.from_args(args, path = None, depth_cap = None, dup_prob = .1)
+    assert (exact.path, exact.seed, exact.backend, exact.depth_cap, exact.dup_prob) == (None, 3, 'exact', None, .1)
+    defaults = pcr_thresholds.from_args(parser.parse_args([]))
+    assert (defaults.path, defaults.seed, defaults.backend, defaults.depth_cap) == (None, 0, 'permutation', None)
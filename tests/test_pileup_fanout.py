@@ -0,0 +1,45 @@
+import gzip
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def script(name, *argv, stdout = None):
+    return subprocess.run([sys.executable, os.path.join(ROOT, name)] + [str(a) for a in argv], stdout = stdout, check = True)
+
+@pytest.fixture
+def inputs(simulated_pileup, vcf_header):
+    return simulated_pileup(5000, contigs = 2, seed = 9, depth = ('uniform', [5, 120]), alt_rate = .03, pcr_rate = .05, indel_rate = .02, edge_rate = .01), vcf_header
+
+def separate_outputs(tmp_path, pileup, header):
+    #each script run on its own, with the same settings as the fan-out run.
+    script('pileup_to_vcf.py', '-a', header, '-p', pileup, '-o', tmp_path / 'vcf.vcf', '-d', 20)
+    script('pileup_to_vcf_snpg.py', '-a', header, '-p', pileup, '-o', tmp_path / 'snpg.vcf')
+    script('pileup_to_plaintxt.py', '-p', pileup, '-o', tmp_path / 'plain.txt', '-d', 30, '-i', 'S1')
+    with open(tmp_path / 'collapse.txt', 'w+') as outf:
+        script('collapse_pileup_to_mut.py', '-e', pileup, '-t', 3, stdout = outf)
+    return {name: (tmp_path / name).read_bytes() for name in ('vcf.vcf', 'snpg.vcf', 'plain.txt', 'collapse.txt')}
+
+def test_fanout_matches_separate_scripts(tmp_path, inputs):
+    pileup, header = inputs
+    expected = separate_outputs(tmp_path, pileup, header)
+    out = tmp_path / 'fanout'
+    out.mkdir()
+    script('pileup_fanout.py', '-p', pileup, '-a', header, '--vcf', out / 'vcf.vcf', '--vcf-mind', 20, '--snpg', out / 'snpg.vcf',
+        '--plaintxt', out / 'plain.txt', '--plaintxt-mind', 30, '-i', 'S1', '--collapse', out / 'collapse.txt', '--collapse-threshold', 3)
+    for name, text in expected.items():
+        assert text.count(b'\n') > 10
+        assert (out / name).read_bytes() == text
+
+def test_fanout_bgzip(tmp_path, inputs):
+    pileup, header = inputs
+    expected = separate_outputs(tmp_path, pileup, header)
+    out = tmp_path / 'fanout'
+    out.mkdir()
+    script('pileup_fanout.py', '-p', pileup, '-a', header, '-z', '--vcf', out / 'vcf.vcf', '--vcf-mind', 20, '--plaintxt', out / 'plain.txt.gz', '--plaintxt-mind', 30, '-i', 'S1')
+    assert gzip.open(out / 'vcf.vcf').read() == expected['vcf.vcf']
+    assert gzip.open(out / 'plain.txt.gz').read() == expected['plain.txt']
+    assert (out / 'vcf.vcf.tbi').exists()
+    assert not (out / 'plain.txt.gz.tbi').exists()
@@ -0,0 +1,111 @@
+import io
+import importlib
+import numpy as np
+import pytest
+import pileup_parser
+import pcr_thresholds
+import pileup_to_vcf
+import pileup_to_plaintxt
+import collapse_pileup_to_mut
+import simulate_pileup
+
+def strand_pileup(nsites = 40):
+    #sites alternating between forward strand alternatives and alternatives seen only on the reverse strand (lower case, with , reference matches).
+    lines = []
+    for i in range(nsites):
+        bases = '....AA...A..' if i % 2 == 0 else '..,,a.,a,.a,'
+        lines.append('\t'.join(['chr1', str(100 + i), 'G', str(len(bases)), bases, '5' * len(bases)]))
+    return ('\n'.join(lines) + '\n').encode()
+
+def per_line(block, function):
+    #the lines the per-line version of a script makes, for comparison with its batch version.
+    lines = []
+    for entry in block.decode().splitlines():
+        line, _ = function(entry.split(), pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+        if line != None:
+            lines.append(line)
+    return lines
+
+def test_tokenize_markup():
+    raw = np.frombuffer(b'^].$+2AC,a-1g*T^^,$', dtype = np.uint8)
+    codes, reverse, offsets = pileup_parser.tokenize(raw, np.array([0, len(raw)]))
+    assert codes.tobytes() == b'..A*T.'
+    assert reverse.tolist() == [False, True, True, False, False, True]
+    assert offsets.tolist() == [0, 6]
+
+def test_tokenize_matches_site_walker():
+    rng = np.random.default_rng(1)
+    alphabet = list('.,ACGTNacgtn*#<>$') + ['^' + c for c in '!A^$+5'] + ['+2AG', '-1c', '+12ACGTACGTACGT']
+    columns = [''.join(rng.choice(alphabet, size = rng.integers(0, 30))) for _ in range(200)]
+    raw = np.frombuffer(''.join(columns).encode(), dtype = np.uint8)
+    raw_offsets = np.zeros(len(columns) + 1, dtype = np.int64)
+    np.cumsum([len(c) for c in columns], out = raw_offsets[1:])
+    codes, reverse, offsets = pileup_parser.tokenize(raw, raw_offsets)
+    for i, column in enumerate(columns):
+        reads, strands, _ = pileup_parser.tokenize_site(column, 'x' * (offsets[i+1] - offsets[i]))
+        assert codes[offsets[i]:offsets[i+1]].tobytes().decode() == reads
+        assert reverse[offsets[i]:offsets[i+1]].tolist() == list(strands)
+
+def test_parse_block_columns():
+    block = b'chr1\t5\tA\t3\t.,T\t567\nchr2\t7\tc\t0\t*\t*\n'
+    batch = pileup_parser.parse_block(block)
+    assert len(batch) == 2
+    assert batch.fields(0) == ['chr1', '5', 'A', '3', '.,T', '567']
+    assert batch.positions().tolist() == [5, 7]
+    assert batch.bases.tobytes() == b'..T'
+    assert batch.quals.tolist() == [5, 6, 7]
+    assert batch.offsets.tolist() == [0, 3, 3]
+    assert batch.contig_runs() == [('chr1', 0, 1), ('chr2', 1, 2)]
+
+def test_require_keeps_reverse_strand_sites():
+    block = strand_pileup()
+    assert len(pileup_parser.parse_block(block, require = b'ACGT')) == 40
+    assert len(pileup_parser.parse_block(b'chr1\t1\tA\t3\t.,.\t555\n', require = b'ACGT')) == 0
+
+def test_batch_matches_per_line_vcf():
+    block = strand_pileup()
+    batch = pileup_parser.parse_block(block, require = b'ACGT')
+    lines = pileup_to_vcf.call_batch(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    assert len(lines) == 40
+    assert lines == per_line(block, pileup_to_vcf.make_vcf_line)
+
+def test_batch_matches_per_line_plaintxt():
+    block = strand_pileup()
+    batch = pileup_parser.parse_block(block, require = b'ACGT')
+    lines = pileup_to_plaintxt.call_batch(batch, mind = 10, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    assert len(lines) == 40
+    assert lines == per_line(block, pileup_to_plaintxt.make_vcf_line)
+
+def test_collapse_calls_reverse_strand_sites():
+    batch = pileup_parser.parse_block(strand_pileup(), require = b'ACGT')
+    records = collapse_pileup_to_mut.call_records(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    assert [r[1] for r in records] == [str(100 + i) for i in range(40)]
+    assert set([r[3] for r in records]) == {'A'}
+
+def test_text_and_store_input_agree(tmp_path):
+    import site_store
+    path = str(tmp_path / 'strand.pileup')
+    with open(path, 'wb') as outf:
+        outf.write(strand_pileup())
+    site_store.build_store(path, str(tmp_path / 'store'))
+    text = [pileup_to_vcf.call_batch(b, pcr_duplicate_track = pcr_thresholds.ThresholdCache()) for b in pileup_parser.read_batches(path, require = b'ACGT')]
+    store = [pileup_to_vcf.call_batch(b, pcr_duplicate_track = pcr_thresholds.ThresholdCache()) for b in pileup_parser.read_batches(str(tmp_path / 'store'), require = b'ACGT')]
+    assert sum(text, []) == sum(store, [])
+    assert len(sum(text, [])) == 40
+
+@pytest.mark.parametrize('script', ['pileup_to_vcf', 'pileup_to_vcf_snpg', 'pileup_to_plaintxt', 'get_best_mutations'])
+def test_batch_matches_per_line_on_simulated_sites(script):
+    #simulated sites with read markup, reverse strand reads, Ns and pcr clusters, at depths around each script's filter.
+    module = importlib.import_module(script)
+    text = io.StringIO()
+    simulate_pileup.simulate(text, 3000, seed = 8, depth = ('uniform', [5, 120]), alt_rate = .03, n_rate = .02, pcr_rate = .05, edge_rate = .02)
+    block = text.getvalue().encode()
+    batch = pileup_parser.parse_block(block)
+    if script == 'get_best_mutations':
+        lines = ['\t'.join(record) for record in module.best_batch(batch, pcr_thresholds.ThresholdCache(), mind = 40)]
+        expected = per_line(block, lambda spent, pcr_duplicate_track: module.make_pileup_line(spent, 40, pcr_duplicate_track))
+    else:
+        lines = module.call_batch(batch, 40, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+        expected = per_line(block, lambda spent, pcr_duplicate_track: module.make_vcf_line(spent, 40, pcr_duplicate_track = pcr_duplicate_track))
+    assert len(lines) > 0
+    assert lines == expected
@@ -0,0 +1,57 @@
+import os
+import shlex
+import subprocess
+import sys
+import pytest
+import pcr_thresholds
+import pileup_pipeline
+import simulate_pileup
+from conftest import VCF_HEADER, run_main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#the shell pipelines of the scripts, each with the -s values of the same chain in one process and the simulated pileup it reads.
+CHAINS = [
+    ('remove_bad_entries.py -t 3 | pileup_to_vcf.py -a {header} -d 20', ['remove_bad_entries:threshold=3', 'pileup_to_vcf:header={header},mind=20'], 'sim'),
+    ('remove_bad_entries.py | pileup_to_vcf.py -a {header} -g True', ['remove_bad_entries', 'pileup_to_vcf:header={header},germline=True'], 'sim'),
+    ('detect_pcr_dups.py | get_best_mutations.py', ['detect_pcr_dups', 'get_best_mutations'], 'pcr'),
+    ('get_best_mutations.py | remove_bad_entries.py | pileup_to_vcf.py -a {header}', ['get_best_mutations', 'remove_bad_entries', 'pileup_to_vcf:header={header}'], 'pcr'),
+    ('detect_pcr_dups.py | remove_bad_entries.py -s | collapse_pileup_to_mut.py', ['detect_pcr_dups', 'remove_bad_entries:remove_singleton=True', 'collapse_pileup_to_mut'], 'pcr'),
+]
+
+@pytest.fixture(scope = 'module')
+def inputs(tmp_path_factory):
+    #an ordinary simulated pileup, and a deep one where many sites carry large pcr clusters besides scattered alternatives, for detect_pcr_dups and get_best_mutations to keep.
+    tmp = tmp_path_factory.mktemp('pipeline')
+    pileups = {}
+    for name, settings in [('sim', {'nsites': 3000, 'seed': 11, 'depth': ('uniform', [10, 200]), 'alt_rate': .03, 'pcr_rate': .1}),
+        ('pcr', {'nsites': 1500, 'seed': 12, 'depth': ('uniform', [100, 250]), 'alt_rate': .05, 'pcr_rate': .4, 'pcr_size': (12, 24)})]:
+        pileups[name] = tmp / (name + '.pileup')
+        with open(pileups[name], 'w+') as outf:
+            simulate_pileup.simulate(outf, contigs = 2, indel_rate = .02, edge_rate = .01, **settings)
+    header = tmp / 'header.txt'
+    header.write_text(VCF_HEADER)
+    return pileups, header
+
+def run_text_pipes(command, pileup, output):
+    #the scripts one after another, joined by text pipes in the shell.
+    scripts = [shlex.quote(sys.executable) + ' ' + os.path.join(ROOT, part.strip()) for part in command.split('|')]
+    scripts[0] += ' < ' + shlex.quote(str(pileup))
+    subprocess.run(' | '.join(scripts) + ' > ' + shlex.quote(str(output)), shell = True, check = True, stdin = subprocess.DEVNULL)
+
+@pytest.mark.parametrize('command,specs,name', CHAINS)
+def test_chain_matches_text_pipes(inputs, tmp_path, command, specs, name):
+    pileups, header = inputs
+    pileup = pileups[name]
+    expected = tmp_path / 'shell.txt'
+    run_text_pipes(command.format(header = header), pileup, expected)
+    output = tmp_path / 'chained.txt'
+    stages = [pileup_pipeline.parse_stage(spec.format(header = header)) for spec in specs]
+    count = pileup_pipeline.run_pipeline(str(pileup), str(output), stages, pcr_thresholds.ThresholdCache())
+    assert count > 10
+    assert output.read_bytes() == expected.read_bytes()
+
+def test_vcf_stage_must_be_last(inputs, tmp_path, monkeypatch):
+    pileups, header = inputs
+    with pytest.raises(AssertionError):
+        run_main(monkeypatch, pileup_pipeline, ['-p', pileups['sim'], '-o', tmp_path / 'out.txt', '-s', 'pileup_to_vcf:header=' + str(header), '-s', 'fix_chr'])
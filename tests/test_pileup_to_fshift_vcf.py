@@ -0,0 +1,45 @@
+import functools
+import multiprocessing
+import pytest
+import pileup_parser
+import pileup_to_fshift_vcf
+from conftest import run_main
+
+CHUNKSIZE = 1 << 14
+
+#ordinary simulated sites around a run where every site is deep and has quality alternatives and indel tokens, so the carry is never reset
+#inside it and the run spans several ranges of CHUNKSIZE bytes.
+STRETCHES = [(1000, 1, {'alt_rate': .02, 'pcr_rate': .05, 'edge_rate': .01}),
+    (1500, 2, {'depth': ('uniform', [40, 100]), 'alt_rate': .2, 'n_rate': 0, 'indel_rate': .3}),
+    (1000, 3, {'alt_rate': .02, 'pcr_rate': .05, 'indel_rate': .02})]
+
+def test_ranges_join_to_single_process_output(tmp_path, monkeypatch, simulated_pileup, vcf_header):
+    pileup = simulated_pileup(stretches = STRETCHES)
+    monkeypatch.setattr(pileup_parser, 'split_ranges', functools.partial(pileup_parser.split_ranges, chunksize = CHUNKSIZE))
+    serial = tmp_path / 'serial.vcf'
+    threaded = tmp_path / 'threaded.vcf'
+    run_main(monkeypatch, pileup_to_fshift_vcf, ['-a', vcf_header, '-p', pileup, '-o', serial])
+    run_main(monkeypatch, pileup_to_fshift_vcf, ['-a', vcf_header, '-p', pileup, '-o', threaded, '--threads', '2'])
+    assert serial.read_text().count('\n') > 1000
+    assert threaded.read_bytes() == serial.read_bytes()
+    #called range by range in this process: ranges inside the run have no reset site and leave their sites to the range the run started in,
+    #whose worker carries the depth and alternatives on through the following blocks.
+    monkeypatch.setattr(pileup_to_fshift_vcf, 'following_blocks', functools.partial(pileup_to_fshift_vcf.following_blocks, step = 1 << 12))
+    pileup_to_fshift_vcf.init_worker(None, 0, 'permutation')
+    outputs = [pileup_to_fshift_vcf.pool_call_range((pileup, start, end, 10, False))[0] for start, end in pileup_parser.split_ranges(pileup)]
+    assert sum([lines == [] for lines in outputs]) >= 3
+    body = [line for line in serial.read_text().splitlines() if not line.startswith('#')]
+    assert sum(outputs, []) == body
+
+class Failed(Exception):
+    pass
+
+def fail_range(task):
+    raise Failed()
+
+def test_failed_range_leaves_no_workers(tmp_path, monkeypatch, simulated_pileup, vcf_header):
+    pileup = simulated_pileup(stretches = STRETCHES)
+    monkeypatch.setattr(pileup_to_fshift_vcf, 'pool_call_range', fail_range)
+    with pytest.raises(Failed):
+        run_main(monkeypatch, pileup_to_fshift_vcf, ['-a', vcf_header, '-p', pileup, '-o', tmp_path / 'out.vcf', '--threads', '2'])
+    assert multiprocessing.active_children() == []
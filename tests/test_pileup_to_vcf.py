@@ -0,0 +1,41 @@
+import functools
+import multiprocessing
+import pytest
+import pileup_parser
+import pileup_to_vcf
+from conftest import run_main
+
+CHUNKSIZE = 1 << 14
+
+#two simulated stretches around one without alternatives, long enough that some ranges of CHUNKSIZE bytes lie inside it.
+STRETCHES = [(1500, 1, {'alt_rate': .02, 'pcr_rate': .05, 'indel_rate': .02, 'edge_rate': .01}),
+    (400, 2, {'alt_rate': 0, 'n_rate': 0, 'pcr_rate': 0}),
+    (1500, 3, {'alt_rate': .02, 'pcr_rate': .05})]
+
+def test_threads_match_single_process(tmp_path, monkeypatch, simulated_pileup, vcf_header):
+    pileup = simulated_pileup(stretches = STRETCHES)
+    monkeypatch.setattr(pileup_parser, 'split_ranges', functools.partial(pileup_parser.split_ranges, chunksize = CHUNKSIZE))
+    #at least one range has no site with an alternative, so the require filter of parse_block leaves it empty.
+    empty = [len(pileup_parser.parse_block(pileup_parser.read_range(pileup, start, end), require = b'ACGT')) == 0 for start, end in pileup_parser.split_ranges(pileup)]
+    assert any(empty) and not all(empty)
+    serial = tmp_path / 'serial.vcf'
+    threaded = tmp_path / 'threaded.vcf'
+    run_main(monkeypatch, pileup_to_vcf, ['-a', vcf_header, '-p', pileup, '-o', serial])
+    run_main(monkeypatch, pileup_to_vcf, ['-a', vcf_header, '-p', pileup, '-o', threaded, '--threads', '2'])
+    assert serial.read_text().count('\n') > 100
+    assert threaded.read_bytes() == serial.read_bytes()
+
+class Failed(Exception):
+    pass
+
+def fail_range(task):
+    raise Failed()
+
+def test_failed_range_leaves_no_workers(tmp_path, monkeypatch, simulated_pileup, vcf_header):
+    #the workers are forked after the patch, so every range fails in them.
+    pileup = simulated_pileup(stretches = STRETCHES)
+    monkeypatch.setattr(pileup_parser, 'split_ranges', functools.partial(pileup_parser.split_ranges, chunksize = CHUNKSIZE))
+    monkeypatch.setattr(pileup_to_vcf, 'pool_call_range', fail_range)
+    with pytest.raises(Failed):
+        run_main(monkeypatch, pileup_to_vcf, ['-a', vcf_header, '-p', pileup, '-o', tmp_path / 'out.vcf', '--threads', '2'])
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,40 @@
+import io
+import sys
+import numpy as np
+import pytest
+from scipy.stats import betabinom
+from scipy.optimize import check_grad
+import predict_freq
+
+def sample_histogram(a = .5, b = 20, nsites = 5000, seed = 6):
+    rng = np.random.default_rng(seed)
+    depths = rng.integers(20, 200, nsites)
+    seen = betabinom.rvs(depths, a, b, random_state = rng)
+    histogram = {}
+    for s, d in zip(seen.tolist(), depths.tolist()):
+        histogram[(s, d)] = histogram.get((s, d), 0) + 1
+    return histogram
+
+@pytest.mark.parametrize('a,b', [(.1, 10), (.5, 20), (3, 2)])
+def test_objective_is_the_beta_binomial_likelihood(a, b):
+    histogram = sample_histogram()
+    expected = -sum([count * betabinom.logpmf(s, d, a, b) for (s, d), count in histogram.items()])
+    assert predict_freq.objective([a, b], *predict_freq.histogram_arrays(histogram)) == pytest.approx(expected, rel = 1e-10)
+    assert predict_freq.objective([-a, b], *predict_freq.histogram_arrays(histogram)) == np.inf
+
+@pytest.mark.parametrize('a,b', [(.1, 10), (.5, 20), (3, 2)])
+def test_gradient_matches_finite_differences(a, b):
+    data = predict_freq.histogram_arrays(sample_histogram())
+    error = check_grad(predict_freq.objective, predict_freq.gradient, np.array([a, b]), *data, epsilon = 1e-7)
+    assert error < 1e-4 * np.linalg.norm(predict_freq.gradient(np.array([a, b]), *data))
+
+def test_optimize_recovers_parameters():
+    result = predict_freq.optimize(sample_histogram(nsites = 20000), .1, 10, 'L-BFGS-B', 1e-8)
+    assert result.success
+    assert result.x == pytest.approx([.5, 20], rel = .15)
+
+def test_parse_pileup_histogram(monkeypatch):
+    text = 'chr1\t1\tA\t10\t..CC..T...\t5555555555\nchr1\t2\tA\t10\tCCCC......\t5555555555\nchr1\t3\tA\t4\t..G.\t5555\n'
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(text))
+    #the second site's C is at frequency .4, over the cap; the third site is not deeper than mind.
+    assert predict_freq.parse_pileup(mind = 5) == {(0, 10): 5, (2, 10): 1, (1, 10): 1}
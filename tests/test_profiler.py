@@ -0,0 +1,56 @@
+import json
+import pytest
+import profiler
+import pileup_to_vcf
+import remove_bad_entries
+from conftest import run_main
+
+@pytest.fixture
+def inputs(monkeypatch, simulated_pileup, vcf_header):
+    #each run enables its own profile; put the null one back afterwards.
+    monkeypatch.setattr(profiler, 'active', profiler.NullProfile())
+    return simulated_pileup(2000, seed = 4, depth = ('uniform', [2, 60]), alt_rate = .03, pcr_rate = .1, edge_rate = .01), vcf_header
+
+def records(path):
+    with open(path) as inf:
+        return len([line for line in inf if not line.startswith('#')])
+
+def report_rows(err):
+    #the rows of the stderr table, by their first column.
+    rows = {}
+    for line in err.splitlines():
+        fields = line.split('\t')
+        rows.setdefault(fields[0], []).append(fields[1:])
+    return rows
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_vcf_rejects_add_up(inputs, tmp_path, monkeypatch, capsys, threads):
+    pileup, header = inputs
+    output = tmp_path / 'out.vcf'
+    profile = tmp_path / 'profile.json'
+    run_main(monkeypatch, pileup_to_vcf, ['-a', header, '-p', pileup, '-o', output, '--profile', profile, '--threads', str(threads)])
+    summary = json.loads(profile.read_text())
+    assert summary['script'] == 'pileup_to_vcf'
+    assert set(summary['stages']) == {'parse', 'filter', 'pcr_test', 'format', 'write'}
+    assert {'depth', 'quality'} <= set(summary['rejected']) <= {'depth', 'quality', 'pcr_cluster'}
+    #every site the parser kept is either rejected by one filter or written as a vcf line.
+    assert summary['counts']['sites'] == sum(summary['rejected'].values()) + records(output)
+    assert summary['rejected']['depth'] > 0 and summary['rejected']['quality'] > 0
+    cache = summary['cache']
+    assert cache['hits'] + cache['misses'] == cache['lookups'] > 0
+    rows = report_rows(capsys.readouterr().err)
+    assert rows['stage'] == [['seconds', 'percent', 'calls']]
+    assert [r[0] for r in rows['rejected']] == sorted(summary['rejected'])
+    assert {r[0]: int(r[1]) for r in rows['rejected']} == summary['rejected']
+    assert {r[0]: int(r[1]) for r in rows['count']}['sites'] == summary['counts']['sites']
+    assert len(rows['thresholds']) == 1 and 'total' in rows
+
+def test_remove_bad_entries_rejects_add_up(inputs, tmp_path, monkeypatch):
+    pileup, header = inputs
+    output = tmp_path / 'out.pileup'
+    profile = tmp_path / 'profile.json'
+    run_main(monkeypatch, remove_bad_entries, ['-i', pileup, '-o', output, '--profile', profile])
+    summary = json.loads(profile.read_text())
+    assert summary['counts']['sites'] == 2000
+    assert summary['counts']['sites'] == sum(summary['rejected'].values()) + records(output)
+    assert {'parse', 'filter', 'write'} <= set(summary['stages'])
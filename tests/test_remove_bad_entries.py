@@ -0,0 +1,21 @@
+import io
+import pileup_parser
+import pcr_thresholds
+import simulate_pileup
+import remove_bad_entries
+import pileup_to_vcf
+
+def simulated_block(nsites = 3000, seed = 3):
+    text = io.StringIO()
+    simulate_pileup.simulate(text, nsites, seed = seed, alt_rate = .02, pcr_rate = .1, indel_rate = .05, edge_rate = .01)
+    return text.getvalue().encode()
+
+def test_vcf_records_match_filtered_text():
+    #the --vcf output from the filtered records must be what pileup_to_vcf makes of the filtered pileup text.
+    batch = pileup_parser.parse_block(simulated_block())
+    records = remove_bad_entries.filter_records(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    text = ('\n'.join(['\t'.join(r) for r in records]) + '\n').encode()
+    direct = pileup_to_vcf.call_batch(pileup_parser.RecordBatch(records), pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    reparsed = pileup_to_vcf.call_batch(pileup_parser.parse_block(text, require = b'ACGT'), pcr_duplicate_track = pcr_thresholds.ThresholdCache())
+    assert len(direct) > 0
+    assert direct == reparsed
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import bgzf
+import pileup_parser
+import pcr_thresholds
+import pileup_to_vcf
+import pileup_to_vcf_snpg
+import pileup_to_plaintxt
+import collapse_pileup_to_mut
+import simulate_pileup
+import site_store
+
+CALLERS = {
+    'pileup_to_vcf': lambda batch: pileup_to_vcf.call_batch(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache(pnum = 200)),
+    'pileup_to_vcf_snpg': lambda batch: pileup_to_vcf_snpg.call_batch(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache(pnum = 200)),
+    'pileup_to_plaintxt': lambda batch: pileup_to_plaintxt.call_batch(batch, mind = 20, pcr_duplicate_track = pcr_thresholds.ThresholdCache(pnum = 200)),
+    'collapse_pileup_to_mut': lambda batch: collapse_pileup_to_mut.call_batch(batch, pcr_duplicate_track = pcr_thresholds.ThresholdCache(pnum = 200)),
+}
+REGIONS = [('chr1', 100, 900), ('chr2', 1, 50), ('chr2', 1500, 3000), ('chr9', 1, 100)]
+
+@pytest.fixture(scope = 'module')
+def inputs(tmp_path_factory):
+    #a simulated pileup with read start/end markup and indels, its BGZF copy with an index, and a store built from it.
+    tmp = tmp_path_factory.mktemp('store')
+    pileup = str(tmp / 'sim.pileup')
+    with open(pileup, 'w+') as outf:
+        simulate_pileup.simulate(outf, 6000, contigs = 2, seed = 7, alt_rate = .03, pcr_rate = .05, indel_rate = .01, edge_rate = .02)
+    compressed = pileup + '.gz'
+    bgzf.compress_pileup(pileup, compressed)
+    bgzf.write_index(compressed, bgzf.build_index(compressed))
+    store = str(tmp / 'sim.store')
+    assert site_store.build_store(pileup, store) == 6000
+    return pileup, compressed, store
+
+def calls(path, caller, regions = None, require = b'ACGT'):
+    return sum([CALLERS[caller](batch) for batch in pileup_parser.read_batches(path, regions, require = require)], [])
+
+@pytest.mark.parametrize('caller', sorted(CALLERS))
+def test_store_matches_text(inputs, caller):
+    pileup, compressed, store = inputs
+    text = calls(pileup, caller)
+    assert len(text) > 0
+    assert calls(store, caller) == text
+    assert calls(store, caller, require = None) == calls(pileup, caller, require = None)
+
+@pytest.mark.parametrize('caller', sorted(CALLERS))
+def test_store_regions_match_text(inputs, caller):
+    pileup, compressed, store = inputs
+    assert calls(store, caller, REGIONS) == calls(compressed, caller, REGIONS)
+
+def test_store_built_from_regions(inputs, tmp_path):
+    pileup, compressed, store = inputs
+    part = str(tmp_path / 'part.store')
+    site_store.build_store(compressed, part, REGIONS)
+    assert calls(part, 'pileup_to_vcf') == calls(compressed, 'pileup_to_vcf', REGIONS)
+
+def test_quality_counts(inputs):
+    pileup, compressed, store = inputs
+    columns = site_store.load_store(store)
+    depths = np.diff(np.asarray(columns['offsets']))
+    assert np.array_equal(np.asarray(columns['counts']).sum(axis = (1, 2)), depths)
+    with open(pileup) as inf:
+        for i, line in enumerate(inf):
+            if i % 97 == 0:
+                spent = line.rstrip('\n').split('\t')
+                bases, quals = pileup_parser.clean_site(spent[4], spent[5])
+                row = np.asarray(columns['counts'][i])
+                for j, symbol in enumerate('ACGTN.'):
+                    digits = [int(q) for b, q in zip(bases, quals) if b == symbol]
+                    assert row[j].tolist() == np.bincount(np.clip(np.array(digits, dtype = np.int64), 0, 9), minlength = 10).tolist()
+
+def test_store_version(inputs, tmp_path):
+    path = tmp_path / 'old.store'
+    path.mkdir()
+    (path / 'contigs.txt').write_text('#site_store\tversion=0\n')
+    with pytest.raises(ValueError):
+        site_store.load_store(str(path))
+
+def test_region_ranges_match_a_full_scan(inputs):
+    pileup, compressed, store = inputs
+    columns = site_store.load_store(store)
+    names = np.array(columns['names'])[np.asarray(columns['contig'])]
+    pos = np.asarray(columns['pos'])
+    rng = np.random.default_rng(5)
+    regions = [('chr' + str(rng.integers(1, 4)), int(a), int(a + rng.integers(0, 400))) for a in rng.integers(1, 3200, 300)]
+    assert set(site_store.contig_spans(columns)) == {'chr1', 'chr2'}
+    ranges = site_store.region_ranges(columns, regions)
+    expected = [np.flatnonzero((names == c) & (pos >= s) & (pos <= e)) for c, s, e in regions if c != 'chr3']
+    assert len(ranges) == len(expected)
+    for (lo, hi), sites in zip(ranges, expected):
+        assert np.array_equal(np.arange(lo, hi), sites)